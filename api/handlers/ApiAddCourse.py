@@ -1,4 +1,5 @@
 from .BaseSocket import BaseSocket
+from tornado import gen
 from tornado.escape import json_decode, json_encode
 
 class ApiAddCourse(BaseSocket):
@@ -7,13 +8,26 @@ class ApiAddCourse(BaseSocket):
     def open(self):
         pass
 
+    @gen.coroutine
     def on_message(self, message):
         data = json_decode(message)
-        self.user = self.get_user_obj(data["username"])
-        if self.is_authenticated(data["username"], data["apikey"]):
-            with self.db.session_scope() as session:
-                course = self.db.fetch_course_by_id(session, data["course"])
-                self.db.add_rating(session, data["username"], course.identifier, semester=course.semester, professor=course.professor, year=course.year, rating=None, difficulty=None, grade=None)
-            self.write_message(json_encode({"stat":"added"}))
+        claims = self.verify_token(data)
+        if claims is not None:
+            reply = yield self.add_course_message(claims, data)
+            self.write_message(json_encode(reply))
         else:
             self.write_message(json_encode({"stat":"failed"}))
+
+    @gen.coroutine
+    def add_course_message(self, claims, data):
+        """
+        Adds data["course"] to the courses of the user the claims are of
+
+        Return -> the reply to the message
+        """
+        yield self.adb.run(self.add_course, claims.username, data["course"])
+        raise gen.Return({"stat":"added"})
+
+    def add_course(self, session, username, course_id):
+        course = self.db.fetch_course_by_id(session, course_id)
+        self.db.add_rating(session, username, course.identifier, semester=course.semester, professor=course.professor, year=course.year, rating=None, difficulty=None, grade=None)
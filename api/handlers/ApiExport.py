@@ -0,0 +1,47 @@
+from .BaseApi import BaseHandler
+from databases.Exporter import Exporter
+from tornado import gen
+from tornado.web import authenticated, HTTPError
+
+class ApiExport(BaseHandler):
+    """
+    Streams a table, or the part of it belonging to ?school=<id>, as csv or
+    newline delimited json, for admins.  The rows are read a page at a time
+    through the AsyncDatabase and each page is flushed as a chunk, so the
+    export takes the same memory whatever the size of the school.
+    """
+    page_size = 1000
+
+    @authenticated
+    @gen.coroutine
+    def get(self, table, form=None):
+        if self.claims is not None:
+            admin = self.claims.admin and self.tokens.current(self.claims, (yield self.get_user_obj_async()))
+        else:
+            admin = (yield self.get_user_obj_async()).admin
+        if not admin:
+            raise HTTPError(403)
+        if table not in Exporter.tables:
+            raise HTTPError(404)
+        school_id = self.get_argument("school", None)
+        school_id = int(school_id) if school_id else None
+        form = form or "csv"
+        exporter = Exporter(self.db)
+
+        if form == "csv":
+            self.set_header("Content-Type", "text/csv")
+            self.write(exporter.csv_header(table))
+        else:
+            self.set_header("Content-Type", "application/x-ndjson")
+        self.set_header("Content-Disposition", "attachment; filename={}.{}".format(table, form))
+
+        after = None
+        while True:
+            # each page in a session of its own, so no connection is held while a slow client reads the last one
+            rows = yield self.async_db.run(exporter.page, table, school_id, after, self.page_size)
+            if not rows:
+                break
+            self.write(exporter.csv_lines(rows) if form == "csv" else exporter.json_lines(table, rows))
+            yield self.flush()
+            after = exporter.key(table, rows[-1])
+        self.finish()
@@ -1,9 +1,11 @@
 from .BaseApi import BaseHandler
 from databases.database import ItemDoesNotExistError
+from tornado import gen
 
 class ApiSchool(BaseHandler):
     """
     """
+    @gen.coroutine
     def get(self, school_value):
         try:
             school_id = int(school_value)
@@ -12,25 +14,34 @@ class ApiSchool(BaseHandler):
             school_abbr = " ".join(school_value.split("_"))
             school_id = None
 
-        with self.db.session_scope() as session:
-            try:
-                if school_id:
-                    school = self.db.fetch_school_by_id(session, school_id)
-                else:
-                    school = self.db.fetch_school_by_name(session, school_abbr)
-            
-                if school is None:
-                    self.write(self.render_object(dict(Error="No school found")))
-                else:
-                    values = {}
-                    values["school_name"] = school.school_name
-                    values["school_short"] = school.school_short
-                    values["school_id"] = school.school_id
-                    values["courses"] = [str(course.identifier) for course in school.courses]
-                    values["studends"] = [str(student.user_name) for student in school.students]
+        try:
+            values = yield self.adb.run(self.school, school_id, school_abbr)
+        except ItemDoesNotExistError:
+            values = None
+
+        if values is None:
+            self.write(self.render_object(dict(Error="No school found")))
+        else:
+            self.write(self.render_object(values))
+            self.finish()
+
+    def school(self, session, school_id, school_abbr):
+        """
+        Looks a school up by id or name, run by self.adb on a worker thread
 
-                    self.write(self.render_object(values))
-                    self.finish()
+        Return -> the dict of the school's values that is served, or None
+        """
+        if school_id:
+            school = self.db.fetch_school_by_id(session, school_id)
+        else:
+            school = self.db.fetch_school_by_name(session, school_abbr)
 
-            except ItemDoesNotExistError:
-                self.write(self.render_object(dict(Error="No school found")))
+        if school is None:
+            return None
+        values = {}
+        values["school_name"] = school.school_name
+        values["school_short"] = school.school_short
+        values["school_id"] = school.school_id
+        values["courses"] = [str(course.identifier) for course in school.courses]
+        values["studends"] = [str(student.user_name) for student in school.students]
+        return values
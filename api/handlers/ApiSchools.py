@@ -1,10 +1,12 @@
 from .BaseApi import BaseHandler
+from tornado import gen
 
 class ApiSchools(BaseHandler):
     """
     """
+    @gen.coroutine
     def get(self, school_id=None, school_abbreviation=None):
-        schools = self.db.schools
+        schools = yield self.adb.schools()
         values = dict(schools={school.school_id:school.school_short for school in schools}) 
         self.write(self.render_object(values))
         self.finish()
@@ -0,0 +1,90 @@
+from .ApiAddCourse import ApiAddCourse
+from .ApiToggleSocket import ApiToggleSocket
+from .BaseSocket import BaseSocket
+from tornado import gen
+from tornado.escape import json_decode, json_encode
+from tornado.ioloop import IOLoop
+
+class ApiSocket(ApiAddCourse, ApiToggleSocket):
+    """
+    A single socket a page keeps open for all of its requests, in place of a
+    connection per click to api/add_course or api/toggle.  Every message is
+    a json object with a type, the request's id and a token:
+
+        {"id": 3, "type": "toggle", "token": "...", "toggled": 12, "role": "moderator"}
+
+    and is answered with the reply the single purpose socket would give,
+    carrying the same id, so that a page can have several requests out at
+    once.  A message that fails is answered with {"id": ..., "stat": "failed"}
+    and the socket stays open.
+
+    The types are
+        add_course -- adds "course" to the sender's courses
+        toggle     -- toggles the "role" of the user with the id "toggled"
+        predict    -- the sender's predicted rating, grade and difficulty of
+                      "course"
+        subscribe  -- the sender's predictions of every course they haven't
+                      rated, after which the socket is pushed the ones that
+                      change whenever their ratings do (see PredictionPush)
+    """
+    messages = dict(add_course="add_course_message", toggle="toggle_message", predict="predict_message",
+                    subscribe="subscribe_message")
+
+    def initialize(self, db, adb=None, tokens=None, filters=None, push=None):
+        BaseSocket.initialize(self, db, adb, tokens)
+        self.filters = filters
+        self.push = push
+
+    def open(self):
+        pass
+
+    def on_close(self):
+        self.push.unsubscribe(self)
+
+    def on_message(self, message):
+        # tornado reads no further message until a coroutine on_message returns, so each is answered by one of its own
+        IOLoop.current().spawn_callback(self.reply, message)
+
+    @gen.coroutine
+    def reply(self, message):
+        """
+        Answers a message, with the reply carrying its id
+        """
+        data = json_decode(message)
+        reply = {"stat":"failed"}
+        claims = self.verify_token(data)
+        if claims is not None and data.get("type") in self.messages:
+            try:
+                reply = yield getattr(self, self.messages[data["type"]])(claims, data)
+            except Exception as error:
+                print("{} message from {} failed, {!r}".format(data["type"], claims.username, error))
+        reply["id"] = data.get("id")
+        # the page may have gone while the reply was worked out
+        if self.ws_connection is not None:
+            self.write_message(json_encode(reply))
+
+    @gen.coroutine
+    def predict_message(self, claims, data):
+        """
+        Predicts what the user the claims are of would make of data["course"]
+
+        Return -> the reply to the message, with the predicted rating, grade
+                  and difficulty, each None if no similar user rated the course
+        """
+        course_id = int(data["course"])
+        rating, grade, difficulty = yield [self.filters.rating.calculated_rating_async(claims.user_id, course_id),
+                                           self.filters.grade.calculated_rating_async(claims.user_id, course_id),
+                                           self.filters.difficulty.calculated_rating_async(claims.user_id, course_id)]
+        raise gen.Return({"stat":"predicted", "course":course_id, "rating":rating, "grade":grade, "difficulty":difficulty})
+
+    @gen.coroutine
+    def subscribe_message(self, claims, data):
+        """
+        Subscribes the socket to the changes of the predictions of the user
+            the claims are of
+
+        Return -> the reply to the message, with every current prediction
+        """
+        predictions = yield self.push.subscribe(self, claims.user_id, claims.school_id)
+        predictions["stat"] = "subscribed"
+        raise gen.Return(predictions)
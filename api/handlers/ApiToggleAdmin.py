@@ -9,10 +9,15 @@ class ApiToggleAdmin(BaseHandler):
     def get(self, user_id):
         self.get_user_obj()
         if self.user.admin is True:
+            toggled = None
             with self.db.session_scope() as session:
                 other = self.db.fetch_user_by_id(session, user_id)
                 if self.user.user_id is not other.user_id:
-                    other.admin = not other.admin
+                    self.db.toggle_role(session, other, "admin")
+                    toggled = other.user_name
+            # the toggled user's tokens claim the role they had
+            if toggled is not None and self.tokens is not None:
+                self.tokens.revoke_user(toggled)
             self.redirect("/adminpanel")
         else:
             self.redirect("/welcome") 
\ No newline at end of file
@@ -11,7 +11,11 @@ class ApiToggleMod(BaseHandler):
         if self.user.admin is True or self.user.admin is True:
             with self.db.session_scope() as session:
                 other = self.db.fetch_user_by_id(session, user_id)
-                other.moderator = not other.moderator
+                self.db.toggle_role(session, other, "moderator")
+                toggled = other.user_name
+            # the toggled user's tokens claim the role they had
+            if self.tokens is not None:
+                self.tokens.revoke_user(toggled)
             self.redirect("/adminpanel")
         else:
             self.redirect("/welcome") 
\ No newline at end of file
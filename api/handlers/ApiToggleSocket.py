@@ -1,4 +1,5 @@
 from .BaseSocket import BaseSocket
+from tornado import gen
 from tornado.escape import json_decode, json_encode
 
 class ApiToggleSocket(BaseSocket):
@@ -7,19 +8,45 @@ class ApiToggleSocket(BaseSocket):
     def open(self):
         pass
 
+    @gen.coroutine
     def on_message(self, message):
         data = json_decode(message)
-        self.user = self.get_user_obj(data["username"])
-        if self.is_authenticated(data["username"], data["apikey"]):
-            with self.db.session_scope() as session:
-                toggled_user = self.db.fetch_user_by_id(session, data["toggled"])
-                if data["role"] == "moderator" and any([self.user.moderator, self.user.admin]) and data["username"] != toggled_user.user_name:
-                    toggled_user.moderator = not toggled_user.moderator
-                elif data["role"] == "admin" and data["username"] != toggled_user.user_name and self.user.admin:
-                    toggled_user.admin = not toggled_user.admin
-                else:
-                    self.write_message(json_encode({"stat":"failed"}))
-                    return
-            self.write_message(json_encode({"stat":"toggled"}))
+        claims = self.verify_token(data)
+        if claims is not None:
+            reply = yield self.toggle_message(claims, data)
+            self.write_message(json_encode(reply))
         else:
             self.write_message(json_encode({"stat":"failed"}))
+
+    @gen.coroutine
+    def toggle_message(self, claims, data):
+        """
+        Toggles the data["role"] of the user with the id data["toggled"], if
+            the user the claims are of may
+
+        Return -> the reply to the message
+        """
+        toggled = yield self.adb.run(self.toggle, claims, data["toggled"], data["role"])
+        if toggled:
+            # the toggled user's tokens claim the role they had
+            self.tokens.revoke_user(toggled)
+        raise gen.Return({"stat":"toggled" if toggled else "failed"})
+
+    def toggle(self, session, claims, toggled_id, role):
+        """
+        Flips the moderator or admin role of a user, if the user the claims
+            are of may
+
+        Return -> the name of the toggled user, or None if nothing was toggled
+        """
+        # the claimed roles are only trusted if they haven't changed since the token was issued
+        if not self.tokens.current(claims, self.db.fetch_user_by_id(session, claims.user_id)):
+            return None
+        toggled_user = self.db.fetch_user_by_id(session, toggled_id)
+        if role == "moderator" and any([claims.moderator, claims.admin]) and claims.username != toggled_user.user_name:
+            self.db.toggle_role(session, toggled_user, "moderator")
+        elif role == "admin" and claims.username != toggled_user.user_name and claims.admin:
+            self.db.toggle_role(session, toggled_user, "admin")
+        else:
+            return None
+        return toggled_user.user_name
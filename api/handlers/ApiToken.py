@@ -0,0 +1,26 @@
+from .BaseApi import BaseHandler
+from tornado import gen
+from tornado.web import authenticated, HTTPError
+
+class ApiToken(BaseHandler):
+    """
+    Hands a signed in user a token for the api and the websockets, and
+    revokes the token a request is sent with.  Tokens are only handed out for
+    the cookie, so that a token can't be traded for a fresh one and outlive
+    its expiry.
+    """
+    @authenticated
+    @gen.coroutine
+    def get(self):
+        if not self.user_cookie:
+            raise HTTPError(403)
+        user = yield self.get_user_obj_async()
+        self.write(self.render_object(dict(token=self.tokens.issue(user), expires_in=self.tokens.lifetime)))
+        self.finish()
+
+    @authenticated
+    def delete(self):
+        if self.claims is not None:
+            self.tokens.revoke(self.claims)
+        self.write(self.render_object(dict(stat="revoked" if self.claims is not None else "failed")))
+        self.finish()
@@ -1,9 +1,11 @@
 from .BaseApi import BaseHandler
 from databases.database import ItemDoesNotExistError
+from tornado import gen
 
 class ApiUser(BaseHandler):
     """
     """
+    @gen.coroutine
     def get(self, user_value):
         try:
             user_id = int(user_value)
@@ -12,30 +14,38 @@ class ApiUser(BaseHandler):
             user_name = " ".join(user_value.split("_"))
             user_id = None
 
-        with self.db.session_scope() as session:
-            try:
-                if user_id:
-                    user = self.db.fetch_user_by_id(session, user_id)
-                else:
-                    user = self.db.fetch_user_by_name(session, user_name)
-            
-                if user is None:
-                    self.write(self.render_object(dict(Error="No school found")))
-                else:
-                    values = {}
-                    values["school_id"] = user.school_id
-                    values["user_name"] = user.user_name
-                    values["first_name"] = user.first_name
-                    values["last_name"] = user.last_name
-                    values["last_name"] = user.last_name
-                    values["age"] = user.age
-                    values["graduation"] = user.graduation
-                    values["admin"] = user.admin
-                    values["moderator"] = user.moderator
-                    values["courses"] = [str(course.course_name) for course in user.courses]
+        try:
+            values = yield self.adb.run(self.user_values, user_id, user_name)
+        except ItemDoesNotExistError:
+            values = None
+
+        if values is None:
+            self.write(self.render_object(dict(Error="No school found")))
+        else:
+            self.write(self.render_object(values))
+            self.finish()
+
+    def user_values(self, session, user_id, user_name):
+        """
+        Looks a user up by id or name, run by self.adb on a worker thread
 
-                    self.write(self.render_object(values))
-                    self.finish()
+        Return -> the dict of the user's values that is served, or None
+        """
+        if user_id:
+            user = self.db.fetch_user_by_id(session, user_id)
+        else:
+            user = self.db.fetch_user_by_name(session, user_name)
 
-            except ItemDoesNotExistError:
-                self.write(self.render_object(dict(Error="No school found")))
+        if user is None:
+            return None
+        values = {}
+        values["school_id"] = user.school_id
+        values["user_name"] = user.user_name
+        values["first_name"] = user.first_name
+        values["last_name"] = user.last_name
+        values["age"] = user.age
+        values["graduation"] = user.graduation
+        values["admin"] = user.admin
+        values["moderator"] = user.moderator
+        values["courses"] = [str(course.course_name) for course in user.courses]
+        return values
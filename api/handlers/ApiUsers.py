@@ -1,10 +1,12 @@
 from .BaseApi import BaseHandler
+from tornado import gen
 
 class ApiUsers(BaseHandler):
     """
     """
+    @gen.coroutine
     def get(self, school_id=None, school_abbreviation=None):
-        users = self.db.users
+        users = yield self.adb.users()
         values = dict(schools={user.user_id:user.user_name for user in users}) 
         self.write(self.render_object(values))
         self.finish()
@@ -1,6 +1,7 @@
 """
 The base class from which most (all? other api handlers will inherit)
 """
+from tornado import gen
 from tornado.web import RequestHandler
 import tornado
 import json
@@ -14,29 +15,108 @@ class BaseHandler(RequestHandler):
         An override to the builtin @authenticate, can be rewritten to be better
             if eventually necessary
 
-        This one should also have some sort of api key auth method, will work
-            on that eventually
+        A request is signed in by its cookie, or by a token sent as
+            "Authorization: Bearer <token>" or ?token=<token>
         """
-        return self.get_secure_cookie("user")
+        return self.user_cookie or self.claims
 
 
-    def initialize(self, db):
+    def initialize(self, db, adb=None, tokens=None):
         """
         Gives the handler some base information that it can then change
         """
 
         self.set_header("Content-Type", "application/json")
-        if self.get_secure_cookie("user"):
-            self.username = tornado.escape.json_decode(self.get_secure_cookie("user"))
+        # the cookie's signature is checked once, here, rather than by every method that needs the username
+        cookie = self.get_secure_cookie("user")
+        if cookie:
+            self.username = tornado.escape.json_decode(cookie)
+        self.user_cookie = cookie
+        # without a cookie, a token is checked in memory and says what roles its user has without a query
+        self.tokens = tokens
+        self.claims = None
+        if not cookie and tokens is not None:
+            token = self.request_token()
+            self.claims = tokens.verify(token) if token else None
+            if self.claims is not None:
+                self.username = self.claims.username
         self.db = db
+        self.async_db = adb
+        self._session = None
+        self._adb = None
         self.data = {"auth":False, "user":None}
 
+    def request_token(self):
+        """
+        Return -> the token the request was sent with, or None
+        """
+        authorization = self.request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            return authorization[len("Bearer "):].strip()
+        return self.get_argument("token", None)
+
     def get_user_obj(self):
-        self.username = tornado.escape.json_decode(self.get_secure_cookie("user"))
-        with self.db.session_scope() as session:
-            self.user = self.db.fetch_user_by_name(session, self.username)
+        """
+        The signed in user, from the Database's cache of them when it is there,
+            detached so only its columns can be read
+        """
+        self.user = self.db.current_user(self.username)
         return self.user
 
+    @gen.coroutine
+    def get_user_obj_async(self):
+        """
+        get_user_obj, without blocking the IOLoop when the user isn't cached
+        """
+        self.user = self.db.cached_user(self.username)
+        if self.user is None:
+            self.user = yield self.async_db.call(self.db.current_user, self.username)
+        raise gen.Return(self.user)
+
+    @property
+    def session(self):
+        """
+        The session of this request, shared by every query it makes so that
+            each object is only fetched once, created the first time it is
+            used and committed once the request has finished
+
+        From its first query to its commit the session holds one of the
+            engine's pooled connections, so a handler commits before it waits
+            on anything else (the hasher, the filters, a slow client) and uses
+            the unbound self.async_db for lookups made before such a wait
+        """
+        if self._session is None:
+            self._session = self.db.sessionmaker()
+        return self._session
+
+    @property
+    def adb(self):
+        """
+        The AsyncDatabase, bound to the request's session
+        """
+        if self._adb is None:
+            self._adb = self.async_db.bind(self.session)
+        return self._adb
+
+    @gen.coroutine
+    def commit(self):
+        """
+        Commits what the request has done so far, for a handler that reads
+            something the commit updates, like the filters, before it finishes,
+            or that is about to wait on something other than the database, as
+            the commit hands the session's connection back to the pool
+        """
+        if self._session is not None:
+            yield self.adb.commit()
+
+    def on_finish(self):
+        """
+        Commits the request's session, or rolls it back if the request failed
+        """
+        if self._session is not None:
+            session, self._session, self._adb = self._session, None, None
+            self.async_db.finish(session, commit=self.get_status() < 500)
+
     def render_object(self, dictionary):
         return json.dumps(dictionary)
 
@@ -1,3 +1,4 @@
+from tornado import gen
 from tornado.websocket import WebSocketHandler
 
 class BaseSocket(WebSocketHandler):
@@ -5,18 +6,31 @@ class BaseSocket(WebSocketHandler):
     a base class for websockets
     """
 
-    def initialize(self, db):
+    def initialize(self, db, adb=None, tokens=None):
         self.db = db
+        self.adb = adb
+        self.tokens = tokens
 
-    def is_authenticated(self, user_name, password_hash):
-        with self.db.session_scope() as session:
-            user = self.db.fetch_user_by_name(session, user_name)
-            if user.apikey == password_hash:
-                return True
-        return False
+    def verify_token(self, data):
+        """
+        Checks the token a message was sent with, in memory
+
+        Return -> the TokenClaims of the sender, or None if the token isn't
+                  valid
+        """
+        return self.tokens.verify(data.get("token"))
 
     def get_user_obj(self, username):
         self.username = username
-        with self.db.session_scope() as session:
-            user = self.db.fetch_user_by_name(session, self.username)
-        return user
\ No newline at end of file
+        return self.db.current_user(self.username)
+
+    @gen.coroutine
+    def get_user_obj_async(self, username):
+        """
+        get_user_obj, without blocking the IOLoop when the user isn't cached
+        """
+        self.username = username
+        user = self.db.cached_user(self.username)
+        if user is None:
+            user = yield self.adb.call(self.db.current_user, self.username)
+        raise gen.Return(user)
@@ -0,0 +1,134 @@
+"""
+A bounded cache for the collaborative filters
+"""
+
+from collections import OrderedDict
+import sys
+import time
+
+# what an entry costs beyond its key and value: the OrderedDict's slot and link, and the (value, expiry) tuple
+ENTRY_OVERHEAD = 170
+
+
+def sizeof(value):
+    """
+    Estimates the bytes a key or value takes, counting the items of a tuple
+        but nothing deeper, which covers what the collaborative filter caches
+
+    Return -> the size in bytes
+    """
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    A dictionary like cache that holds at most max_entries values, and at most
+    max_bytes bytes of them, evicting the least recently used values when it is
+    full.  Values can also be given a time to live, after which they are
+    dropped as if they had never been cached.
+
+    The bytes are an estimate, ENTRY_OVERHEAD plus sizeof the key and the
+    value.  For the collaborative filter, whose keys are pairs of ids and whose
+    values are up to three floats, that comes to 280 to 420 bytes an entry.
+
+    Keeps count of its hits, misses, evictions and expirations so that the size
+    of the cache can be tuned against real load.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, max_bytes=None, clock=time.monotonic, sizeof=sizeof):
+        """
+        Arguments:
+            max_entries -> the most values held at once, None for no limit
+            ttl         -> seconds a value stays valid for, None for forever
+            max_bytes   -> the most bytes held at once, None for no limit
+            clock       -> a function returning the current time in seconds
+            sizeof      -> a function estimating the bytes of a key or value
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key->tuple(value, expiry, bytes), least recently used first
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key, or default if it is not cached
+        """
+        if self._live(key):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        if self._live(key):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        self.misses += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        expiry = None if self.ttl is None else self.clock() + self.ttl
+        size = ENTRY_OVERHEAD + self.sizeof(key) + self.sizeof(value)
+        if key in self._entries:
+            self.bytes -= self._entries[key][2]
+        self._entries[key] = (value, expiry, size)
+        self._entries.move_to_end(key)
+        self.bytes += size
+        while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                 (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.bytes -= self._entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        self.bytes -= self._entries.pop(key)[2]
+
+    def __contains__(self, key):
+        return self._live(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        """
+        Removes key and returns its value, or default if it is not cached
+        """
+        if self._live(key):
+            value, expiry, size = self._entries.pop(key)
+            self.bytes -= size
+            return value
+        return default
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        Return -> a dict of the size of the cache and its counters
+        """
+        return dict(size=len(self._entries), max_entries=self.max_entries, bytes=self.bytes, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations)
+
+    def _live(self, key):
+        """
+        Whether key is cached and unexpired, dropping it if it has expired
+        """
+        if key not in self._entries:
+            return False
+        expiry = self._entries[key][1]
+        if expiry is not None and expiry <= self.clock():
+            del self[key]
+            self.expirations += 1
+            return False
+        return True
@@ -4,7 +4,9 @@ The collaborative filtering portion of the system.
 
 
 import databases.database as databases
+from backend.Cache import LRUCache
 from math import sqrt
+import heapq
 from sys import stdout
 
 class CollaborativeFilter(object):
@@ -13,19 +15,31 @@ class CollaborativeFilter(object):
     for speed
     """
 
-    def __init__(self, name, path, table, debug=False, cache=True):
+    def __init__(self, name, path, table, debug=False, cache=True, cacheSize=100000, cacheTtl=None, cacheBytes=None, cacheFactory=LRUCache, neighbours=None, minOverlap=1):
         """
         Initilialies the collaborative filter with the values
 
         Arguments:
-            name  -> the name of the database file
-            path  -> the path to the database file
-            table -> the name of the table in the database file
-            debug -> activates debug mode, providing additional outputs and
-                     information about what is happening
-            cache -> used for testing, to compare between the caches being used
-                     and a normal, cache free version both for benchmarking and
-                     for error checking
+            name         -> the name of the database file
+            path         -> the path to the database file
+            table        -> the name of the table in the database file
+            debug        -> activates debug mode, providing additional outputs and
+                            information about what is happening
+            cache        -> used for testing, to compare between the caches being used
+                            and a normal, cache free version both for benchmarking and
+                            for error checking
+            cacheSize    -> the most entries each of the three caches may hold, the
+                            least recently used entries are evicted past it, None for
+                            no limit.  An entry is 280 to 420 bytes, so the default
+                            holds up to about 110MB across the three
+            cacheTtl     -> seconds before a cached entry is recalculated, None for never
+            cacheBytes   -> the most bytes each of the three caches may hold, as
+                            estimated by LRUCache, None for no limit
+            cacheFactory -> called as cacheFactory(cacheSize, cacheTtl, cacheBytes) to
+                            make each cache, anything with get, in, [] and stats() will do
+            neighbours   -> if given, only this many most similar users are used
+                            to predict an opinion, rather than every user
+            minOverlap   -> the fewest items a user must share to count as a neighbour
         """
 
         self.name = name
@@ -33,19 +47,32 @@ class CollaborativeFilter(object):
         self.table = table
         self.debug = debug
         self.cache = cache
+        self.neighbours = neighbours
+        self.minOverlap = minOverlap
         self.db = databases.Database(self.name, self.table, self.path)
 
-        #implemented as map(user->map(item->opinion))
+        #the caches are bounded, so that they stop growing as users squared under load
+
+        #implemented as map(tuple(user, item)->opinion)
         #opinions can be None or 1-5
-        self.opinions = {}
+        self.opinions = cacheFactory(cacheSize, cacheTtl, cacheBytes)
 
-        #implemented as map(user1->map(user2->tuple(rss(u1), rss(u2), multSum(u1, u2))))
+        #implemented as map(tuple(user1, user2)->tuple(rss(u1), rss(u2), multSum(u1, u2)))
         #rss(u) is root sum squared
         #multSum(u1, u2) is sum(u1[item]*u2[item] for item in sharedItems)
-        self.similarities = {}
+        self.similarities = cacheFactory(cacheSize, cacheTtl, cacheBytes)
+
+        #implemented as map(tuple(user1, item)->tuple(sum(simil*opinions[user][item] for user in users), sum(simil for user in users)))
+        self.calculated = cacheFactory(cacheSize, cacheTtl, cacheBytes)
 
-        #implemented as map(user1->map(item->tuple(sum(simil*opinions[user][item] for user in users), sum(simil for user in users))))
-        self.calculated = {}
+
+    def cacheStats(self):
+        """
+        Returns the hit, miss and eviction counters of the caches
+
+        Return -> map(cache name->stats)
+        """
+        return {"opinions": self.opinions.stats(), "similarities": self.similarities.stats(), "calculated": self.calculated.stats()}
 
 
     def items(self):
@@ -91,11 +118,11 @@ class CollaborativeFilter(object):
         """
 
         if self.cache == True:
-            if user not in self.calculated:
-                self.calculated[user] = {}
-            if item not in self.calculated[user]:
-                self.calculated[user][item] = self._calculateWeights(user, item)
-            return self._ratingFromCalculated(*self.calculated[user][item])
+            weights = self.calculated.get((user, item))
+            if weights is None:
+                weights = self._calculateWeights(user, item)
+                self.calculated[(user, item)] = weights
+            return self._ratingFromCalculated(*weights)
         else:
             pass #for now
             #return self._ratingFromCalculated(*self._forceNoCacheRating(user, item))
@@ -132,11 +159,33 @@ class CollaborativeFilter(object):
         
         #create the users and items sets
         users = {person[0] for person in self.users()} - {user}
+        if self.neighbours:
+            users = self._neighbours(user, users)
 
         #use those sets to seperately calculate the top and bottom values for the final rating
         return (self._ratingTop(user, item, users), self._ratingBottom(user, item, users)) 
 
 
+    def _neighbours(self, user, users):
+        """
+        Picks the most similar users to a user, out of those that share enough items with them.
+        This scans every user and item, so it is O(users * items) per prediction; the legacy
+        filter is deliberately left that way, backend.Filter with backend.Neighbourhood keeps
+        the neighbours incrementally over a RatingMatrix and is what the site serves
+
+        Arguments:
+            user  -> the user for which you are calculating an opinion
+            users -> the other users
+
+        Return -> a set of at most self.neighbours users
+        """
+
+        items = [column[0] for column in self.items()]
+        userItems = {item for item in items if self._opinion(user, item) != 0}
+        peers = [other for other in users if len(userItems) >= self.minOverlap and sum(1 for item in userItems if self._opinion(other, item) != 0) >= self.minOverlap]
+        return set(heapq.nlargest(self.neighbours, peers, key=lambda other: self._similarity(user, other)))
+
+
     def _ratingTop(self, user, item, users): #done
         """
         Calculates the top portion of the fraction that a user would have for an item based on other users
@@ -177,11 +226,11 @@ class CollaborativeFilter(object):
         Return -> the similarity between user and other
         """
 
-        if user not in self.similarities:
-            self.similarities[user] = {}
-        if other not in self.similarities[user]:
-            self.similarities[user][other] = self._setSimilarities(user, other)
-        return self._calculateSimilarity(*self.similarities[user][other])
+        similarity = self.similarities.get((user, other))
+        if similarity is None:
+            similarity = self._setSimilarities(user, other)
+            self.similarities[(user, other)] = similarity
+        return self._calculateSimilarity(*similarity)
 
 
     def _calculateSimilarity(self, rssUser, rssOther, multSum): #done
@@ -258,11 +307,11 @@ class CollaborativeFilter(object):
         Return -> the opinion a user has for an item based directly on the database, either a number or 0 representing a null value
         """
 
-        if user not in self.opinions:
-            self.opinions[user] = {}
-        if item not in self.opinions[user]:
-            self.opinions[user][item] = self.fetchOpinion(user, item) or 0
-        return self.opinions[user][item]
+        opinion = self.opinions.get((user, item))
+        if opinion is None:
+            opinion = self.fetchOpinion(user, item) or 0
+            self.opinions[(user, item)] = opinion
+        return opinion
 
 
     def changeOpinion(self, user, item, opinion): #in progress
@@ -289,9 +338,7 @@ class CollaborativeFilter(object):
         #checks to see if the item is removed or not
         change = self._checkNewOrRemoved(user, item, usersItems, opinion, oldOpinion)
         #then this needs to be updated in the opinions matrix
-        if user not in self.opinions:
-            self.opinions[user] = {}
-        self.opinions[user][item] = opinion
+        self.opinions[(user, item)] = opinion
 
         #then this change needs to propgate out to all of the similarities
         users = {person[0] for person in self.users()} - {user}
@@ -340,53 +387,54 @@ class CollaborativeFilter(object):
         #this whole secion could probably be cleaned up, I'm almost certain it could be in fact
         #maybe refactor it into its own sub-function that gets called twice
 
-        if user in self.similarities:
+        #an evicted pair is simply recalculated the next time it is needed
+        if (user, other) in self.similarities:
             #updates the similarities matrix for user
-            if other in self.similarities[user]:
-                rssUser = sqrt(self.similarities[user][other][0] ** 2 - oldOpinion ** 2 + opinion ** 2)
-                newA = self.similarities[user][other][2] + self._opinion(other, item) * (opinion - oldOpinion)
-                if change == 1:
-                    #adds item to the overall list of items
-                    rssOther = sqrt(self.similarities[user][other][1] + self._opinion(other, item) ** 2)
-                elif change == -1:
-                    #removes item from the overall list of items
-                    rssOther = sqrt(self.similarities[user][other][1] - self._opinion(other, item) ** 2)
-                else:
-                    rssOther = sqrt(self.similarities[user][other][1])
-                oldSimil = self._calculateSimilarity(*self.similarities[user][other])
-                self.similarities[user][other] = (rssUser, rssOther, newA)
-                items = [column[0] for column in self.items()]
-                for otherItem in items:
-                    self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
+            similarity = self.similarities[(user, other)]
+            rssUser = sqrt(similarity[0] ** 2 - oldOpinion ** 2 + opinion ** 2)
+            newA = similarity[2] + self._opinion(other, item) * (opinion - oldOpinion)
+            if change == 1:
+                #adds item to the overall list of items
+                rssOther = sqrt(similarity[1] + self._opinion(other, item) ** 2)
+            elif change == -1:
+                #removes item from the overall list of items
+                rssOther = sqrt(similarity[1] - self._opinion(other, item) ** 2)
             else:
-                pass
-                #although this could reasonably be set up to instead calculate the ratings instead
+                rssOther = sqrt(similarity[1])
+            oldSimil = self._calculateSimilarity(*similarity)
+            self.similarities[(user, other)] = (rssUser, rssOther, newA)
+            items = [column[0] for column in self.items()]
+            for otherItem in items:
+                self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
+        else:
+            pass
+            #although this could reasonably be set up to instead calculate the ratings instead
 
         #this should be tested
-        if other in self.similarities:
+        if (other, user) in self.similarities:
             #updates the similarities matrix for other, in case similarities[other][user] exists
-            if user in self.similarities[other]:
-                rssUser = sqrt(self.similarities[other][user][0] ** 2 - oldOpinion ** 2 + opinion ** 2)
-                newA = self.similarities[other][user][2] + self._opinion(other, item) * (opinion - oldOpinion)
-                if change == 1:
-                    #adds item to the overall list of items
-                    rssOther = sqrt(self.similarities[other][user][1] + self._opinion(other, item) ** 2)
-                elif change == -1:
-                    #removes item from the overall list of items
-                    rssOther = sqrt(self.similarities[other][user][1] - self._opinion(other, item) ** 2)
-                else:
-                    rssOther = sqrt(self.similarities[other][user][1])
-                    #keep in mind that user and other switch in this case,everything else is the same
-                oldSimil = self._calculateSimilarity(*self.similarities[other][user])
-                self.similarities[other][user] = (rssOther, rssUser, newA)
-                items = [column[0] for column in self.items()]
-                for otherItem in items:
-                    self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
-                #then update for the user 
-                #self.caculated[user][item] = self._forceNoCacheRating(user, item)
+            similarity = self.similarities[(other, user)]
+            rssUser = sqrt(similarity[0] ** 2 - oldOpinion ** 2 + opinion ** 2)
+            newA = similarity[2] + self._opinion(other, item) * (opinion - oldOpinion)
+            if change == 1:
+                #adds item to the overall list of items
+                rssOther = sqrt(similarity[1] + self._opinion(other, item) ** 2)
+            elif change == -1:
+                #removes item from the overall list of items
+                rssOther = sqrt(similarity[1] - self._opinion(other, item) ** 2)
             else:
-                pass
-                #although once more, this could recalulate everything and set it.
+                rssOther = sqrt(similarity[1])
+                #keep in mind that user and other switch in this case,everything else is the same
+            oldSimil = self._calculateSimilarity(*similarity)
+            self.similarities[(other, user)] = (rssOther, rssUser, newA)
+            items = [column[0] for column in self.items()]
+            for otherItem in items:
+                self._updateCalculatedRating(user, item, other, opinion, oldOpinion, oldSimil)
+            #then update for the user 
+            #self.caculated[user][item] = self._forceNoCacheRating(user, item)
+        else:
+            pass
+            #although once more, this could recalulate everything and set it.
 
 
     def _noCacheRating(self, user, item):#done
@@ -453,13 +501,14 @@ class CollaborativeFilter(object):
         Return -> None
         """
 
-        if other not in self.calculated:
-            return
-        if item not in self.calculated[other]:
+        calculated = self.calculated.get((other, item))
+        if calculated is None:
             return
-        newTop = self.calculated[other][item][0] + self.similarities[other][other] * opinion - oldOpinion * oldSimil
-        newBot = self.calculated[other][item][1] - oldSimil + self.similarities[other][other]
-        self.calculated[other][item] = (newTop, newBot)
+        #the pair may have been evicted, so it goes through _similarity, which recalculates it
+        similarity = self._similarity(other, other)
+        newTop = calculated[0] + similarity * opinion - oldOpinion * oldSimil
+        newBot = calculated[1] - oldSimil + similarity
+        self.calculated[(other, item)] = (newTop, newBot)
 
 
 
@@ -0,0 +1,275 @@
+"""
+The collaborative filter backed by trained factor models
+"""
+
+import os
+import numpy
+from tornado import gen
+from .FactorModel import FactorModel
+from .RatingStore import RatingStore
+
+
+class FactorFilter(object):
+    """
+    A collaborative filter over a single attribute of the ratings table that
+    answers from FactorModels trained offline (see train, and the train command
+    of routing.py), with the same predictions interface as Filter.
+
+    Nothing is learnt at request time: a prediction is one dot product and a
+    recommendation one matrix vector product.  Users and courses added since a
+    model was trained have no factors, and get no predictions until the next
+    training.  A model trained on an older revision of the ratings than the
+    store holds is loaded again once its file changes, so that a server picks
+    up the models the train command writes without restarting.
+
+    Given a fallback filter, the _async methods answer from a school's model
+    only while it was trained on the ratings the store holds, and from the
+    fallback otherwise, so the web application can serve the models whenever
+    they are current.  The matrix of a school is only loaded to compare the
+    revisions once a model of it has been trained.
+
+    instance data:
+        folder   -- where the models are kept, one file per school and attribute
+        fallback -- the filter answering when there is no current model, or None
+        models   -- map(tuple(school_id, attribute)->FactorModel), None where
+                    there is no trained model
+        modified -- map(tuple(school_id, attribute)->the modification time of
+                    the model's file when it was loaded, None if there was none)
+    """
+    def __init__(self, table, rating, folder, store=None, fallback=None):
+        self.table = table
+        self.rating = rating
+        self.folder = folder
+        self.store = store or RatingStore(table)
+        self.fallback = fallback
+        self.models = {}
+        self.modified = {}
+
+    def model(self, school_id, attribute=None):
+        """
+        Returns the FactorModel of a school, loading it if it isn't loaded or is
+            behind the school's ratings and has been retrained since, or None if
+            none has been trained
+        """
+        key = (school_id, attribute or self.rating)
+        model = self.models.get(key)
+        if model is not None and model.revision == self._revision(school_id):
+            return model
+        modified = self._modified(*key)
+        if key not in self.models or modified != self.modified[key]:
+            self.models[key] = None if modified is None else FactorModel.load(self._path(*key))
+            self.modified[key] = modified
+        return self.models[key]
+
+    def current(self, school_id, attribute=None):
+        """
+        Returns the FactorModel of a school if it was trained on the ratings
+            the store holds, otherwise None
+        """
+        model = self.model(school_id, attribute)
+        return model if model is not None and model.revision == self._revision(school_id) else None
+
+    def train(self, school_id, attribute=None, **options):
+        """
+        Trains and saves the model of a school on its current ratings
+
+        Arguments:
+            school_id -> the school to train the model for
+            attribute -> the attribute to model, the filter's own by default
+            options   -> passed on to FactorModel.train
+
+        Return -> the trained FactorModel
+        """
+        attribute = attribute or self.rating
+        matrix = self.store.matrix(school_id)
+        model = FactorModel.train(matrix, attribute, school_id, self.store.revisions[school_id], **options)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        model.save(self._path(school_id, attribute))
+        self.models[(school_id, attribute)] = model
+        self.modified[(school_id, attribute)] = self._modified(school_id, attribute)
+        return model
+
+    def calculated_rating(self, user_id, course_id):
+        """
+        Predicts the value a user would give a course
+
+        Arguments:
+            user_id   -> the user whose opinion is to be calculated
+            course_id -> the course of which the user has an unknown opinion
+
+        Return -> the predicted value, or None if there is no model for the user or course
+        """
+        model = self.model(self.store.school_of(user_id))
+        return None if model is None else model.predict(user_id, course_id)
+
+    def recommend(self, user_id, n=10, attribute=None):
+        """
+        Finds the courses with the highest predicted values for a user out of
+            the courses at their school that they have not rated
+
+        Arguments:
+            user_id   -> the user to recommend courses to
+            n         -> the number of courses to recommend
+            attribute -> the attribute to rank by, the filter's own by default
+
+        Return -> a list of up to n tuple(course_id, predicted value), best first
+        """
+        school_id = self.store.school_of(user_id)
+        model = self.model(school_id, attribute)
+        scores = None if model is None or n <= 0 else model.scores(user_id)
+        if scores is None:
+            return []
+
+        matrix = self.store.matrix(school_id)
+        candidates = numpy.ones(len(scores), dtype=bool)
+        if user_id in matrix.users:
+            user = matrix.users[user_id]
+            rated = matrix.course_ids[matrix.indices[matrix.indptr[user]:matrix.indptr[user + 1]]]
+            candidates[[model.courses[course_id] for course_id in rated if course_id in model.courses]] = False
+        candidates = numpy.flatnonzero(candidates)
+        scores = scores[candidates]
+        if len(candidates) > n:
+            best = numpy.argpartition(-scores, n - 1)[:n]
+            candidates, scores = candidates[best], scores[best]
+        order = numpy.argsort(-scores, kind="mergesort")
+        return [(int(model.course_ids[course]), float(score)) for course, score in zip(candidates[order], scores[order])]
+
+    def predict(self, user_id, course_ids=None, attribute=None):
+        """
+        Predicts the values a user would give a few courses, or every course at
+            their school
+
+        Return -> map(course_id->predicted value) of every course asked for,
+                  None where there is no model for it or the user rated it
+        """
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if course_ids is None:
+            course_ids = [int(course_id) for course_id in matrix.course_ids]
+        predictions = dict.fromkeys(course_ids)
+        model = self.model(school_id, attribute)
+        scores = None if model is None else model.scores(user_id)
+        if scores is None:
+            return predictions
+        rated = set()
+        if user_id in matrix.users:
+            user = matrix.users[user_id]
+            rated = set(matrix.course_ids[matrix.indices[matrix.indptr[user]:matrix.indptr[user + 1]]].tolist())
+        for course_id in course_ids:
+            if course_id in model.courses and course_id not in rated:
+                predictions[course_id] = float(scores[model.courses[course_id]])
+        return predictions
+
+    def changed_courses(self, user_id, changes):
+        """
+        The courses whose predictions for a user the given committed rating
+            changes can have moved.  A model doesn't learn from them, so only
+            the courses the user themself rated or unrated move.
+
+        Return -> a list of course_ids
+        """
+        return sorted({change.course_id for change in changes if change.user_id == user_id})
+
+    def changed_predictions(self, user_id, changes):
+        """
+        predict for the courses the changes can have moved, see changed_courses
+
+        Return -> map(course_id->predicted value or None)
+        """
+        return self.predict(user_id, self.changed_courses(user_id, changes))
+
+    @gen.coroutine
+    def calculated_rating_async(self, user_id, course_id):
+        """
+        calculated_rating, from the current model or else the fallback
+
+        Return -> a Future of the predicted value
+        """
+        school_id = yield self._ready(user_id)
+        if self._falls_back(school_id):
+            result = yield self.fallback.calculated_rating_async(user_id, course_id)
+            raise gen.Return(result)
+        raise gen.Return(self.calculated_rating(user_id, course_id))
+
+    @gen.coroutine
+    def recommend_async(self, user_id, n=10, attribute=None):
+        """
+        recommend, from the current model or else the fallback
+
+        Return -> a Future of the list of tuple(course_id, predicted value)
+        """
+        school_id = yield self._ready(user_id, attribute)
+        if self._falls_back(school_id, attribute):
+            result = yield self.fallback.recommend_async(user_id, n, attribute)
+            raise gen.Return(result)
+        raise gen.Return(self.recommend(user_id, n, attribute))
+
+    @gen.coroutine
+    def predict_async(self, user_id, course_ids=None, attribute=None):
+        """
+        predict, from the current model or else the fallback
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        school_id = yield self._ready(user_id, attribute)
+        if self._falls_back(school_id, attribute):
+            result = yield self.fallback.predict_async(user_id, course_ids, attribute)
+            raise gen.Return(result)
+        raise gen.Return(self.predict(user_id, course_ids, attribute))
+
+    @gen.coroutine
+    def changed_predictions_async(self, user_id, changes):
+        """
+        changed_predictions, from the current model or else the fallback.  Once
+            the changes leave the model behind, every prediction the user was
+            last sent from it is replaced by the fallback's.
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        school_id = yield self._ready(user_id)
+        if not self._falls_back(school_id):
+            raise gen.Return(self.changed_predictions(user_id, changes))
+        model = self.models.get((school_id, self.rating))
+        # the changes of a commit are all at the revision it moved the school to
+        if model is not None and model.revision >= min(change.revision for change in changes) - 1:
+            result = yield self.fallback.predict_async(user_id)
+        else:
+            result = yield self.fallback.changed_predictions_async(user_id, changes)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _ready(self, user_id, attribute=None):
+        """
+        Return -> a Future of the user's school_id, which resolves once the
+                  school's matrix is loaded if a model of it has been trained
+        """
+        school_id = yield self.store.school_of_async(user_id)
+        key = (school_id, attribute or self.rating)
+        if self.models.get(key) is not None or self._modified(*key) is not None:
+            yield self.store.matrix_async(school_id)
+        raise gen.Return(school_id)
+
+    def _falls_back(self, school_id, attribute=None):
+        """
+        Return -> whether the fallback answers for the school, having no model
+                  trained on its current ratings
+        """
+        return self.fallback is not None and self.current(school_id, attribute) is None
+
+    def _revision(self, school_id):
+        """
+        The revision of the ratings the store holds for a school, loading them
+            if necessary
+        """
+        self.store.matrix(school_id)
+        return self.store.revisions[school_id]
+
+    def _path(self, school_id, attribute):
+        return os.path.join(self.folder, "school-{}-{}.factors".format(school_id, attribute))
+
+    def _modified(self, school_id, attribute):
+        try:
+            return os.stat(self._path(school_id, attribute)).st_mtime_ns
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,129 @@
+"""
+A latent factor model of one attribute of a school's ratings
+"""
+
+import numpy
+from . import Snapshot
+
+
+class FactorModel(object):
+    """
+    Approximates the values users give courses as
+        value(u, i) = mean + user_factors[u] . course_factors[i]
+    with a few factors per user and course, trained by alternating least
+    squares: holding the course factors fixed, each user's factors are the
+    solution of a small regularised least squares problem over the courses
+    they rated, and then the same for each course, over a few iterations.
+
+    Once trained, a prediction is one dot product and ranking every course for
+    a user is one matrix vector product.  The factors are stored as float32.
+
+    instance data:
+        school_id      -- the school the model was trained for
+        revision       -- the revision of the school's ratings it was trained on
+        mean           -- the mean of every value it was trained on
+        users          -- map(user_id->row of user_factors)
+        courses        -- map(course_id->row of course_factors)
+        user_ids       -- array(row->user_id)
+        course_ids     -- array(row->course_id)
+        user_factors   -- a (users x factors) array
+        course_factors -- a (courses x factors) array
+    """
+
+    def __init__(self, school_id, revision, mean, user_ids, course_ids, user_factors, course_factors):
+        self.school_id = school_id
+        self.revision = revision
+        self.mean = float(mean)
+        self.user_ids = user_ids
+        self.course_ids = course_ids
+        self.user_factors = user_factors
+        self.course_factors = course_factors
+        self.users = {int(user_id): row for row, user_id in enumerate(user_ids)}
+        self.courses = {int(course_id): row for row, course_id in enumerate(course_ids)}
+
+    @classmethod
+    def train(cls, matrix, attribute, school_id, revision, factors=10, regularization=0.1, iterations=10, seed=0):
+        """
+        Trains a model on one attribute of a school's ratings
+
+        Arguments:
+            matrix         -> the RatingMatrix of the school
+            attribute      -> one of RatingMatrix.attributes
+            school_id      -> the school the matrix belongs to
+            revision       -> the revision of the school's ratings the matrix reflects
+            factors        -> the number of latent factors per user and course
+            regularization -> how strongly large factors are penalised, scaled
+                              by the number of values each row is fitted to
+            iterations     -> the number of times both sides are solved for
+
+        Return -> the trained FactorModel
+        """
+        values = matrix.attribute(attribute).tocsr()
+        mean = values.data.mean() if values.nnz else 0.0
+        centred = values.copy()
+        centred.data = centred.data - mean
+        by_course = centred.tocsc()
+
+        random = numpy.random.RandomState(seed)
+        user_factors = random.normal(0, 0.1, (matrix.shape[0], factors))
+        course_factors = random.normal(0, 0.1, (matrix.shape[1], factors))
+        for iteration in range(iterations):
+            cls._solve(centred.indptr, centred.indices, centred.data, course_factors, user_factors, regularization)
+            cls._solve(by_course.indptr, by_course.indices, by_course.data, user_factors, course_factors, regularization)
+
+        return cls(school_id, revision, mean, numpy.array(matrix.user_ids), numpy.array(matrix.course_ids),
+                   user_factors.astype(numpy.float32), course_factors.astype(numpy.float32))
+
+    @staticmethod
+    def _solve(indptr, indices, data, fixed, solved, regularization):
+        """
+        Solves for every row of solved in place, holding fixed constant.  Row r
+            is fitted to the values data[indptr[r]:indptr[r+1]], which were
+            given with the rows indices[indptr[r]:indptr[r+1]] of fixed.
+        """
+        identity = numpy.eye(fixed.shape[1])
+        for row in range(len(solved)):
+            start, end = indptr[row], indptr[row + 1]
+            if start == end:
+                solved[row] = 0
+                continue
+            known = fixed[indices[start:end]]
+            solved[row] = numpy.linalg.solve(known.T.dot(known) + regularization * (end - start) * identity, known.T.dot(data[start:end]))
+
+    def predict(self, user_id, course_id):
+        """
+        Return -> the value the model predicts the user would give the course,
+                  None if either is new since the model was trained
+        """
+        if user_id not in self.users or course_id not in self.courses:
+            return None
+        return self.mean + float(self.user_factors[self.users[user_id]].dot(self.course_factors[self.courses[course_id]]))
+
+    def scores(self, user_id):
+        """
+        Return -> the predicted value of every course for a user, in the order
+                  of course_ids, or None if the user is new since training
+        """
+        if user_id not in self.users:
+            return None
+        return self.mean + self.course_factors.dot(self.user_factors[self.users[user_id]])
+
+    def save(self, path):
+        """
+        Writes the model to a file, in the snapshot format
+        """
+        arrays = dict(mean=numpy.array([self.mean]), user_ids=self.user_ids, course_ids=self.course_ids,
+                      user_factors=self.user_factors, course_factors=self.course_factors)
+        Snapshot.write_snapshot(path, self.school_id, self.revision, arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps a model written by save
+
+        Return -> the FactorModel
+        """
+        header = Snapshot.read_header(path)
+        arrays = Snapshot.read_snapshot(path, header)
+        return cls(header["school_id"], header["revision"], arrays["mean"][0], arrays["user_ids"], arrays["course_ids"],
+                   arrays["user_factors"], arrays["course_factors"])
@@ -1,45 +1,325 @@
-from math import sqrt
+"""
+The collaborative filter used by the web application
+"""
+
+import numpy
+from tornado import gen
+from .RatingStore import RatingStore
+from .Similarities import Similarities
+
 
 class Filter(object):
     """
-    this is going to be a really naive and as a result slow implementation
-    of the filtering algorithm, its gonna be hella slow for more than proabably
-    like 10 ratings/users
+    A user based collaborative filter over a single attribute of the ratings
+    table (rating, grade or difficulty).
+
+    The ratings of each school are read from a RatingStore, which holds them as
+    a sparse users x courses matrix that can be shared between the filters of
+    the different attributes, along with precomputed similarity sums that it
+    keeps up to date as ratings change.  A prediction reads one row of those
+    sums and one column of the matrix rather than scanning every rating.
+
+    Given a number of neighbours k, the filter only weighs each user's k most
+    similar peers that share at least min_overlap courses with them, so a
+    prediction costs O(k) and isn't drowned out by barely similar users.
+
+    At schools too large to keep the similarity of every pair of users, the
+    filter can be made approximate: each user's neighbours are then found among
+    the candidates of a MinHashIndex and scored exactly, so nothing is
+    quadratic in the number of users.  See backend/LSHBenchmark.py for how much
+    this costs in recall.  A school with more students than the similarities
+    are kept for (Similarities.max_users) is always treated approximately.
 
-    eww
+    Given a JobPool, the _async versions of the methods build any similarities
+    they need in the pool rather than on the IOLoop.
     """
-    def __init__(self, table, rating):
+    def __init__(self, table, rating, store=None, neighbours=None, min_overlap=1, approximate=False, jobs=None):
         self.table = table
         self.rating = rating
+        self.store = store or RatingStore(table)
+        self.neighbours = neighbours
+        self.min_overlap = min_overlap
+        self.approximate = approximate
+        self.jobs = jobs
 
     def similarity(self, user_id, other_id):
         """
-        """
-        with self.table.session_scope() as session:
-            user = self.table.fetch_user_by_id(session, user_id)
-            other = self.table.fetch_user_by_id(session, other_id)
+        Calculates the cosine similarity of two users over the courses that
+            both of them have rated
 
-            shared_courses = {course for course in user.courses if getattr(self.table.fetch_rating_by_id(session, user.user_id, course.course_id), self.rating) is not None} & {course for course in other.courses if getattr(self.table.fetch_rating_by_id(session, other.user_id, course.course_id), self.rating) is not None}
-            user_rss = sqrt(sum(getattr(self.table.fetch_rating_by_id(session, user_id, course.course_id), self.rating) ** 2 for course in shared_courses))
-            other_rss = sqrt(sum(getattr(self.table.fetch_rating_by_id(session, other_id, course.course_id), self.rating) ** 2 for course in shared_courses))
-            multiplicative_sum = sum(getattr(self.table.fetch_rating_by_id(session, user_id, course.course_id), self.rating) * getattr(self.table.fetch_rating_by_id(session, other_id, course.course_id), self.rating) for course in shared_courses)
-        return 0 if user_rss * other_rss == 0 else multiplicative_sum / (user_rss * other_rss)
+        Arguments:
+            user_id  -> the user whose opinion is being calculated
+            other_id -> the user to whom they are being compared
 
+        Return -> the similarity between the two users, 0 if they share no courses
+        """
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if user_id not in matrix.users or other_id not in matrix.users:
+            return 0
+        if self._approximate(school_id):
+            return float(matrix.cosine(self.rating, matrix.users[user_id], [matrix.users[other_id]])[0][0])
+        return float(self._similarities(school_id, matrix.users[user_id])[matrix.users[other_id]])
 
     def calculated_rating(self, user_id, course_id):
         """
+        Predicts the value a user would give a course, weighting the ratings of
+            the other students at their school by their similarity to the user
+
+        Arguments:
+            user_id   -> the user whose opinion is to be calculated
+            course_id -> the course of which the user has an unknown opinion
+
+        Return -> the predicted value, or None if no similar user rated the course
+        """
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if user_id not in matrix.users or course_id not in matrix.courses:
+            return None
+        user = matrix.users[user_id]
+
+        if self.neighbours or self._approximate(school_id):
+            others, weights = self._neighbours(school_id, user, self.rating)
+            values, raters = matrix.values_at(self.rating, others, matrix.courses[course_id])
+            top = weights[raters].dot(values[raters])
+            bottom = weights[raters].sum()
+            return None if bottom == 0 else float(top) / float(bottom)
+
+        weights = self._similarities(school_id, user)
+        values, raters = matrix.column(self.rating, matrix.courses[course_id])
+        raters[user] = False
+        top = weights[raters].dot(values[raters])
+        bottom = weights[raters].sum()
+        return None if bottom == 0 else float(top) / float(bottom)
+
+    def recommend(self, user_id, n=10, attribute=None):
+        """
+        Finds the courses at a user's school they have not rated yet with the
+            highest predicted values.  The user's similarities are computed once
+            and every course is scored in one pass, instead of calling
+            calculated_rating once per course.
+
+        Arguments:
+            user_id   -> the user to recommend courses to
+            n         -> the number of courses to return
+            attribute -> the attribute to rank by, defaults to the filter's own
+
+        Return -> a list of up to n tuple(course_id, predicted value), best first
+        """
+        attribute = attribute or self.rating
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if user_id not in matrix.users or n <= 0:
+            return []
+        user = matrix.users[user_id]
+
+        weights = self._weights(school_id, user, attribute)
+        weights[user] = 0
+        top = matrix.attribute(attribute).T.dot(weights)
+        bottom = matrix.rated(attribute).T.dot(weights)
+
+        candidates = bottom != 0
+        candidates[matrix.indices[matrix.indptr[user]:matrix.indptr[user + 1]]] = False
+        candidates = numpy.flatnonzero(candidates)
+        scores = top[candidates] / bottom[candidates]
+        if len(candidates) > n:
+            best = numpy.argpartition(-scores, n - 1)[:n]
+            candidates, scores = candidates[best], scores[best]
+        order = numpy.argsort(-scores, kind="mergesort")
+        return [(int(matrix.course_ids[course]), float(score)) for course, score in zip(candidates[order], scores[order])]
+
+    def predict(self, user_id, course_ids=None, attribute=None):
+        """
+        Predicts the values a user would give a few courses, or every course at
+            their school, scoring them together from the user's similarities as
+            recommend does, but reading only the ratings of those courses
+
+        Arguments:
+            user_id    -> the user whose opinions are to be calculated
+            course_ids -> the courses to predict, None for every course
+            attribute  -> the attribute to predict, defaults to the filter's own
+
+        Return -> map(course_id->predicted value) of every course asked for,
+                  None where no similar user rated it or the user rated it themself
+        """
+        attribute = attribute or self.rating
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if course_ids is None:
+            course_ids = [int(course_id) for course_id in matrix.course_ids]
+        predictions = dict.fromkeys(course_ids)
+        columns = numpy.array([matrix.courses[course_id] for course_id in course_ids if course_id in matrix.courses], dtype=numpy.int64)
+        if user_id not in matrix.users or len(columns) == 0:
+            return predictions
+        user = matrix.users[user_id]
+
+        weights = self._weights(school_id, user, attribute)
+        weights[user] = 0
+        # the slot of every column asked for, -1 for the rest
+        slots = numpy.full(matrix.shape[1], -1, dtype=numpy.int64)
+        slots[columns] = numpy.arange(len(columns))
+        positions = numpy.flatnonzero(slots[matrix.indices] >= 0)
+        rows = numpy.searchsorted(matrix.indptr, positions, side="right") - 1
+        values = matrix.values[positions, matrix.attributes.index(attribute)]
+        keep = ~numpy.isnan(values)
+        rows, values, slot = rows[keep], values[keep], slots[matrix.indices[positions[keep]]]
+        top = numpy.bincount(slot, weights=weights[rows] * values, minlength=len(columns))
+        bottom = numpy.bincount(slot, weights=weights[rows], minlength=len(columns))
+
+        rated = slots[matrix.indices[matrix.indptr[user]:matrix.indptr[user + 1]]]
+        bottom[rated[rated >= 0]] = 0
+        for column, value, weight in zip(columns, top, bottom):
+            if weight != 0:
+                predictions[int(matrix.course_ids[column])] = float(value / weight)
+        return predictions
+
+    def changed_courses(self, user_id, changes):
+        """
+        The courses whose predictions for a user the given committed rating
+            changes can have moved, once the store has applied them.  Without
+            neighbours a prediction only moves with the ratings of its course
+            or the weights of its raters, so:
+                a change by the user moves their weight to every other rater
+                    of its course, and so the predictions of every course those
+                    raters rated, as well as of the course itself
+                a change by another user to a course the user rated moves
+                    their weight to the writer, and so the predictions of every
+                    course the writer rated
+                any other change only moves the prediction of its own course
+            With neighbours or when approximate, a weight that moves can change
+            who the neighbours are, so every course is returned.
+
+        Arguments:
+            user_id -> the user whose predictions are being kept up to date
+            changes -> a list of databases.database.RatingChange at their school
+
+        Return -> a list of course_ids
+        """
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if self.neighbours or self._approximate(school_id):
+            return [int(course_id) for course_id in matrix.course_ids]
+        rated = set() if user_id not in matrix.users else set(matrix.indices[matrix.indptr[matrix.users[user_id]]:matrix.indptr[matrix.users[user_id] + 1]])
+        columns = set()
+        for change in changes:
+            column = matrix.courses.get(change.course_id)
+            if column is None:
+                continue
+            columns.add(column)
+            if change.user_id == user_id:
+                raters = numpy.searchsorted(matrix.indptr, numpy.flatnonzero(matrix.indices == column), side="right") - 1
+                for rater in raters:
+                    columns.update(matrix.indices[matrix.indptr[rater]:matrix.indptr[rater + 1]])
+            elif column in rated and change.user_id in matrix.users:
+                writer = matrix.users[change.user_id]
+                columns.update(matrix.indices[matrix.indptr[writer]:matrix.indptr[writer + 1]])
+        return [int(matrix.course_ids[column]) for column in sorted(columns)]
+
+    def changed_predictions(self, user_id, changes):
+        """
+        predict for the courses the changes can have moved, see changed_courses
+
+        Return -> map(course_id->predicted value or None)
+        """
+        return self.predict(user_id, self.changed_courses(user_id, changes))
+
+    @gen.coroutine
+    def calculated_rating_async(self, user_id, course_id):
+        """
+        calculated_rating, with the similarities it needs built in the JobPool
+
+        Return -> a Future of the predicted value
+        """
+        yield self._ready(user_id)
+        raise gen.Return(self.calculated_rating(user_id, course_id))
+
+    @gen.coroutine
+    def recommend_async(self, user_id, n=10, attribute=None):
+        """
+        recommend, with the similarities it needs built in the JobPool
+
+        Return -> a Future of the list of tuple(course_id, predicted value)
+        """
+        yield self._ready(user_id, attribute)
+        raise gen.Return(self.recommend(user_id, n, attribute))
+
+    @gen.coroutine
+    def predict_async(self, user_id, course_ids=None, attribute=None):
+        """
+        predict, with the similarities it needs built in the JobPool
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        yield self._ready(user_id, attribute)
+        raise gen.Return(self.predict(user_id, course_ids, attribute))
+
+    @gen.coroutine
+    def changed_predictions_async(self, user_id, changes):
+        """
+        changed_predictions, with the similarities it needs built in the JobPool
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        yield self._ready(user_id)
+        raise gen.Return(self.changed_predictions(user_id, changes))
+
+    @gen.coroutine
+    def _ready(self, user_id, attribute=None):
+        """
+        Return -> a Future that resolves once the matrix of the user's school,
+                  and unless approximate its similarities, are loaded
+        """
+        school_id = yield self.store.school_of_async(user_id)
+        yield self.store.matrix_async(school_id)
+        if self.jobs is not None and not self._approximate(school_id):
+            yield self.store.similarities_async(school_id, attribute or self.rating, self.jobs)
+
+    def _weights(self, school_id, user, attribute=None):
+        """
+        The weight of every user at the school in the given user's predictions,
+            their similarity, or 0 outside the user's neighbourhood when the
+            filter only considers the nearest neighbours
+        """
+        attribute = attribute or self.rating
+        if not (self.neighbours or self._approximate(school_id)):
+            return self._similarities(school_id, user, attribute)
+        others, similarities = self._neighbours(school_id, user, attribute)
+        weights = numpy.zeros(self.store.matrix(school_id).shape[0])
+        weights[others] = similarities
+        return weights
+
+    def _neighbours(self, school_id, user, attribute):
+        """
+        The neighbours of the user in the given row, their nearest neighbours,
+            or when approximate every candidate sharing enough courses with them
+
+        Return -> tuple(rows, similarities) of the neighbours as arrays
+        """
+        if not self._approximate(school_id):
+            return self.store.neighbourhood_for(school_id, attribute, self.neighbours, self.min_overlap).neighbours(user)
+        matrix = self.store.matrix(school_id)
+        others = self.store.index_for(school_id, attribute).candidates(user)
+        similarities, overlap = matrix.cosine(attribute, user, others)
+        keep = (similarities > 0) & (overlap >= self.min_overlap)
+        others, similarities = others[keep], similarities[keep]
+        if self.neighbours and len(others) > self.neighbours:
+            nearest = numpy.argpartition(-similarities, self.neighbours - 1)[:self.neighbours]
+            others, similarities = others[nearest], similarities[nearest]
+        return others, similarities
+
+    def _approximate(self, school_id):
+        """
+        Whether the neighbours of the users at a school are found approximately,
+            as they are when the filter is approximate or when the school has
+            too many students to keep the similarities of every pair
+        """
+        return self.approximate or not Similarities.fits(self.store.matrix(school_id).shape[0])
+
+    def _similarities(self, school_id, user, attribute=None):
+        """
+        The similarity of the user in the given row to every user at the school,
+            read from the store's precomputed sums
+
+        Return -> a dense vector of similarities, one per row of the matrix
         """
-        with self.table.session_scope() as session:
-            user = self.table.fetch_user_by_id(session, user_id)
-            users = {person for person in self.table.users}
-            new_users = set()
-            for person in users:
-                try:
-                    session.add(person)
-                    new_users.add(person)
-                except:
-                    pass
-            other_users = {other for other in new_users if user.school == other.school and getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) is not None and other.user_id is not user_id}
-            top = sum(self.similarity(user_id, other.user_id) * getattr(self.table.fetch_rating_by_id(session, other.user_id, course_id), self.rating) for other in other_users)
-            bottom = sum(self.similarity(user_id, other.user_id) for other in other_users)
-        return float(top)/float(bottom)
\ No newline at end of file
+        return self.store.similarities_for(school_id, attribute or self.rating).row(user)
@@ -0,0 +1,226 @@
+"""
+The item based collaborative filter
+"""
+
+import numpy
+from tornado import gen
+from .RatingStore import RatingStore
+
+
+class ItemFilter(object):
+    """
+    An item based collaborative filter over a single attribute of the ratings
+    table (rating, grade or difficulty), with the same interface as Filter.
+
+    Instead of comparing a user to every other student, the filter compares
+    courses, and predicts a user's value for a course from the values they gave
+    the courses most like it.  The course to course similarities are read from a
+    RatingStore, which builds them once and only rebuilds them after many
+    ratings have changed, so a prediction costs time in the number of courses
+    the user has rated and the model behind it rarely has to be recomputed.
+
+    Given a JobPool, the _async versions of the methods build the similarities
+    in the pool rather than on the IOLoop, and go on answering from the old
+    similarities while they are rebuilt.
+
+    The web application uses it instead of Filter when FILTER_ENGINE=item.
+    """
+    def __init__(self, table, rating, store=None, jobs=None):
+        self.table = table
+        self.rating = rating
+        self.store = store or RatingStore(table)
+        self.jobs = jobs
+
+    def similarity(self, course_id, other_id):
+        """
+        Calculates the cosine similarity of two courses over the users that
+            rated both of them
+
+        Arguments:
+            course_id -> the course being compared
+            other_id  -> the course to which it is being compared
+
+        Return -> the similarity between the two courses, 0 if no user rated both
+        """
+        with self.table.session_scope() as session:
+            school_id = self.table.fetch_course_by_id(session, course_id).school_id
+        matrix = self.store.matrix(school_id)
+        if course_id not in matrix.courses or other_id not in matrix.courses:
+            return 0
+        items = self.store.item_similarities_for(school_id, self.rating)
+        return float(items.row(matrix.courses[course_id], [matrix.courses[other_id]])[0])
+
+    def calculated_rating(self, user_id, course_id):
+        """
+        Predicts the value a user would give a course, weighting the values they
+            gave other courses by the similarity of those courses to it
+
+        Arguments:
+            user_id   -> the user whose opinion is to be calculated
+            course_id -> the course of which the user has an unknown opinion
+
+        Return -> the predicted value, or None if the user rated no similar course
+        """
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if user_id not in matrix.users or course_id not in matrix.courses:
+            return None
+        course = matrix.courses[course_id]
+        columns, values = matrix.row(self.rating, matrix.users[user_id])
+        weights = self.store.item_similarities_for(school_id, self.rating).row(course, columns)
+        weights[columns == course] = 0
+
+        bottom = weights.sum()
+        return None if bottom == 0 else float(weights.dot(values)) / float(bottom)
+
+    def recommend(self, user_id, n=10, attribute=None):
+        """
+        Finds the courses with the highest predicted values for a user out of
+            the courses at their school that they have not rated
+
+        Arguments:
+            user_id   -> the user to recommend courses to
+            n         -> the number of courses to recommend
+            attribute -> the attribute to rank by, the filter's own by default
+
+        Return -> a list of up to n tuple(course_id, predicted value), best first
+        """
+        attribute = attribute or self.rating
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if user_id not in matrix.users or n <= 0:
+            return []
+
+        top, bottom = self._sums(school_id, matrix.users[user_id], attribute)
+        candidates = numpy.flatnonzero(bottom != 0)
+        scores = top[candidates] / bottom[candidates]
+        if len(candidates) > n:
+            best = numpy.argpartition(-scores, n - 1)[:n]
+            candidates, scores = candidates[best], scores[best]
+        order = numpy.argsort(-scores, kind="mergesort")
+        return [(int(matrix.course_ids[course]), float(score)) for course, score in zip(candidates[order], scores[order])]
+
+    def predict(self, user_id, course_ids=None, attribute=None):
+        """
+        Predicts the values a user would give a few courses, or every course at
+            their school, scoring them together as recommend does
+
+        Arguments:
+            user_id    -> the user whose opinions are to be calculated
+            course_ids -> the courses to predict, None for every course
+            attribute  -> the attribute to predict, defaults to the filter's own
+
+        Return -> map(course_id->predicted value) of every course asked for,
+                  None where the user rated no similar course or rated it themself
+        """
+        attribute = attribute or self.rating
+        school_id = self.store.school_of(user_id)
+        matrix = self.store.matrix(school_id)
+        if course_ids is None:
+            course_ids = [int(course_id) for course_id in matrix.course_ids]
+        predictions = dict.fromkeys(course_ids)
+        if user_id not in matrix.users:
+            return predictions
+        top, bottom = self._sums(school_id, matrix.users[user_id], attribute)
+        for course_id in course_ids:
+            course = matrix.courses.get(course_id)
+            if course is not None and course < len(bottom) and bottom[course] != 0:
+                predictions[course_id] = float(top[course] / bottom[course])
+        return predictions
+
+    def changed_courses(self, user_id, changes):
+        """
+        The courses whose predictions for a user the given committed rating
+            changes can have moved.  The similarities are only rebuilt once many
+            ratings have changed, so in between only the user's own changes
+            move their predictions, and those move every one of them.
+
+        Arguments:
+            user_id -> the user whose predictions are being kept up to date
+            changes -> a list of databases.database.RatingChange at their school
+
+        Return -> a list of course_ids
+        """
+        if not any(change.user_id == user_id for change in changes):
+            return []
+        return [int(course_id) for course_id in self.store.matrix(self.store.school_of(user_id)).course_ids]
+
+    def changed_predictions(self, user_id, changes):
+        """
+        predict for the courses the changes can have moved, see changed_courses
+
+        Return -> map(course_id->predicted value or None)
+        """
+        return self.predict(user_id, self.changed_courses(user_id, changes))
+
+    @gen.coroutine
+    def calculated_rating_async(self, user_id, course_id):
+        """
+        calculated_rating, with the similarities it needs built in the JobPool
+
+        Return -> a Future of the predicted value
+        """
+        yield self._ready(user_id)
+        raise gen.Return(self.calculated_rating(user_id, course_id))
+
+    @gen.coroutine
+    def recommend_async(self, user_id, n=10, attribute=None):
+        """
+        recommend, with the similarities it needs built in the JobPool
+
+        Return -> a Future of the list of tuple(course_id, predicted value)
+        """
+        yield self._ready(user_id, attribute)
+        raise gen.Return(self.recommend(user_id, n, attribute))
+
+    @gen.coroutine
+    def predict_async(self, user_id, course_ids=None, attribute=None):
+        """
+        predict, with the similarities it needs built in the JobPool
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        yield self._ready(user_id, attribute)
+        raise gen.Return(self.predict(user_id, course_ids, attribute))
+
+    @gen.coroutine
+    def changed_predictions_async(self, user_id, changes):
+        """
+        changed_predictions, with the similarities it needs built in the JobPool
+
+        Return -> a Future of map(course_id->predicted value or None)
+        """
+        yield self._ready(user_id)
+        raise gen.Return(self.changed_predictions(user_id, changes))
+
+    def _sums(self, school_id, user, attribute):
+        """
+        The weighted sum of the user's values and the sum of the weights, per
+            course, weighting each course they rated by its similarity to the
+            course being scored.  The weights of the courses the user rated are
+            left 0, so that they are never predicted.
+
+        Return -> tuple(top, bottom), two vectors with one entry per course the
+                  similarities were built with
+        """
+        matrix = self.store.matrix(school_id)
+        items = self.store.item_similarities_for(school_id, attribute)
+        columns, values = matrix.row(attribute, user)
+        columns, values = columns[columns < items.size], values[columns < items.size]
+        weights = items.similarity[:, columns].astype(float)
+        top = weights.dot(values)
+        bottom = weights.sum(axis=1)
+        rated = matrix.indices[matrix.indptr[user]:matrix.indptr[user + 1]]
+        bottom[rated[rated < items.size]] = 0
+        return top, bottom
+
+    @gen.coroutine
+    def _ready(self, user_id, attribute=None):
+        """
+        Return -> a Future that resolves once the matrix of the user's school
+                  and its course similarities are loaded
+        """
+        school_id = yield self.store.school_of_async(user_id)
+        yield self.store.matrix_async(school_id)
+        if self.jobs is not None:
+            yield self.store.item_similarities_async(school_id, attribute or self.rating, self.jobs)
@@ -0,0 +1,70 @@
+"""
+Precomputed similarities of every pair of courses at a school
+"""
+
+import numpy
+
+
+class ItemSimilarities(object):
+    """
+    The cosine similarity of every pair of courses at a school for one rating
+    attribute, taken over the users who rated both courses:
+        similarity(i, j) = sum(r[u][i] * r[u][j]) / sqrt(sum(r[u][i] ** 2) * sum(r[u][j] ** 2))
+    with every sum over the users u who rated both i and j.
+
+    A school has far fewer courses than ratings and the similarity of two
+    courses settles as they collect ratings, so unlike the user similarities
+    these are not updated on every rating.  They are rebuilt from the matrix
+    once enough ratings have changed, see RatingStore.item_similarities_for.
+
+    instance data:
+        similarity -- a (courses x courses) array, 0 for courses with no raters in common
+        changes    -- the number of rating changes since the similarities were built
+    """
+
+    def __init__(self, matrix, attribute):
+        """
+        Computes the similarities of every pair of courses in a RatingMatrix
+
+        Arguments:
+            matrix    -> the RatingMatrix of the school
+            attribute -> one of RatingMatrix.attributes
+        """
+        values = matrix.attribute(attribute)
+        mult_sum = values.T.dot(values).toarray()
+        rss = matrix.squared(attribute).T.dot(matrix.rated(attribute)).toarray()
+        bottom = numpy.sqrt(rss * rss.T)
+        self.similarity = numpy.where(bottom == 0, 0, mult_sum / numpy.where(bottom == 0, 1, bottom)).astype(numpy.float32)
+        self.changes = 0
+
+    @classmethod
+    def from_arrays(cls, similarity):
+        """
+        Rebuilds the similarities from their array, as stored in a snapshot
+        """
+        similarities = cls.__new__(cls)
+        similarities.similarity = similarity
+        similarities.changes = 0
+        return similarities
+
+    @property
+    def size(self):
+        return len(self.similarity)
+
+    def row(self, course, columns):
+        """
+        The similarity of a course to a few others, 0 for courses added to the
+            school since the similarities were built
+
+        Arguments:
+            course  -> the column of the course
+            columns -> the columns of the courses it is compared to
+
+        Return -> a vector of similarities, one per column given
+        """
+        columns = numpy.asarray(columns, dtype=numpy.int64)
+        similarities = numpy.zeros(len(columns))
+        if course < self.size:
+            known = columns < self.size
+            similarities[known] = self.similarity[course, columns[known]]
+        return similarities
@@ -0,0 +1,122 @@
+"""
+A pool of worker processes for the filters' heavy computation
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from .RatingMatrix import RatingMatrix
+from .Similarities import Similarities
+from .ItemSimilarities import ItemSimilarities
+
+
+class JobPool(object):
+    """
+    Runs jobs in a process pool so that building a model never blocks the
+    IOLoop, and hands their results back to the IOLoop as tornado Futures that
+    handlers can yield.
+
+    Jobs are submitted under a key naming what they build.  While a job is
+    running, submitting another job with the same key returns the first job's
+    future instead, so a hundred requests arriving while a school's model is
+    being built wait on a single build.
+
+    instance data:
+        executor  -- the concurrent.futures executor the jobs run in
+        pending   -- map(key->Future) of the jobs still running
+        submitted -- the number of jobs run
+        coalesced -- the number of submissions answered by an already running job
+    """
+
+    def __init__(self, workers=None, executor=None):
+        """
+        Arguments:
+            workers  -> the number of worker processes, one per cpu by default
+            executor -> an executor to use instead of a new process pool
+        """
+        self.executor = executor or ProcessPoolExecutor(workers)
+        self.pending = {}
+        self.submitted = 0
+        self.coalesced = 0
+
+    def submit(self, key, function, *args, finished=None, arguments=None):
+        """
+        Runs function(*args) in the pool, unless a job with the same key is
+            already running
+
+        Arguments:
+            key       -> a hashable name for what the job computes, None for a
+                         job that is never shared
+            function  -> a module level function, so that it can be pickled
+            args      -> its arguments, which must be picklable too
+            finished  -> a function called with the job's result on the IOLoop
+                         before the future resolves, whose return value
+                         becomes the future's result
+            arguments -> a function returning the tuple of arguments instead of
+                         args, called only if the job is run rather than
+                         answered by a running one, for arguments that are
+                         costly to gather
+
+        Return -> a tornado Future of the result
+        """
+        if key is not None and key in self.pending:
+            self.coalesced += 1
+            return self.pending[key]
+
+        if arguments is not None:
+            args = arguments()
+        future = Future()
+        if key is not None:
+            self.pending[key] = future
+        self.submitted += 1
+
+        def done(job):
+            self.pending.pop(key, None)
+            try:
+                result = job.result()
+                if finished is not None:
+                    result = finished(result)
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        IOLoop.current().add_future(self.executor.submit(function, *args), done)
+        return future
+
+    def stats(self):
+        """
+        Return -> a dict of the number of jobs running and the counters
+        """
+        return dict(pending=len(self.pending), submitted=self.submitted, coalesced=self.coalesced)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def resolved(result):
+    """
+    Return -> a Future that has already resolved to result
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def build_similarities(arrays, attribute):
+    """
+    Job computing the Similarities of a school from the arrays of its
+        RatingMatrix, as returned by RatingStore.matrix_arrays
+
+    Return -> tuple(mult_sum, rss, overlap)
+    """
+    similarities = Similarities(RatingMatrix.from_arrays(*arrays), attribute)
+    size = similarities.size
+    return similarities.mult_sum[:size, :size], similarities.rss[:size, :size], similarities.overlap[:size, :size]
+
+
+def build_item_similarities(arrays, attribute):
+    """
+    Job computing the ItemSimilarities of a school from the arrays of its
+        RatingMatrix, as returned by RatingStore.matrix_arrays
+    """
+    return ItemSimilarities(RatingMatrix.from_arrays(*arrays), attribute)
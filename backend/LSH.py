@@ -0,0 +1,122 @@
+"""
+A locality sensitive hash index of the users at a school
+"""
+
+import numpy
+
+_PRIME = 2 ** 31 - 1
+_MASK = 2 ** 62 - 1
+
+
+class MinHashIndex(object):
+    """
+    An approximate nearest neighbour index over the users of a school, for
+    schools too large to keep the similarity of every pair of users.
+
+    A user's similarity to another is only taken over the courses both rated,
+    so a good neighbour is first of all someone who rated many of the same
+    courses.  The index therefore hashes the set of courses each user rated:
+    under a random ordering of the courses, two users' first rated courses are
+    the same with probability equal to the Jaccard similarity of their sets.
+    Each of several tables buckets users by the first course under a few such
+    orderings, and the users sharing a bucket with someone in any table are a
+    small set of likely neighbours to score exactly.  More hashes per table make
+    buckets smaller and lookups faster, more tables make a true neighbour less
+    likely to be missed.
+
+    Only a user's own hashes depend on their ratings, so a rating change rehashes
+    that one user.  Users without a value for the attribute are left out.
+
+    instance data:
+        attribute -- the attribute of the ratings that is indexed
+        hashes    -- the number of min hashes per table
+        tables    -- the number of tables
+        codes     -- a (users x tables) array of the bucket of every user in
+                     every table, -1 for users who aren't indexed
+        buckets   -- one map(code->set(row)) per table
+    """
+
+    def __init__(self, matrix, attribute, hashes=1, tables=16, seed=0):
+        """
+        Hashes every user of a RatingMatrix
+
+        Arguments:
+            matrix    -> the RatingMatrix of the school
+            attribute -> one of RatingMatrix.attributes
+            hashes    -> the number of min hashes per table
+            tables    -> the number of tables
+            seed      -> the seed the orderings of the courses are drawn from
+        """
+        self.attribute = attribute
+        self.hashes = hashes
+        self.tables = tables
+        random = numpy.random.RandomState(seed)
+        # each ordering ranks course c at (a * c + b) mod _PRIME
+        self._a = random.randint(1, _PRIME, tables * hashes).astype(numpy.int64)
+        self._b = random.randint(0, _PRIME, tables * hashes).astype(numpy.int64)
+
+        rated = matrix.rated(attribute)
+        present = numpy.flatnonzero(numpy.diff(rated.indptr))
+        minimums = numpy.zeros((len(present), tables * hashes), dtype=numpy.int64)
+        for column in range(tables * hashes):
+            ranks = (self._a[column] * rated.indices + self._b[column]) % _PRIME
+            minimums[:, column] = numpy.minimum.reduceat(ranks, rated.indptr[present])
+        self.codes = -numpy.ones((matrix.shape[0], tables), dtype=numpy.int64)
+        self.codes[present] = self._codes(minimums)
+        self.buckets = [{} for table in range(tables)]
+        for user in present:
+            self._add(user)
+
+    def candidates(self, user):
+        """
+        The users that share a bucket with a user in any table
+
+        Arguments:
+            user -> the row of the user
+
+        Return -> a sorted array of rows, never including the user themselves
+        """
+        if user >= len(self.codes) or self.codes[user, 0] < 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        found = set()
+        for table, code in enumerate(self.codes[user]):
+            found.update(self.buckets[table][int(code)])
+        found.discard(user)
+        return numpy.array(sorted(found), dtype=numpy.int64)
+
+    def changed(self, matrix, user):
+        """
+        Rehashes the user in the given row after one of their ratings changed
+        """
+        if user >= len(self.codes):
+            self.codes = numpy.vstack((self.codes, -numpy.ones((user + 1 - len(self.codes), self.tables), dtype=numpy.int64)))
+        self._remove(user)
+        columns = matrix.row(self.attribute, user)[0]
+        if len(columns):
+            ranks = (numpy.outer(columns, self._a) + self._b) % _PRIME
+            self.codes[user] = self._codes(ranks.min(axis=0).reshape(1, -1))[0]
+            self._add(user)
+        else:
+            self.codes[user] = -1
+
+    def _codes(self, minimums):
+        """
+        Combines the min hashes of each table into one bucket code per user
+        """
+        minimums = minimums.reshape(len(minimums), self.tables, self.hashes)
+        codes = minimums[:, :, 0].copy()
+        for position in range(1, self.hashes):
+            codes = codes * _PRIME + minimums[:, :, position]
+        return codes & _MASK
+
+    def _add(self, user):
+        for table, code in enumerate(self.codes[user]):
+            self.buckets[table].setdefault(int(code), set()).add(user)
+
+    def _remove(self, user):
+        for table, code in enumerate(self.codes[user]):
+            bucket = self.buckets[table].get(int(code))
+            if bucket is not None:
+                bucket.discard(user)
+                if not bucket:
+                    del self.buckets[table][int(code)]
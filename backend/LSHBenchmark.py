@@ -0,0 +1,85 @@
+"""
+Benchmarks the approximate neighbour search of MinHashIndex against
+exactly scoring every user at the school
+
+    python3 -m backend.LSHBenchmark [users] [courses] [ratings per user]
+
+Users are generated in groups that take and like similar courses, so that they
+have real neighbours to find.  For a sample of users it reports the recall of
+their k nearest neighbours sharing at least min_overlap courses with them, and
+the mean time taken to find them, for the exact search and for a few settings
+of the index.
+"""
+
+from sys import argv
+import time
+import numpy
+from .RatingMatrix import RatingMatrix
+from .LSH import MinHashIndex
+
+
+def generate(users, courses, per_user, groups=50, seed=0):
+    """
+    Generates ratings for a school, each user taking most of their courses from
+        those of their group, as students of one major do
+
+    Return -> a RatingMatrix of (users x courses) with per_user ratings per user
+    """
+    random = numpy.random.RandomState(seed)
+    tastes = random.uniform(1, 5, (groups, courses))
+    pools = numpy.array_split(random.permutation(courses), groups)
+    rows = []
+    for user in range(users):
+        group = random.randint(groups)
+        taste = tastes[group]
+        # a group's pool has courses // groups courses, which can be fewer than a user takes from it
+        taken = set(random.choice(pools[group], min(len(pools[group]), per_user * 3 // 4), replace=False))
+        while len(taken) < min(per_user, courses):
+            taken.add(random.randint(courses))
+        for course in taken:
+            rating = int(numpy.clip(numpy.round(taste[course] + random.normal(0, 0.5)), 1, 5))
+            rows.append((user, course, rating, None, None))
+    return RatingMatrix(rows)
+
+
+def nearest(matrix, user, others, k, min_overlap):
+    """
+    The k users most similar to a user out of others, as Filter picks neighbours
+    """
+    similarities, overlap = matrix.cosine("rating", user, others)
+    similarities[overlap < min_overlap] = 0
+    order = numpy.argsort(-similarities, kind="mergesort")[:k]
+    return set(others[order[similarities[order] > 0]])
+
+
+def benchmark(users=20000, courses=2000, per_user=20, k=20, min_overlap=3, queries=200, settings=((1, 8), (1, 16), (2, 32), (2, 64))):
+    """
+    Prints the recall and latency of each (hashes, tables) setting
+    """
+    matrix = generate(users, courses, per_user)
+    sample = numpy.random.RandomState(1).choice(users, queries, replace=False)
+
+    started = time.perf_counter()
+    truth = {user: nearest(matrix, user, numpy.delete(numpy.arange(users), user), k, min_overlap) for user in sample}
+    elapsed = time.perf_counter() - started
+    print("{} users, {} courses, {} ratings each, recall of the {} nearest sharing {} courses".format(users, courses, per_user, k, min_overlap))
+    print("exact:                {:8.3f}ms per query".format(1000 * elapsed / queries))
+
+    for hashes, tables in settings:
+        started = time.perf_counter()
+        index = MinHashIndex(matrix, "rating", hashes, tables)
+        built = time.perf_counter() - started
+
+        recall = candidates = 0
+        started = time.perf_counter()
+        for user in sample:
+            others = index.candidates(user)
+            recall += len(nearest(matrix, user, others, k, min_overlap) & truth[user]) / float(max(len(truth[user]), 1))
+            candidates += len(others)
+        elapsed = time.perf_counter() - started
+        print("hashes={} tables={:2}: {:8.3f}ms per query, recall {:.3f}, {:6.0f} candidates, built in {:.2f}s".format(
+            hashes, tables, 1000 * elapsed / queries, recall / queries, candidates / float(queries), built))
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in argv[1:4]])
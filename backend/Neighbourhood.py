@@ -0,0 +1,94 @@
+"""
+The k nearest neighbours of every user at a school
+"""
+
+import heapq
+import numpy
+
+
+class Neighbourhood(object):
+    """
+    The k most similar peers of each user at a school, for one attribute.  Only
+    peers who share at least min_overlap rated courses with a user count, which
+    keeps similarities built from a single shared course out of predictions.
+
+    Each user's neighbours are kept as a min heap of (similarity, row), built the
+    first time they are needed.  When a user's ratings change only their own
+    similarities move, so their heap is dropped and every other heap either
+    takes the user in, updates them in place or, if a member got less similar
+    and might have been overtaken, is dropped to be rebuilt on its next read.
+
+    instance data:
+        similarities -- the Similarities of the school
+        k            -- the number of neighbours kept per user
+        min_overlap  -- the fewest shared courses a neighbour must have
+        heaps        -- map(row->heap of tuple(similarity, row))
+    """
+
+    def __init__(self, similarities, k, min_overlap=1):
+        self.similarities = similarities
+        self.k = k
+        self.min_overlap = min_overlap
+        self.heaps = {}
+
+    def neighbours(self, user):
+        """
+        The neighbours of a user
+
+        Arguments:
+            user -> the row of the user
+
+        Return -> tuple(rows, similarities) of the user's neighbours as arrays
+        """
+        if user not in self.heaps:
+            self.heaps[user] = self._build(user)
+        heap = self.heaps[user]
+        return numpy.array([row for similarity, row in heap], dtype=numpy.int64), numpy.array([similarity for similarity, row in heap])
+
+    def changed(self, user):
+        """
+        Updates the heaps after a rating of the user in the given row changed
+        """
+        self.heaps.pop(user, None)
+        if not self.heaps:
+            return
+        row = self._eligible(user)
+        for other in list(self.heaps):
+            heap = self.heaps[other]
+            similarity = row[other] if other < len(row) else 0
+            for position, (old, member) in enumerate(heap):
+                if member == user:
+                    if similarity >= old:
+                        heap[position] = (similarity, user)
+                        heapq.heapify(heap)
+                    else:
+                        del self.heaps[other]
+                    break
+            else:
+                if similarity <= 0:
+                    continue
+                if len(heap) < self.k:
+                    heapq.heappush(heap, (similarity, user))
+                elif similarity > heap[0][0]:
+                    heapq.heapreplace(heap, (similarity, user))
+
+    def _eligible(self, user):
+        """
+        The user's similarity to every user, 0 for themselves and for anyone
+            sharing fewer than min_overlap courses with them
+        """
+        row = self.similarities.row(user)
+        if user >= self.similarities.size:
+            return row
+        row[self.similarities.overlap[user, :self.similarities.size] < self.min_overlap] = 0
+        row[user] = 0
+        return row
+
+    def _build(self, user):
+        row = self._eligible(user)
+        candidates = numpy.flatnonzero(row > 0)
+        if len(candidates) > self.k:
+            candidates = candidates[numpy.argpartition(-row[candidates], self.k - 1)[:self.k]]
+        heap = [(float(row[other]), int(other)) for other in candidates]
+        heapq.heapify(heap)
+        return heap
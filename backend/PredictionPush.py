@@ -0,0 +1,162 @@
+"""
+Pushing a user's changed predictions to their open pages
+"""
+
+from tornado import gen
+from tornado.escape import json_encode
+from tornado.ioloop import IOLoop
+
+
+class PredictionPush(object):
+    """
+    Keeps the pages a user has open up to date with what the filters predict
+    they would make of the courses they have not taken.  A page subscribes
+    through its ApiSocket and is sent every prediction once; after that,
+    whenever a commit changes the ratings at the user's school, the
+    predictions it can have moved are worked out again and only the ones that
+    did are pushed, as
+
+        {"type": "predictions", "predictions": {course_id: {"rating": ..., "grade": ..., "difficulty": ...}},
+         "removed": [course_ids now rated]}
+
+    A change moves the prediction of its own course for every user at the
+    school, and the weight between the writer and everyone who rated that
+    course, and so a few more of their predictions, see
+    Filter.changed_courses.  So every subscriber at the school is pushed to,
+    but only the courses the change can have moved are worked out again,
+    rather than every prediction of every subscriber.  Changes committed
+    while a user's predictions are being worked out are queued and folded
+    into one more pass once it finishes, so a burst of writes costs at most
+    two.
+
+    instance data:
+        filters     -- the rating, grade and difficulty filters, as given to
+                       the handlers
+        subscribers -- map(user_id->map(socket->the predictions last sent to
+                       it, map(course_id->tuple(rating, grade, difficulty))))
+        schools     -- map(user_id->school_id) of the subscribed users
+        running     -- the user_ids whose predictions are being worked out
+        waiting     -- map(user_id->list of the RatingChanges at their school
+                       not yet worked into their predictions)
+    """
+
+    attributes = ("rating", "grade", "difficulty")
+
+    def __init__(self, table, filters):
+        """
+        Arguments:
+            table   -> the Database, whose rating changes trigger the pushes
+            filters -> the object holding the rating, grade and difficulty
+                       filters
+        """
+        self.filters = filters
+        self.subscribers = {}
+        self.schools = {}
+        self.running = set()
+        self.waiting = {}
+        table.add_listener(self.changed)
+
+    @gen.coroutine
+    def predictions(self, user_id, changes=None):
+        """
+        Arguments:
+            user_id -> the user whose predictions are worked out
+            changes -> the RatingChanges to work out the moved predictions of,
+                       None for every prediction
+
+        Return -> a Future of map(course_id->tuple(rating, grade, difficulty))
+                  of the courses worked out, None where an attribute can't be
+                  predicted, to the hundredth so that only changes a page
+                  could show are pushed
+        """
+        if changes is None:
+            predicted = yield [getattr(self.filters, attribute).predict_async(user_id) for attribute in self.attributes]
+        else:
+            predicted = yield [getattr(self.filters, attribute).changed_predictions_async(user_id, changes) for attribute in self.attributes]
+        predictions = {}
+        for index, values in enumerate(predicted):
+            for course_id, value in values.items():
+                predictions.setdefault(course_id, [None] * len(self.attributes))[index] = None if value is None else round(value, 2)
+        raise gen.Return({course_id: tuple(values) for course_id, values in predictions.items()})
+
+    @gen.coroutine
+    def subscribe(self, socket, user_id, school_id):
+        """
+        Starts pushing a user's changed predictions to a socket
+
+        Return -> a Future of the user's current predictions, in the form
+                  they are pushed in
+        """
+        predictions = yield self.predictions(user_id)
+        predictions, message = self.merge({}, predictions)
+        self.subscribers.setdefault(user_id, {})[socket] = predictions
+        self.schools[user_id] = school_id
+        raise gen.Return(message)
+
+    def unsubscribe(self, socket):
+        for user_id in list(self.subscribers):
+            self.subscribers[user_id].pop(socket, None)
+            if not self.subscribers[user_id]:
+                del self.subscribers[user_id]
+                del self.schools[user_id]
+
+    def changed(self, changes):
+        """
+        Listener for Database rating changes, pushes the moved predictions of
+            every subscribed user at the schools the changes were made at
+        """
+        by_school = {}
+        for change in changes:
+            by_school.setdefault(change.school_id, []).append(change)
+        for user_id, school_id in list(self.schools.items()):
+            if school_id not in by_school:
+                continue
+            self.waiting.setdefault(user_id, []).extend(by_school[school_id])
+            if user_id not in self.running:
+                self.running.add(user_id)
+                IOLoop.current().spawn_callback(self.push, user_id)
+
+    @gen.coroutine
+    def push(self, user_id):
+        """
+        Works out the predictions the changes waiting for a user can have moved
+            and sends each of their sockets those that differ from what it was
+            sent last, until no more changes are waiting
+        """
+        try:
+            while self.waiting.get(user_id):
+                changes = self.waiting.pop(user_id)
+                predictions = yield self.predictions(user_id, changes)
+                for socket, sent in list(self.subscribers.get(user_id, {}).items()):
+                    self.subscribers[user_id][socket], message = self.merge(sent, predictions)
+                    # a socket that has closed is unsubscribed by its on_close
+                    if socket.ws_connection is not None and (message["predictions"] or message["removed"]):
+                        socket.write_message(json_encode(message))
+        except Exception as error:
+            print("Couldn't push the predictions of user {}, {!r}".format(user_id, error))
+        finally:
+            self.waiting.pop(user_id, None)
+            self.running.discard(user_id)
+
+    def merge(self, sent, predictions):
+        """
+        Brings what a page was sent up to date with the predictions of some
+            courses, dropping those that can no longer be predicted
+
+        Arguments:
+            sent        -> map(course_id->tuple) the predictions the page has
+            predictions -> map(course_id->tuple) the courses worked out again
+
+        Return -> tuple(the page's predictions afterwards, the message that
+                  brings it there)
+        """
+        merged = dict(sent)
+        moved, removed = {}, []
+        for course_id, values in predictions.items():
+            if all(value is None for value in values):
+                if merged.pop(course_id, None) is not None:
+                    removed.append(course_id)
+            elif merged.get(course_id) != values:
+                merged[course_id] = values
+                moved[course_id] = dict(zip(self.attributes, values))
+        return merged, dict(type="predictions", predictions=moved, removed=sorted(removed))
@@ -0,0 +1,253 @@
+"""
+A compressed sparse row matrix of one school's ratings
+"""
+
+import numpy
+import scipy.sparse
+
+
+class RatingMatrix(object):
+    """
+    The ratings of a school stored in compressed sparse row form, with all three
+    rating attributes side by side.  Memory scales with the number of ratings,
+    not with users x courses.
+
+    instance data:
+        users      -- map(user_id->row)
+        courses    -- map(course_id->column)
+        user_ids   -- array(row->user_id)
+        course_ids -- array(column->course_id)
+        indptr     -- the csr row pointers, row r is stored in [indptr[r], indptr[r+1])
+        indices    -- the csr column of every stored rating
+        values     -- a (ratings x 3) array of the rating, grade and difficulty
+                      of every stored rating, nan where the attribute is None
+    """
+
+    attributes = ("rating", "grade", "difficulty")
+
+    def __init__(self, rows):
+        """
+        Builds the matrix
+
+        Arguments:
+            rows -> (user_id, course_id, rating, grade, difficulty) tuples, as
+                    returned by Database.fetch_school_ratings
+        """
+        self.users = {}
+        self.courses = {}
+        for row in rows:
+            self.users.setdefault(row[0], len(self.users))
+            self.courses.setdefault(row[1], len(self.courses))
+        self.user_ids = numpy.array(sorted(self.users, key=self.users.get), dtype=numpy.int64)
+        self.course_ids = numpy.array(sorted(self.courses, key=self.courses.get), dtype=numpy.int64)
+
+        coords = numpy.array([(self.users[row[0]], self.courses[row[1]]) for row in rows], dtype=numpy.int64).reshape(-1, 2)
+        values = numpy.array([[numpy.nan if value is None else value for value in row[2:]] for row in rows], dtype=float).reshape(-1, 3)
+        order = numpy.lexsort((coords[:, 1], coords[:, 0]))
+
+        self.indices = coords[order, 1]
+        self.values = values[order]
+        self.indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(coords[:, 0], minlength=len(self.users))))).astype(numpy.int64)
+        self._views = {}
+
+    @classmethod
+    def from_arrays(cls, user_ids, course_ids, indptr, indices, values):
+        """
+        Rebuilds a matrix from its arrays, as stored in a snapshot
+        """
+        matrix = cls([])
+        matrix.user_ids = user_ids
+        matrix.course_ids = course_ids
+        matrix.indptr = indptr
+        matrix.indices = indices
+        matrix.values = values
+        matrix.users = {int(user_id): row for row, user_id in enumerate(user_ids)}
+        matrix.courses = {int(course_id): column for column, course_id in enumerate(course_ids)}
+        return matrix
+
+    @property
+    def shape(self):
+        return (len(self.users), len(self.courses))
+
+    def attribute(self, attribute):
+        """
+        The values of one attribute as a scipy csr matrix, ratings where the
+            attribute is None are left out entirely
+
+        Arguments:
+            attribute -> one of RatingMatrix.attributes
+
+        Return -> a (users x courses) scipy.sparse.csr_matrix
+        """
+        return self._view(attribute, "values")
+
+    def rated(self, attribute):
+        """
+        The same structure as attribute(attribute), but with every value set to 1
+        """
+        return self._view(attribute, "rated")
+
+    def squared(self, attribute):
+        """
+        The same structure as attribute(attribute), but with every value squared
+        """
+        return self._view(attribute, "squared")
+
+    def column(self, attribute, course):
+        """
+        The values of one attribute for a single column, read straight from the
+            csr arrays so that it stays cheap while the matrix is being changed
+
+        Arguments:
+            attribute -> one of RatingMatrix.attributes
+            course    -> the column of the course
+
+        Return -> tuple(values, rated), two dense vectors with one entry per row
+        """
+        positions = numpy.flatnonzero(self.indices == course)
+        rows = numpy.searchsorted(self.indptr, positions, side="right") - 1
+        column = self.values[positions, self.attributes.index(attribute)]
+        keep = ~numpy.isnan(column)
+
+        values = numpy.zeros(len(self.users))
+        rated = numpy.zeros(len(self.users), dtype=bool)
+        values[rows[keep]] = column[keep]
+        rated[rows[keep]] = True
+        return values, rated
+
+    def values_at(self, attribute, rows, course):
+        """
+        The values of one attribute for a few rows of a single column, found by
+            searching each row rather than scanning the whole matrix
+
+        Arguments:
+            attribute -> one of RatingMatrix.attributes
+            rows      -> the rows to read
+            course    -> the column of the course
+
+        Return -> tuple(values, rated), two dense vectors with one entry per row given
+        """
+        index = self.attributes.index(attribute)
+        values = numpy.zeros(len(rows))
+        rated = numpy.zeros(len(rows), dtype=bool)
+        for position, row in enumerate(rows):
+            start, end = self.indptr[row], self.indptr[row + 1]
+            found = start + numpy.searchsorted(self.indices[start:end], course)
+            if found < end and self.indices[found] == course and not numpy.isnan(self.values[found, index]):
+                values[position] = self.values[found, index]
+                rated[position] = True
+        return values, rated
+
+    def row(self, attribute, row):
+        """
+        The values of one attribute for a single row
+
+        Return -> tuple(columns, values) of the courses the user gave a value
+        """
+        start, end = self.indptr[row], self.indptr[row + 1]
+        values = self.values[start:end, self.attributes.index(attribute)]
+        keep = ~numpy.isnan(values)
+        return self.indices[start:end][keep], values[keep]
+
+    def cosine(self, attribute, row, rows):
+        """
+        The cosine similarity of one row to a few others over the courses they
+            share, read straight from the csr arrays so that it costs time in
+            the number of ratings of those rows rather than of the whole school
+
+        Arguments:
+            attribute -> one of RatingMatrix.attributes
+            row       -> the row of the user being compared
+            rows      -> the rows of the users they are compared to
+
+        Return -> tuple(similarities, overlap), the similarity to every row given,
+                  0 where there are no shared courses, and the number of courses shared
+        """
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        columns, values = self.row(attribute, row)
+        own = numpy.zeros(len(self.courses))
+        rated = numpy.zeros(len(self.courses), dtype=bool)
+        own[columns] = values
+        rated[columns] = True
+
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        owners = numpy.repeat(numpy.arange(len(rows)), lengths)
+        positions = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + numpy.repeat(starts, lengths)
+        others = self.values[positions, self.attributes.index(attribute)]
+        shared = rated[self.indices[positions]] & ~numpy.isnan(others)
+        owners = owners[shared]
+        mine = own[self.indices[positions][shared]]
+        others = others[shared]
+
+        mult_sum = numpy.bincount(owners, weights=mine * others, minlength=len(rows))
+        bottom = numpy.sqrt(numpy.bincount(owners, weights=mine ** 2, minlength=len(rows)) * numpy.bincount(owners, weights=others ** 2, minlength=len(rows)))
+        overlap = numpy.bincount(owners, minlength=len(rows))
+        return numpy.where(bottom == 0, 0, mult_sum / numpy.where(bottom == 0, 1, bottom)), overlap
+
+    def apply(self, change):
+        """
+        Applies a committed RatingChange to the matrix in place, adding a row or
+            column if the user or course is new to the matrix
+
+        Arguments:
+            change -> a databases.database.RatingChange for this school
+
+        Return -> tuple(row, column, old, new) where old and new are the
+                  (rating, grade, difficulty) the matrix held before and after,
+                  or None where there was no rating
+        """
+        if change.user_id not in self.users:
+            self.users[change.user_id] = len(self.users)
+            self.user_ids = numpy.append(self.user_ids, change.user_id)
+            self.indptr = numpy.append(self.indptr, self.indptr[-1])
+        if change.course_id not in self.courses:
+            self.courses[change.course_id] = len(self.courses)
+            self.course_ids = numpy.append(self.course_ids, change.course_id)
+        row = self.users[change.user_id]
+        column = self.courses[change.course_id]
+
+        start, end = self.indptr[row], self.indptr[row + 1]
+        position = start + numpy.searchsorted(self.indices[start:end], column)
+        exists = position < end and self.indices[position] == column
+        old = self._triple(self.values[position]) if exists else None
+
+        if change.new is None:
+            if exists:
+                self.indices = numpy.delete(self.indices, position)
+                self.values = numpy.delete(self.values, position, axis=0)
+                self.indptr[row + 1:] -= 1
+        else:
+            values = [numpy.nan if value is None else value for value in change.new]
+            if exists:
+                self.values[position] = values
+            else:
+                self.indices = numpy.insert(self.indices, position, column)
+                self.values = numpy.insert(self.values, position, values, axis=0)
+                self.indptr[row + 1:] += 1
+
+        self._views.clear()
+        return row, column, old, None if change.new is None else tuple(change.new)
+
+    def _triple(self, values):
+        return tuple(None if numpy.isnan(value) else float(value) for value in values)
+
+    def _view(self, attribute, kind):
+        """
+        Lazily builds and caches the scipy views of the matrix
+        """
+        if (attribute, kind) not in self._views:
+            if kind == "values":
+                column = self.values[:, self.attributes.index(attribute)]
+                keep = ~numpy.isnan(column)
+                rows = numpy.repeat(numpy.arange(len(self.users)), numpy.diff(self.indptr))
+                indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(rows[keep], minlength=len(self.users)))))
+                view = scipy.sparse.csr_matrix((column[keep], self.indices[keep], indptr), shape=self.shape)
+            elif kind == "rated":
+                values = self.attribute(attribute)
+                view = scipy.sparse.csr_matrix((numpy.ones(values.nnz), values.indices, values.indptr), shape=self.shape)
+            elif kind == "squared":
+                values = self.attribute(attribute)
+                view = scipy.sparse.csr_matrix((values.data ** 2, values.indices, values.indptr), shape=self.shape)
+            self._views[(attribute, kind)] = view
+        return self._views[(attribute, kind)]
@@ -0,0 +1,485 @@
+"""
+A shared, per school store of rating matrices
+"""
+
+import os
+import numpy
+from tornado import gen
+from .RatingMatrix import RatingMatrix
+from .Similarities import Similarities
+from .ItemSimilarities import ItemSimilarities
+from .Neighbourhood import Neighbourhood
+from .LSH import MinHashIndex
+from .Jobs import build_similarities, build_item_similarities, resolved
+from . import Snapshot
+
+
+class RatingStore(object):
+    """
+    Holds one RatingMatrix per school, loaded from the database the first time
+    it is needed and shared by every filter, so that the rating, grade and
+    difficulty filters read the ratings table once between them.
+
+    Alongside the matrices the store keeps the Similarities of every pair of
+    users, per school and attribute, computed the first time they are needed.
+    The store listens for committed rating changes and applies them to both in
+    place, so predictions read precomputed sums instead of rescanning ratings.
+
+    The course to course ItemSimilarities are kept too, but are only rebuilt
+    once item_rebuild ratings of the school have changed since they were built.
+
+    Either can be built in a JobPool instead, off the IOLoop, see
+    similarities_async.  Changes committed while a build runs are logged and
+    replayed onto its result.  Given an AsyncDatabase, the matrices and the
+    schools of users can likewise be loaded by its threads, see matrix_async,
+    with the changes committed while a matrix loads replayed onto it too.
+
+    Given a folder, the store can snapshot what it holds to disk and memory map
+    it back after a restart, as long as the school's ratings have not changed
+    since (see Database.fetch_revision).
+
+    instance data:
+        table          -- the Database the ratings are loaded from
+        folder         -- where snapshots are kept, None to never snapshot
+        adb            -- the AsyncDatabase that loads matrices off the IOLoop, or None
+        matrices       -- map(school_id->RatingMatrix)
+        similarities   -- map(tuple(school_id, attribute)->Similarities)
+        neighbourhoods -- map(tuple(school_id, attribute, k, min_overlap)->Neighbourhood)
+        indexes        -- map(tuple(school_id, attribute, hashes, tables)->MinHashIndex)
+        items          -- map(tuple(school_id, attribute)->ItemSimilarities)
+        item_rebuild   -- the number of rating changes after which ItemSimilarities are rebuilt
+        building       -- map(tuple(school_id, attribute)->list of the Similarities.update
+                          arguments of the changes made since its build job started)
+        building_items -- map(tuple(school_id, attribute)->the number of changes
+                          since its ItemSimilarities build job started)
+        loading        -- map(school_id->tuple(the Future of its load by the
+                          AsyncDatabase, the list of changes committed since))
+        revisions      -- map(school_id->the revision of the ratings the school's data reflects)
+        saved          -- map(school_id->the revision last written to a snapshot)
+        saving         -- whether a save_async is running
+        schools        -- map(user_id->school_id), a cache of which school users attend
+    """
+
+    def __init__(self, table, folder=None, item_rebuild=500, adb=None):
+        self.table = table
+        self.folder = folder
+        self.adb = adb
+        self.matrices = {}
+        self.similarities = {}
+        self.neighbourhoods = {}
+        self.indexes = {}
+        self.items = {}
+        self.item_rebuild = item_rebuild
+        self.building = {}
+        self.building_items = {}
+        self.loading = {}
+        self.revisions = {}
+        self.saved = {}
+        self.saving = False
+        self.schools = {}
+        self.table.add_listener(self.changed)
+
+    def school_of(self, user_id):
+        """
+        Returns the school_id of the school a user attends
+        """
+        if user_id not in self.schools:
+            with self.table.session_scope() as session:
+                self.schools[user_id] = self.table.fetch_user_by_id(session, user_id).school_id
+        return self.schools[user_id]
+
+    def matrix(self, school_id):
+        """
+        Returns the RatingMatrix of a school, loading it if necessary
+        """
+        if school_id not in self.matrices:
+            with self.table.session_scope() as session:
+                self._install(school_id, *self._load(session, school_id))
+        return self.matrices[school_id]
+
+    @gen.coroutine
+    def school_of_async(self, user_id):
+        """
+        school_of, with the user looked up by a thread of the AsyncDatabase
+
+        Return -> a Future of the school_id
+        """
+        if user_id not in self.schools and self.adb is not None:
+            user = yield self.adb.fetch_user_by_id(user_id)
+            self.schools[user_id] = user.school_id
+        raise gen.Return(self.school_of(user_id))
+
+    @gen.coroutine
+    def matrix_async(self, school_id):
+        """
+        matrix, with the ratings or the snapshot read and the matrix built by a
+            thread of the AsyncDatabase.  Every request for a school that is
+            loading waits on the same load.
+
+        Return -> a Future of the RatingMatrix
+        """
+        if school_id not in self.matrices and self.adb is not None:
+            if school_id not in self.loading:
+                self.loading[school_id] = (self.adb.run(self._load, school_id), [])
+            future = self.loading[school_id][0]
+            try:
+                loaded = yield future
+            except Exception:
+                # the next request tries again
+                if self.loading.get(school_id, (None,))[0] is future:
+                    del self.loading[school_id]
+                raise
+            # unless the school was loaded on the IOLoop or dropped while this load ran
+            if school_id not in self.matrices and self.loading.get(school_id, (None,))[0] is future:
+                self._install(school_id, *loaded)
+        raise gen.Return(self.matrix(school_id))
+
+    def matrix_for(self, user_id):
+        """
+        Returns the RatingMatrix of the school a user attends
+        """
+        return self.matrix(self.school_of(user_id))
+
+    @gen.coroutine
+    def matrix_for_async(self, user_id):
+        """
+        matrix_for, with the user and the matrix loaded off the IOLoop
+
+        Return -> a Future of the RatingMatrix
+        """
+        school_id = yield self.school_of_async(user_id)
+        matrix = yield self.matrix_async(school_id)
+        raise gen.Return(matrix)
+
+    def similarities_for(self, school_id, attribute):
+        """
+        Returns the Similarities of a school for an attribute, computing them if
+            necessary
+        """
+        if (school_id, attribute) not in self.similarities:
+            self.similarities[(school_id, attribute)] = Similarities(self.matrix(school_id), attribute)
+        return self.similarities[(school_id, attribute)]
+
+    def neighbourhood_for(self, school_id, attribute, k, min_overlap=1):
+        """
+        Returns the Neighbourhood of a school for an attribute
+        """
+        key = (school_id, attribute, k, min_overlap)
+        if key not in self.neighbourhoods:
+            self.neighbourhoods[key] = Neighbourhood(self.similarities_for(school_id, attribute), k, min_overlap)
+        return self.neighbourhoods[key]
+
+    def index_for(self, school_id, attribute, hashes=1, tables=16):
+        """
+        Returns the MinHashIndex of a school for an attribute, hashing
+            every user if necessary.  Unlike the similarities the index is never
+            snapshotted, it is one sparse product away from the matrix.
+        """
+        key = (school_id, attribute, hashes, tables)
+        if key not in self.indexes:
+            self.indexes[key] = MinHashIndex(self.matrix(school_id), attribute, hashes, tables)
+        return self.indexes[key]
+
+    def item_similarities_for(self, school_id, attribute):
+        """
+        Returns the ItemSimilarities of a school for an attribute, computing them
+            if necessary or if too many ratings have changed since they were,
+            unless new ones are already being built in a JobPool
+        """
+        items = self.items.get((school_id, attribute))
+        if items is None or (items.changes >= self.item_rebuild and (school_id, attribute) not in self.building_items):
+            self.items[(school_id, attribute)] = ItemSimilarities(self.matrix(school_id), attribute)
+        return self.items[(school_id, attribute)]
+
+    def matrix_arrays(self, school_id):
+        """
+        Returns copies of the arrays of a school's RatingMatrix, as taken by
+            RatingMatrix.from_arrays, to send the matrix to a worker process.
+            They are copied because the matrix changes some of them in place,
+            and the pool pickles them in the background.
+        """
+        matrix = self.matrix(school_id)
+        return tuple(numpy.array(array) for array in (matrix.user_ids, matrix.course_ids, matrix.indptr, matrix.indices, matrix.values))
+
+    def similarities_async(self, school_id, attribute, jobs):
+        """
+        Returns the Similarities of a school for an attribute, computing them in
+            a JobPool if necessary
+
+        Return -> a Future of the Similarities
+        """
+        key = (school_id, attribute)
+        if key in self.similarities:
+            return resolved(self.similarities[key])
+        if key not in self.building:
+            self.building[key] = []
+
+        def finished(sums):
+            log = self.building.pop(key, None)
+            if key not in self.similarities:
+                if log is None:
+                    # the school was dropped while the job ran, or outgrew the similarities, so its changes weren't logged
+                    matrix = self.matrices.get(school_id)
+                    if matrix is not None and not Similarities.fits(matrix.shape[0]):
+                        return None
+                    return self.similarities_for(school_id, attribute)
+                similarities = Similarities.from_arrays(*sums)
+                for update in log:
+                    similarities.update(*update)
+                self.similarities[key] = similarities
+            return self.similarities[key]
+        return jobs.submit(("similarities",) + key, build_similarities, finished=finished, arguments=lambda: (self.matrix_arrays(school_id), attribute))
+
+    def item_similarities_async(self, school_id, attribute, jobs):
+        """
+        Returns the ItemSimilarities of a school for an attribute, computing them
+            in a JobPool if necessary.  Once too many ratings have changed, the
+            old similarities keep being returned while new ones are built.
+
+        Return -> a Future of the ItemSimilarities
+        """
+        key = (school_id, attribute)
+        items = self.items.get(key)
+        if items is not None and items.changes < self.item_rebuild:
+            return resolved(items)
+        if key not in self.building_items:
+            self.building_items[key] = 0
+
+        def finished(items):
+            changes = self.building_items.pop(key, None)
+            if changes is None:
+                return self.item_similarities_for(school_id, attribute)
+            items.changes = changes
+            self.items[key] = items
+            return items
+        future = jobs.submit(("items",) + key, build_item_similarities, finished=finished, arguments=lambda: (self.matrix_arrays(school_id), attribute))
+        return future if items is None else resolved(items)
+
+    def invalidate(self, school_id=None):
+        """
+        Drops the matrix and similarities of a school, or of every school if
+            none is given
+        """
+        if school_id is None:
+            self.matrices.clear()
+            self.similarities.clear()
+            self.neighbourhoods.clear()
+            self.indexes.clear()
+            self.items.clear()
+            self.building.clear()
+            self.building_items.clear()
+            self.loading.clear()
+            self.revisions.clear()
+        else:
+            self.matrices.pop(school_id, None)
+            self.loading.pop(school_id, None)
+            self.revisions.pop(school_id, None)
+            for attribute in RatingMatrix.attributes:
+                self.similarities.pop((school_id, attribute), None)
+                self.items.pop((school_id, attribute), None)
+                self.building.pop((school_id, attribute), None)
+                self.building_items.pop((school_id, attribute), None)
+            for key in [key for key in self.neighbourhoods if key[0] == school_id]:
+                del self.neighbourhoods[key]
+            for key in [key for key in self.indexes if key[0] == school_id]:
+                del self.indexes[key]
+
+    def changed(self, changes):
+        """
+        Listener for Database rating changes, applies each change to the loaded
+            matrix of its school and to the school's similarities
+        """
+        for change in changes:
+            self.schools[change.user_id] = change.school_id
+            matrix = self.matrices.get(change.school_id)
+            if matrix is None and change.school_id in self.loading:
+                self.loading[change.school_id][1].append(change)
+            # a school loaded after the change committed already reflects it
+            if matrix is None or change.revision <= self.revisions[change.school_id]:
+                continue
+            user, course, old, new = matrix.apply(change)
+            if not Similarities.fits(matrix.shape[0]):
+                self._outgrown(change.school_id)
+            for index, attribute in enumerate(matrix.attributes):
+                key = (change.school_id, attribute)
+                if key in self.similarities or key in self.building:
+                    values, rated = matrix.column(attribute, course)
+                    update = (user, values, rated, old and old[index], new and new[index])
+                    if key in self.similarities:
+                        self.similarities[key].update(*update)
+                    else:
+                        self.building[key].append(update)
+                if key in self.items:
+                    self.items[key].changes += 1
+                if key in self.building_items:
+                    self.building_items[key] += 1
+            for key, neighbourhood in self.neighbourhoods.items():
+                if key[0] == change.school_id:
+                    neighbourhood.changed(user)
+            for key, lsh in self.indexes.items():
+                if key[0] == change.school_id:
+                    lsh.changed(matrix, user)
+        for school_id, revision in {(change.school_id, change.revision) for change in changes}:
+            if school_id in self.revisions:
+                self.revisions[school_id] = max(self.revisions[school_id], revision)
+
+    def _outgrown(self, school_id):
+        """
+        Drops the similarities of a school that has grown past
+            Similarities.max_users students, and the neighbourhoods read from
+            them, the filters find its neighbours approximately from then on
+        """
+        for attribute in RatingMatrix.attributes:
+            self.similarities.pop((school_id, attribute), None)
+            self.building.pop((school_id, attribute), None)
+        for key in [key for key in self.neighbourhoods if key[0] == school_id]:
+            del self.neighbourhoods[key]
+
+    def save(self):
+        """
+        Snapshots every loaded school whose data reflects the current ratings.
+            A school whose ratings were changed by another process is dropped
+            instead, to be reloaded on its next read.
+
+        Return -> the number of snapshots written
+        """
+        if self.folder is None:
+            return 0
+        snapshots = self._unsaved(self._fetch_revisions(list(self.matrices)))
+        self._write(snapshots)
+        for school_id, revision, arrays in snapshots:
+            self.saved[school_id] = revision
+        return len(snapshots)
+
+    @gen.coroutine
+    def save_async(self, executor):
+        """
+        save, with the revisions read and the snapshots written by a thread of
+            executor, so that the IOLoop only copies the arrays.  The copies
+            are what is written, as the listeners keep changing the arrays
+            themselves in place on the IOLoop while the thread writes.  Does
+            nothing while another save_async is running.
+
+        Return -> a Future of the number of snapshots written
+        """
+        if self.folder is None or self.saving:
+            raise gen.Return(0)
+        self.saving = True
+        try:
+            asked = dict(self.revisions)
+            current = yield executor.submit(self._fetch_revisions, list(asked))
+            # a school changed while its revision was read is newer than it, and is saved next time
+            current = {school_id: revision for school_id, revision in current.items() if self.revisions.get(school_id) == asked[school_id]}
+            snapshots = self._unsaved(current, copy=True)
+            yield executor.submit(self._write, snapshots)
+            for school_id, revision, arrays in snapshots:
+                self.saved[school_id] = revision
+        finally:
+            self.saving = False
+        raise gen.Return(len(snapshots))
+
+    def _fetch_revisions(self, school_ids):
+        """
+        Return -> map(school_id->its revision in the database)
+        """
+        with self.table.session_scope() as session:
+            return {school_id: self.table.fetch_revision(session, school_id) for school_id in school_ids}
+
+    def _unsaved(self, current, copy=False):
+        """
+        Drops the loaded schools whose ratings were changed by another process,
+            to be reloaded on their next read, and gathers the arrays of those
+            that changed since they were last saved
+
+        Arguments:
+            current -> map(school_id->its revision in the database)
+            copy    -> whether to copy the arrays, rather than take views of them
+
+        Return -> a list of tuple(school_id, revision, map(name->array))
+        """
+        snapshots = []
+        for school_id, revision in current.items():
+            if school_id not in self.matrices:
+                continue
+            if self.revisions[school_id] != revision:
+                self.invalidate(school_id)
+            elif self.saved.get(school_id) != revision:
+                arrays = self._arrays(school_id)
+                if copy:
+                    arrays = {name: numpy.array(array) for name, array in arrays.items()}
+                snapshots.append((school_id, revision, arrays))
+        return snapshots
+
+    def _write(self, snapshots):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        for school_id, revision, arrays in snapshots:
+            Snapshot.write_snapshot(self._path(school_id), school_id, revision, arrays)
+
+    def _path(self, school_id):
+        return os.path.join(self.folder, "school-{}.snapshot".format(school_id))
+
+    def _arrays(self, school_id):
+        """
+        The arrays of a school that make up its snapshot
+        """
+        matrix = self.matrices[school_id]
+        arrays = dict(user_ids=matrix.user_ids, course_ids=matrix.course_ids, indptr=matrix.indptr, indices=matrix.indices, values=matrix.values)
+        for attribute in matrix.attributes:
+            similarities = self.similarities.get((school_id, attribute))
+            if similarities is not None:
+                arrays["mult_sum-" + attribute] = similarities.mult_sum[:similarities.size, :similarities.size]
+                arrays["rss-" + attribute] = similarities.rss[:similarities.size, :similarities.size]
+                arrays["overlap-" + attribute] = similarities.overlap[:similarities.size, :similarities.size]
+            items = self.items.get((school_id, attribute))
+            if items is not None:
+                arrays["items-" + attribute] = items.similarity
+        return arrays
+
+    def _load(self, session, school_id):
+        """
+        Reads the revision of a school's ratings, and its snapshot if there is
+            one taken at that revision, or else the ratings themselves.  Only
+            reads, so that it can run on a thread of the AsyncDatabase.
+
+        Return -> tuple(the revision, the RatingMatrix, the snapshot's arrays or None)
+        """
+        revision = self.table.fetch_revision(session, school_id)
+        arrays = self._restore(school_id, revision)
+        if arrays is None:
+            return revision, RatingMatrix(self.table.fetch_school_ratings(session, school_id)), None
+        return revision, RatingMatrix.from_arrays(arrays["user_ids"], arrays["course_ids"], arrays["indptr"], arrays["indices"], arrays["values"]), arrays
+
+    def _install(self, school_id, revision, matrix, arrays):
+        """
+        Makes what _load read the school's data, and replays onto it the
+            changes committed while it loaded
+        """
+        self.matrices[school_id] = matrix
+        self.revisions[school_id] = revision
+        if arrays is not None:
+            for attribute in RatingMatrix.attributes:
+                if "mult_sum-" + attribute in arrays:
+                    self.similarities[(school_id, attribute)] = Similarities.from_arrays(arrays["mult_sum-" + attribute], arrays["rss-" + attribute], arrays["overlap-" + attribute])
+                if "items-" + attribute in arrays:
+                    self.items[(school_id, attribute)] = ItemSimilarities.from_arrays(arrays["items-" + attribute])
+            self.saved[school_id] = revision
+        future, changes = self.loading.pop(school_id, (None, []))
+        self.changed(changes)
+
+    def _restore(self, school_id, revision):
+        """
+        Memory maps the snapshot of a school, if there is one taken at the given
+            revision of its ratings
+
+        Return -> map(name->array) of the snapshot, or None if there is none
+        """
+        if self.folder is None or not os.path.exists(self._path(school_id)):
+            return None
+        try:
+            header = Snapshot.read_header(self._path(school_id))
+            if header["school_id"] != school_id or header["revision"] != revision:
+                return None
+            return Snapshot.read_snapshot(self._path(school_id), header)
+        except Snapshot.SnapshotError:
+            return None
@@ -0,0 +1,202 @@
+"""
+Sharding the collaborative filters across worker processes by school
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from tornado import gen
+from .Filter import Filter
+from .ItemFilter import ItemFilter
+from .Jobs import JobPool
+from .RatingStore import RatingStore
+
+# the state of a shard's process, built the first time the process is used
+_shard = {"store": None, "filters": {}}
+
+
+class ShardRouter(object):
+    """
+    Spreads the schools over a number of shards, each a single worker process
+    holding its own RatingStore with the matrices and similarities of the
+    schools assigned to it.  The students of one school are only ever compared
+    with each other, so a school's predictions can be made entirely within its
+    shard, and a machine with n cores can serve n schools at once.
+
+    The router keeps the routing table of which shard owns each school, placing
+    a school on the shard with the fewest schools the first time it is used,
+    and looks up which school a user attends through the web tier's
+    RatingStore, off the IOLoop.  It listens for committed rating changes and
+    forwards them to the shard of their school.  A shard runs its calls in the
+    order they are sent, so a prediction sent after a change sees it.
+
+    instance data:
+        table   -- the Database of the web tier
+        store   -- the RatingStore of the web tier, whose school_of_async is used
+        context -- tuple(the Database class, the snapshot folder or None), what
+                   a shard needs to build its RatingStore
+        shards  -- one JobPool of a single process per shard
+        routes  -- map(school_id->the index of the shard that owns it)
+    """
+
+    def __init__(self, table, store, shards, folder=None):
+        """
+        Arguments:
+            table  -> the Database, each shard makes its own instance of its
+                      class, connected to the same DATABASE_URL
+            store  -> the RatingStore of the web tier
+            shards -> the number of shard processes
+            folder -> where the shards keep their snapshots
+        """
+        self.table = table
+        self.store = store
+        self.context = (type(table), folder)
+        self.shards = [JobPool(executor=ProcessPoolExecutor(1)) for shard in range(shards)]
+        # the processes are forked now, before the AsyncDatabase's threads are busy: a fork copies
+        # the locks other threads hold, and the shard would wait on them forever
+        for shard in self.shards:
+            shard.executor.submit(int)
+        self.routes = {}
+        self.table.add_listener(self.changed)
+
+    def shard_of(self, school_id):
+        """
+        Returns the index of the shard that owns a school, assigning it one if
+            it has none yet
+        """
+        if school_id not in self.routes:
+            load = [0] * len(self.shards)
+            for shard in self.routes.values():
+                load[shard] += 1
+            self.routes[school_id] = load.index(min(load))
+        return self.routes[school_id]
+
+    @gen.coroutine
+    def call(self, user_id, function, *args):
+        """
+        Runs function(context, *args) in the shard of the user's school
+
+        Return -> a tornado Future of the result
+        """
+        school_id = yield self.store.school_of_async(user_id)
+        result = yield self.shards[self.shard_of(school_id)].submit(None, function, self.context, *args)
+        raise gen.Return(result)
+
+    def changed(self, changes):
+        """
+        Listener for Database rating changes, forwards them to the shards of
+            the schools they were made at
+        """
+        by_school = {}
+        for change in changes:
+            by_school.setdefault(change.school_id, []).append(change)
+        for school_id, school_changes in by_school.items():
+            if school_id in self.routes:
+                self.shards[self.routes[school_id]].submit(None, _changed, self.context, school_changes)
+
+    @gen.coroutine
+    def save(self):
+        """
+        Has every shard snapshot its schools
+
+        Return -> a Future of the number of snapshots written
+        """
+        saved = yield [shard.submit(None, _save, self.context) for shard in self.shards]
+        raise gen.Return(sum(saved))
+
+    def shutdown(self, wait=True):
+        """
+        Stops the shards, by default once they have finished what they were sent
+        """
+        for shard in self.shards:
+            shard.executor.shutdown(wait=wait)
+
+
+class ShardedFilter(object):
+    """
+    A Filter over a single attribute of the ratings table that runs in the
+    shard of each user's school, with the _async interface of Filter.  Given
+    engine="item" it is an ItemFilter instead.
+    """
+    def __init__(self, router, rating, **options):
+        """
+        Arguments:
+            router  -> the ShardRouter
+            rating  -> the attribute to filter on
+            options -> passed on to the Filter in each shard
+        """
+        self.router = router
+        self.rating = rating
+        self.options = tuple(sorted(options.items()))
+
+    def calculated_rating_async(self, user_id, course_id):
+        """
+        Return -> a Future of Filter.calculated_rating, computed in the user's shard
+        """
+        return self.router.call(user_id, _calculated_rating, self.rating, self.options, user_id, course_id)
+
+    def recommend_async(self, user_id, n=10, attribute=None):
+        """
+        Return -> a Future of Filter.recommend, computed in the user's shard
+        """
+        return self.router.call(user_id, _recommend, self.rating, self.options, user_id, n, attribute)
+
+    def predict_async(self, user_id, course_ids=None, attribute=None):
+        """
+        Return -> a Future of Filter.predict, computed in the user's shard
+        """
+        return self.router.call(user_id, _predict, self.rating, self.options, user_id, course_ids, attribute)
+
+    def changed_predictions_async(self, user_id, changes):
+        """
+        Return -> a Future of Filter.changed_predictions, computed in the user's
+                  shard, which has been sent the changes before this call
+        """
+        return self.router.call(user_id, _changed_predictions, self.rating, self.options, user_id, changes)
+
+
+# the functions below run inside the shard processes
+
+def _store(context):
+    """
+    Returns the RatingStore of this shard, connecting to the database the first
+        time it is needed
+    """
+    if _shard["store"] is None:
+        database, folder = context
+        _shard["store"] = RatingStore(database(), folder)
+    return _shard["store"]
+
+
+def _filter(context, rating, options):
+    key = (rating, options)
+    if key not in _shard["filters"]:
+        store = _store(context)
+        options = dict(options)
+        engine = ItemFilter if options.pop("engine", "user") == "item" else Filter
+        _shard["filters"][key] = engine(store.table, rating, store, **options)
+    return _shard["filters"][key]
+
+
+def _calculated_rating(context, rating, options, user_id, course_id):
+    return _filter(context, rating, options).calculated_rating(user_id, course_id)
+
+
+def _recommend(context, rating, options, user_id, n, attribute):
+    return _filter(context, rating, options).recommend(user_id, n, attribute)
+
+
+def _predict(context, rating, options, user_id, course_ids, attribute):
+    return _filter(context, rating, options).predict(user_id, course_ids, attribute)
+
+
+def _changed_predictions(context, rating, options, user_id, changes):
+    return _filter(context, rating, options).changed_predictions(user_id, changes)
+
+
+def _changed(context, changes):
+    # changes committed by the web tier don't pass through this process's
+    # Database, so they are applied to the store directly
+    _store(context).changed(changes)
+
+
+def _save(context):
+    return _store(context).save()
@@ -0,0 +1,148 @@
+"""
+Precomputed similarity sums for every pair of users at a school
+"""
+
+import numpy
+
+
+class Similarities(object):
+    """
+    The sums behind the cosine similarity of every pair of users at a school for
+    one rating attribute, kept up to date as ratings change.
+
+    The similarity of users u and o is taken over the courses both have rated,
+    so it is built from:
+        multSum(u, o) = sum(r[u][i] * r[o][i] for shared items i)
+        rss(u, o)     = sum(r[u][i] ** 2 for shared items i)
+    giving similarity(u, o) = multSum(u, o) / sqrt(rss(u, o) * rss(o, u)).
+    A single rating change only touches row and column u of both arrays, so it
+    is applied in O(users) rather than recomputing everything.
+
+    All values are sums of products of integer ratings, so they are stored as
+    float32 without losing any precision.
+
+    The three arrays are dense, 12 bytes for every pair of users, so they are
+    capped at max_users users: at 2048 that is 48MiB per attribute, or 144MiB
+    for a school's three.  A school with more students is too large to keep
+    every pair, and the filter finds its neighbours approximately instead, see
+    Filter.  The arrays grow by a quarter at a time, so the spare capacity
+    costs at most about half as much again, and growing briefly holds the old
+    arrays alongside the new.
+
+    instance data:
+        size     -- the number of users, the arrays may have spare capacity
+        mult_sum -- multSum(u, o) for every pair of rows
+        rss      -- rss(u, o) for every pair of rows, this is not symmetric
+        overlap  -- the number of courses shared by every pair of rows
+    """
+
+    max_users = 2048
+
+    def __init__(self, matrix, attribute):
+        """
+        Computes the sums for every pair of users in a RatingMatrix
+
+        Arguments:
+            matrix    -> the RatingMatrix of the school, with at most max_users rows
+            attribute -> one of RatingMatrix.attributes
+        """
+        values = matrix.attribute(attribute)
+        rated = matrix.rated(attribute)
+        squared = matrix.squared(attribute)
+
+        self.size = 0
+        self.mult_sum = numpy.zeros((0, 0), dtype=numpy.float32)
+        self.rss = numpy.zeros((0, 0), dtype=numpy.float32)
+        self.overlap = numpy.zeros((0, 0), dtype=numpy.float32)
+        self._reserve(matrix.shape[0])
+        self.mult_sum[:self.size, :self.size] = values.dot(values.T).toarray()
+        self.rss[:self.size, :self.size] = squared.dot(rated.T).toarray()
+        self.overlap[:self.size, :self.size] = rated.dot(rated.T).toarray()
+
+    @classmethod
+    def fits(cls, users):
+        """
+        Return -> whether the sums of a school with the given number of users
+                  are kept, see max_users
+        """
+        return users <= cls.max_users
+
+    @classmethod
+    def from_arrays(cls, mult_sum, rss, overlap):
+        """
+        Rebuilds the sums from their arrays, as stored in a snapshot
+        """
+        similarities = cls.__new__(cls)
+        similarities.size = len(mult_sum)
+        similarities.mult_sum = mult_sum
+        similarities.rss = rss
+        similarities.overlap = overlap
+        return similarities
+
+    def row(self, user):
+        """
+        The similarity of a user to every user at the school
+
+        Arguments:
+            user -> the row of the user
+
+        Return -> a dense vector of similarities, 0 for users with no shared courses
+        """
+        if user >= self.size:
+            return numpy.zeros(self.size)
+        mult_sum = self.mult_sum[user, :self.size].astype(float)
+        bottom = numpy.sqrt(self.rss[user, :self.size].astype(float) * self.rss[:self.size, user])
+        return numpy.where(bottom == 0, 0, mult_sum / numpy.where(bottom == 0, 1, bottom))
+
+    def update(self, user, values, rated, old, new):
+        """
+        Applies a change to one rating of a user
+
+        Arguments:
+            user   -> the row of the user whose rating changed
+            values -> the values every user gave the course, as returned by
+                      RatingMatrix.column
+            rated  -> which users rated the course
+            old    -> the user's old value for the course, None if there was none
+            new    -> the user's new value for the course, None if there is none
+        """
+        self._reserve(len(values))
+        values = numpy.array(values, dtype=float)
+        rated = numpy.array(rated, dtype=float)
+        # the user's own entry is handled separately, on the diagonal
+        values[user] = 0
+        rated[user] = 0
+
+        old_value = 0 if old is None else old
+        new_value = 0 if new is None else new
+        squares = new_value ** 2 - old_value ** 2
+        added = (new is not None) - (old is not None)
+        size = self.size
+
+        self.mult_sum[user, :size] += (new_value - old_value) * values
+        self.mult_sum[:size, user] += (new_value - old_value) * values
+        self.rss[user, :size] += squares * rated
+        self.rss[:size, user] += added * values ** 2
+        self.overlap[user, :size] += added * rated
+        self.overlap[:size, user] += added * rated
+        self.mult_sum[user, user] += squares
+        self.rss[user, user] += squares
+        self.overlap[user, user] += added
+
+    def _reserve(self, size):
+        """
+        Makes room for the given number of users, growing the capacity of the
+            arrays by a quarter when they run out so that new users are cheap
+            to add, up to max_users
+
+        Raises ValueError past max_users
+        """
+        if not self.fits(size):
+            raise ValueError("{} users is more than the {} whose similarities are kept".format(size, self.max_users))
+        if size > len(self.mult_sum):
+            capacity = min(max(size, len(self.mult_sum) + len(self.mult_sum) // 4, 16), self.max_users)
+            for name in ("mult_sum", "rss", "overlap"):
+                grown = numpy.zeros((capacity, capacity), dtype=numpy.float32)
+                grown[:self.size, :self.size] = getattr(self, name)[:self.size, :self.size]
+                setattr(self, name, grown)
+        self.size = max(self.size, size)
@@ -0,0 +1,115 @@
+"""
+Reading and writing snapshots of a school's rating matrix and similarities
+
+A snapshot is a single file laid out as:
+    MAGIC, then a little endian uint16 format version and uint32 header length
+    a json header naming the school, the revision of its ratings the snapshot
+        was taken at, and the dtype, shape and offset of every array
+    the raw arrays, each aligned to ALIGNMENT bytes
+
+so that the arrays can be memory mapped straight out of the file on startup
+rather than being read and parsed.
+"""
+
+import json
+import os
+import struct
+import tempfile
+import numpy
+
+MAGIC = b"CLASSRANK"
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+_PREFIX = struct.Struct("<HI")
+
+
+class SnapshotError(Exception):
+    """
+    Exception raised when a snapshot file is unreadable or of another format
+    """
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "Snapshot {} can't be read: {}".format(self.path, self.reason)
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path, school_id, revision, arrays):
+    """
+    Writes a snapshot, atomically replacing any existing file at path
+
+    Arguments:
+        path      -> the file to write
+        school_id -> the school the arrays belong to
+        revision  -> the revision of the school's ratings the arrays reflect
+        arrays    -> map(name->numpy array)
+    """
+    entries = []
+    offset = 0
+    for name in sorted(arrays):
+        array = numpy.ascontiguousarray(arrays[name])
+        entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({"school_id": school_id, "revision": revision, "arrays": entries}).encode("utf-8")
+    start = _aligned(len(MAGIC) + _PREFIX.size + len(header))
+
+    # every writer has a temporary file of its own, as the shard processes and the server can save the same school
+    descriptor, temporary = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(descriptor, "wb") as snapshot:
+            snapshot.write(MAGIC + _PREFIX.pack(FORMAT_VERSION, len(header)) + header)
+            for entry in entries:
+                snapshot.seek(start + entry["offset"])
+                snapshot.write(numpy.ascontiguousarray(arrays[entry["name"]]).tobytes())
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def read_header(path):
+    """
+    Reads the header of a snapshot without touching its arrays
+
+    Return -> the header as a dict, with the offset of the array data added as "start"
+    """
+    with open(path, "rb") as snapshot:
+        prefix = snapshot.read(len(MAGIC) + _PREFIX.size)
+        if len(prefix) < len(MAGIC) + _PREFIX.size or not prefix.startswith(MAGIC):
+            raise SnapshotError(path, "not a snapshot")
+        version, length = _PREFIX.unpack(prefix[len(MAGIC):])
+        if version != FORMAT_VERSION:
+            raise SnapshotError(path, "format version {} is not {}".format(version, FORMAT_VERSION))
+        try:
+            header = json.loads(snapshot.read(length).decode("utf-8"))
+        except ValueError:
+            raise SnapshotError(path, "corrupt header")
+    header["start"] = _aligned(len(MAGIC) + _PREFIX.size + length)
+    return header
+
+
+def read_snapshot(path, header=None):
+    """
+    Memory maps the arrays of a snapshot.  The maps are copy on write, so the
+        arrays can be changed in place without the file changing underneath.
+
+    Return -> map(name->numpy array)
+    """
+    header = header or read_header(path)
+    size = os.path.getsize(path)
+    arrays = {}
+    for entry in header["arrays"]:
+        shape = tuple(entry["shape"])
+        # a file cut short, by a copy or a disk that filled up, ends before its arrays do
+        if header["start"] + entry["offset"] + int(numpy.prod(shape)) * numpy.dtype(entry["dtype"]).itemsize > size:
+            raise SnapshotError(path, "truncated")
+        if numpy.prod(shape) == 0:
+            arrays[entry["name"]] = numpy.zeros(shape, dtype=entry["dtype"])
+        else:
+            arrays[entry["name"]] = numpy.memmap(path, dtype=entry["dtype"], mode="c", offset=header["start"] + entry["offset"], shape=shape)
+    return arrays
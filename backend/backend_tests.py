@@ -0,0 +1,669 @@
+"""
+Tests of the filters and the caches they keep
+
+    python3 -m backend.backend_tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from tornado import gen
+from tornado.escape import json_decode, json_encode
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+from unittest import mock
+from databases.database import Database, RatingChange
+from databases.AsyncDatabase import AsyncDatabase
+from databases.TokenSigner import TokenSigner
+from api.handlers.ApiSocket import ApiSocket
+from backend.Cache import LRUCache, ENTRY_OVERHEAD, sizeof
+from backend.CollabFilter import CollaborativeFilter
+from backend.FactorFilter import FactorFilter
+from backend.FactorModel import FactorModel
+from backend.Filter import Filter
+from backend.ItemFilter import ItemFilter
+from backend.ItemSimilarities import ItemSimilarities
+from backend.Jobs import JobPool
+from backend.LSH import MinHashIndex
+from backend.LSHBenchmark import generate
+from backend.PredictionPush import PredictionPush
+from backend.RatingMatrix import RatingMatrix
+from backend.RatingStore import RatingStore
+from backend.Similarities import Similarities
+from backend import Snapshot
+
+
+class Clock(object):
+    """
+    A clock that only moves when it is told to
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryFilter(CollaborativeFilter):
+    """
+    A CollaborativeFilter reading its opinions from a dict rather than a database
+    """
+    def __init__(self, ratings, cacheSize=None):
+        self.ratings = ratings
+        self.cache = True
+        self.neighbours = None
+        self.minOverlap = 1
+        self.opinions = LRUCache(cacheSize)
+        self.similarities = LRUCache(cacheSize)
+        self.calculated = LRUCache(cacheSize)
+
+    def items(self):
+        return [(item,) for item in sorted({item for user, item in self.ratings})]
+
+    def fetchOpinion(self, user, item):
+        return self.ratings.get((user, item))
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_01_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        #reading a marks it as recently used, so b is the one evicted
+        self.assertEqual(cache["a"], 1)
+        cache["c"] = 3
+        self.assertNotIn("b", cache)
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        #replacing a value doesn't evict anything
+        cache["c"] = 4
+        self.assertEqual((len(cache), cache.evictions, cache["c"]), (2, 1, 4))
+
+    def test_02_byte_budget(self):
+        entry = ENTRY_OVERHEAD + sizeof((1, 2)) + sizeof((0.5, 0.25, 0.125))
+        cache = LRUCache(max_bytes=3 * entry)
+        for user in range(5):
+            cache[(user, 2)] = (0.5, 0.25, 0.125)
+        #only the three most recent fit
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.bytes, 3 * entry)
+        self.assertEqual(cache.evictions, 2)
+        self.assertNotIn((1, 2), cache)
+        self.assertIn((4, 2), cache)
+        #and the bytes follow the entries out
+        del cache[(4, 2)]
+        self.assertEqual(cache.pop((3, 2)), (0.5, 0.25, 0.125))
+        self.assertEqual(cache.bytes, entry)
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_03_ttl(self):
+        clock = Clock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache["a"] = 1
+        clock.now = 9
+        self.assertEqual(cache["a"], 1)
+        cache["b"] = 2
+        #an expired value is gone, as if it had never been cached
+        clock.now = 10
+        self.assertNotIn("a", cache)
+        self.assertRaises(KeyError, cache.__getitem__, "a")
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(cache.bytes, ENTRY_OVERHEAD + sizeof("b") + sizeof(2))
+
+    def test_04_counters(self):
+        cache = LRUCache(max_entries=1)
+        cache["a"] = 1
+        cache.get("a")
+        cache.get("b")
+        self.assertRaises(KeyError, cache.__getitem__, "b")
+        cache["b"] = 2
+        stats = cache.stats()
+        self.assertEqual((stats["size"], stats["max_entries"], stats["hits"], stats["misses"], stats["evictions"], stats["expirations"]),
+                         (1, 1, 1, 2, 1, 0))
+        self.assertEqual(stats["bytes"], cache.bytes)
+
+
+class CollaborativeFilterTests(unittest.TestCase):
+
+    def test_01_evicted_similarity(self):
+        #a calculated rating is updated even once the similarity it needs has been evicted
+        collab = MemoryFilter({("u", "x"): 4, ("u", "y"): 2, ("v", "x"): 5, ("v", "y"): 1}, cacheSize=1)
+        collab.calculated[("v", "y")] = (1.0, 1.0)
+        self.assertNotIn(("v", "v"), collab.similarities)
+        collab._updateCalculatedRating("u", "y", "v", 3, 2, 0.5)
+        similarity = collab._noCacheSimilarity("v", "v")
+        self.assertAlmostEqual(collab.calculated[("v", "y")][0], 1.0 + similarity * 3 - 2 * 0.5)
+        self.assertAlmostEqual(collab.calculated[("v", "y")][1], 1.0 - 0.5 + similarity)
+
+
+class Listeners(object):
+    """
+    A Database that only takes listeners, for a RatingStore whose matrices are
+    put in place by the test
+    """
+    def add_listener(self, listener):
+        pass
+
+
+class MemoryStore(object):
+    """
+    A RatingStore holding the RatingMatrix of a single school, with no database
+    """
+    def __init__(self, matrix):
+        self.matrix_ = matrix
+        self.items = {}
+        self.revisions = {1: 0}
+
+    def school_of(self, user_id):
+        return 1
+
+    def matrix(self, school_id):
+        return self.matrix_
+
+    def item_similarities_for(self, school_id, attribute):
+        if attribute not in self.items:
+            self.items[attribute] = ItemSimilarities(self.matrix_, attribute)
+        return self.items[attribute]
+
+
+class ItemFilterTests(unittest.TestCase):
+
+    def test_01_brute_force(self):
+        #the similarities and predictions match the cosine over co-raters worked out pair by pair
+        generator = random.Random(907)
+        ratings = {(user, course): (generator.randint(1, 5), generator.choice([None, 1, 2, 3, 4]), generator.randint(1, 5))
+                   for user in range(1, 16) for course in range(1, 9) if generator.random() < 0.45}
+        matrix = RatingMatrix([key + value for key, value in sorted(ratings.items())])
+        store = MemoryStore(matrix)
+        for index, attribute in enumerate(matrix.attributes):
+            values = {key: value[index] for key, value in ratings.items() if value[index] is not None}
+
+            def cosine(course, other):
+                both = [user for user in range(1, 16) if (user, course) in values and (user, other) in values]
+                top = sum(values[(user, course)] * values[(user, other)] for user in both)
+                bottom = (sum(values[(user, course)] ** 2 for user in both) * sum(values[(user, other)] ** 2 for user in both)) ** 0.5
+                return 0 if bottom == 0 else top / bottom
+
+            items = ItemFilter(None, attribute, store)
+            for course in range(1, 9):
+                for other in range(1, 9):
+                    self.assertAlmostEqual(store.item_similarities_for(1, attribute).row(matrix.courses[course], [matrix.courses[other]])[0],
+                                           cosine(course, other), places=5)
+            for user in range(1, 16):
+                predictions = items.predict(user)
+                for course in range(1, 9):
+                    weights = [(cosine(course, other), values[(user, other)]) for other in range(1, 9) if (user, other) in values and other != course]
+                    bottom = sum(weight for weight, value in weights)
+                    expected = None if (user, course) in ratings or bottom == 0 else sum(weight * value for weight, value in weights) / bottom
+                    if expected is None:
+                        self.assertIsNone(predictions[course], (attribute, user, course))
+                    else:
+                        self.assertAlmostEqual(predictions[course], expected, places=4)
+                        self.assertAlmostEqual(items.calculated_rating(user, course), expected, places=4)
+                ranked = items.recommend(user, 3, attribute)
+                best = sorted((value for value in predictions.values() if value is not None), reverse=True)[:3]
+                self.assertEqual([round(score, 6) for course, score in ranked], [round(score, 6) for score in best])
+
+
+class FactorModelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def rank_one(self):
+        #every value is the product of a user's and a course's taste, so one factor fits them exactly
+        users, courses = [1.0, 2.0, 1.5, 0.5], [2.0, 1.0, 2.5]
+        return RatingMatrix([(user + 1, course + 1, a * b, None, None) for user, a in enumerate(users) for course, b in enumerate(courses)]), users, courses
+
+    def test_01_fit(self):
+        matrix, users, courses = self.rank_one()
+        model = FactorModel.train(matrix, "rating", 1, 7, factors=2, regularization=1e-6, iterations=30)
+        for user, a in enumerate(users):
+            for course, b in enumerate(courses):
+                self.assertAlmostEqual(model.predict(user + 1, course + 1), a * b, places=3)
+            numpy.testing.assert_allclose(model.scores(user + 1), [a * b for b in courses], atol=1e-3)
+        #users and courses it wasn't trained on have no predictions
+        self.assertIsNone(model.predict(9, 1))
+        self.assertIsNone(model.predict(1, 9))
+        self.assertIsNone(model.scores(9))
+
+    def test_02_save_load(self):
+        matrix, users, courses = self.rank_one()
+        model = FactorModel.train(matrix, "rating", 1, 7, factors=2)
+        path = os.path.join(self.folder, "model.factors")
+        model.save(path)
+        loaded = FactorModel.load(path)
+        self.assertEqual((loaded.school_id, loaded.revision, loaded.mean), (1, 7, model.mean))
+        for name in ("user_ids", "course_ids", "user_factors", "course_factors"):
+            numpy.testing.assert_array_equal(getattr(loaded, name), getattr(model, name))
+        self.assertEqual(loaded.predict(2, 3), model.predict(2, 3))
+
+    def test_03_revision(self):
+        matrix, users, courses = self.rank_one()
+        store = MemoryStore(matrix)
+        factors = FactorFilter(None, "rating", self.folder, store, fallback=object())
+        self.assertIsNone(factors.current(1))
+        self.assertTrue(factors._falls_back(1))
+        model = factors.train(1)
+        self.assertIs(factors.current(1), model)
+        self.assertFalse(factors._falls_back(1))
+        #once the ratings move on the model is still there, but no longer current, so the fallback answers
+        store.revisions[1] = 1
+        self.assertIs(factors.model(1), model)
+        self.assertIsNone(factors.current(1))
+        self.assertTrue(factors._falls_back(1))
+        #until it is trained again
+        self.assertEqual(factors.train(1).revision, 1)
+        self.assertIsNotNone(factors.current(1))
+
+
+class SimilaritiesTests(unittest.TestCase):
+
+    def random_rating(self, generator):
+        #grade and difficulty are optional, so they are sometimes missing
+        return (generator.randint(1, 5),) + tuple(generator.choice([None, 1, 2, 3, 4, 5]) for attribute in range(2))
+
+    def assertRebuilt(self, matrix, similarities):
+        """
+        asserts that the incrementally updated sums are those built from scratch
+        """
+        for attribute, updated in similarities.items():
+            rebuilt = Similarities(matrix, attribute)
+            self.assertEqual(updated.size, rebuilt.size)
+            for name in ("mult_sum", "rss", "overlap"):
+                numpy.testing.assert_array_equal(getattr(updated, name)[:updated.size, :updated.size],
+                                                 getattr(rebuilt, name)[:rebuilt.size, :rebuilt.size], err_msg="{} {}".format(attribute, name))
+
+    def test_01_random_changes(self):
+        #adding, updating and removing ratings, by new users and of new courses, matches rebuilding the sums
+        generator = random.Random(1301)
+        rows = [(user, course) + self.random_rating(generator) for user in range(1, 9) for course in range(1, 7) if generator.random() < 0.5]
+        matrix = RatingMatrix(rows)
+        similarities = {attribute: Similarities(matrix, attribute) for attribute in matrix.attributes}
+        for step in range(400):
+            user = generator.randint(1, 8 + step // 20)
+            course = generator.randint(1, 6 + step // 40)
+            new = None if generator.random() < 0.25 else self.random_rating(generator)
+            row, column, old, new = matrix.apply(RatingChange(1, user, course, None, new, step + 1))
+            for index, attribute in enumerate(matrix.attributes):
+                values, rated = matrix.column(attribute, column)
+                similarities[attribute].update(row, values, rated, old and old[index], new and new[index])
+            if step % 20 == 19:
+                self.assertRebuilt(matrix, similarities)
+        self.assertGreater(matrix.shape[0], 8)
+        self.assertGreater(matrix.shape[1], 6)
+
+    def test_02_memory_bound(self):
+        #the arrays never hold more than max_users users, and grow by a quarter at a time
+        max_users, Similarities.max_users = Similarities.max_users, 40
+        try:
+            generator = random.Random(77)
+            rows = [(user, course, generator.randint(1, 5), None, None) for user in range(1, 31) for course in range(1, 6) if generator.random() < 0.6]
+            matrix = RatingMatrix(rows)
+            similarities = Similarities(matrix, "rating")
+            for user in range(31, 41):
+                row, column, old, new = matrix.apply(RatingChange(1, user, 1, None, (3, None, None), user))
+                values, rated = matrix.column("rating", column)
+                similarities.update(row, values, rated, None, 3)
+                capacity = len(similarities.mult_sum)
+                self.assertLessEqual(capacity, max(16, similarities.size * 5 // 4))
+                self.assertEqual(sum(getattr(similarities, name).nbytes for name in ("mult_sum", "rss", "overlap")), 3 * 4 * capacity ** 2)
+            self.assertEqual(len(similarities.mult_sum), 40)
+            row, column, old, new = matrix.apply(RatingChange(1, 41, 1, None, (3, None, None), 41))
+            values, rated = matrix.column("rating", column)
+            self.assertRaises(ValueError, similarities.update, row, values, rated, None, 3)
+
+            #a school that outgrows them has its similarities dropped, and is predicted for approximately
+            matrix = RatingMatrix(rows)
+            store = RatingStore(Listeners())
+            store.matrices[1], store.revisions[1] = matrix, 0
+            store.schools.update((user, 1) for user in range(1, 60))
+            ratings = Filter(None, "rating", store)
+            self.assertFalse(ratings._approximate(1))
+            ratings.recommend(1)
+            self.assertIn((1, "rating"), store.similarities)
+            store.changed([RatingChange(1, user, 2, None, (4, None, None), user) for user in range(31, 42)])
+            self.assertNotIn((1, "rating"), store.similarities)
+            self.assertTrue(ratings._approximate(1))
+            self.assertEqual(ratings.recommend(41, 2), ratings.recommend(41, 2))
+            self.assertIsNotNone(ratings.calculated_rating(41, 1))
+        finally:
+            Similarities.max_users = max_users
+
+
+class LSHTests(unittest.TestCase):
+
+    def test_01_recall(self):
+        #the users whose rated courses overlap a user's most, by exact Jaccard similarity, are nearly all candidates
+        matrix = generate(600, 200, 12, groups=20, seed=3)
+        rated = matrix.rated("rating")
+        courses = [set(rated.indices[rated.indptr[user]:rated.indptr[user + 1]]) for user in range(matrix.shape[0])]
+        index = MinHashIndex(matrix, "rating", hashes=2, tables=16, seed=5)
+        found, similar, candidates = 0, 0, 0
+        for user in range(0, matrix.shape[0], 10):
+            found_for = set(index.candidates(user).tolist())
+            self.assertNotIn(user, found_for)
+            candidates += len(found_for)
+            for other in range(matrix.shape[0]):
+                if other != user and len(courses[user] & courses[other]) >= 0.3 * len(courses[user] | courses[other]):
+                    similar += 1
+                    found += other in found_for
+        self.assertGreater(similar, 1000)
+        self.assertGreaterEqual(found / similar, 0.95)
+        #while only a small part of the school is scored
+        self.assertLess(candidates / (matrix.shape[0] // 10), matrix.shape[0] / 10)
+
+        #a user rehashed after a change lands where a fresh index puts them
+        row = matrix.apply(RatingChange(1, 0, 199, None, (5, None, None), 1))[0]
+        index.changed(matrix, row)
+        numpy.testing.assert_array_equal(index.codes[row], MinHashIndex(matrix, "rating", hashes=2, tables=16, seed=5).codes[row])
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "school-1.snapshot")
+        self.arrays = {"values": numpy.arange(100, dtype=numpy.float32), "rows": numpy.arange(10, dtype=numpy.int64)}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertArrays(self, arrays):
+        self.assertEqual(set(arrays), set(self.arrays))
+        for name in arrays:
+            numpy.testing.assert_array_equal(arrays[name], self.arrays[name])
+
+    def test_01_version(self):
+        Snapshot.write_snapshot(self.path, 1, 3, self.arrays)
+        header = Snapshot.read_header(self.path)
+        self.assertEqual((header["school_id"], header["revision"]), (1, 3))
+        self.assertArrays(Snapshot.read_snapshot(self.path, header))
+
+        #a snapshot of another format version is refused rather than misread
+        with open(self.path, "r+b") as snapshot:
+            snapshot.seek(len(Snapshot.MAGIC))
+            snapshot.write(Snapshot._PREFIX.pack(Snapshot.FORMAT_VERSION - 1, 0)[:2])
+        with self.assertRaises(Snapshot.SnapshotError) as raised:
+            Snapshot.read_header(self.path)
+        self.assertIn("format version", str(raised.exception))
+        #and the store rebuilds the school instead
+        self.assertIsNone(RatingStore(Listeners(), self.folder)._restore(1, 3))
+
+    def test_02_torn_write(self):
+        Snapshot.write_snapshot(self.path, 1, 3, self.arrays)
+
+        #a writer that dies before its file is in place leaves the last snapshot whole, and no temporary file
+        with mock.patch("backend.Snapshot.os.replace", side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, Snapshot.write_snapshot, self.path, 1, 4, {"values": numpy.zeros(100, dtype=numpy.float32)})
+        self.assertEqual(os.listdir(self.folder), ["school-1.snapshot"])
+        self.assertEqual(Snapshot.read_header(self.path)["revision"], 3)
+        self.assertArrays(Snapshot.read_snapshot(self.path))
+
+        #a file cut short is refused, however far into it the cut is
+        with open(self.path, "rb") as snapshot:
+            whole = snapshot.read()
+        store = RatingStore(Listeners(), self.folder)
+        for length in (len(whole) - 1, Snapshot.read_header(self.path)["start"] + 8, len(Snapshot.MAGIC) + 3):
+            with open(self.path, "wb") as snapshot:
+                snapshot.write(whole[:length])
+            self.assertRaises(Snapshot.SnapshotError, Snapshot.read_snapshot, self.path)
+            self.assertIsNone(store._restore(1, 3))
+
+
+class JobPoolTests(AsyncTestCase):
+
+    def setUp(self):
+        super(JobPoolTests, self).setUp()
+        self.pool = JobPool(executor=ThreadPoolExecutor(4))
+        self.release = threading.Event()
+        self.gathered = []
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.executor.shutdown(wait=True)
+        super(JobPoolTests, self).tearDown()
+
+    def job(self, value):
+        self.release.wait(5)
+        if value is None:
+            raise KeyError(value)
+        return value
+
+    def arguments(self, value):
+        def gather():
+            self.gathered.append(value)
+            return (value,)
+        return gather
+
+    @gen_test
+    def test_01_coalescing(self):
+        #submissions under the key of a running job share its future, without gathering their arguments
+        first = self.pool.submit("school", self.job, arguments=self.arguments(1))
+        self.assertIs(self.pool.submit("school", self.job, arguments=self.arguments(2)), first)
+        self.assertIs(self.pool.submit("school", self.job, 3), first)
+        #while other keys, and no key, run jobs of their own
+        other = self.pool.submit("other", self.job, 4)
+        unshared = [self.pool.submit(None, self.job, 5), self.pool.submit(None, self.job, 5)]
+        self.assertIsNot(unshared[0], unshared[1])
+        self.assertEqual(self.gathered, [1])
+        self.assertEqual(self.pool.stats(), dict(pending=2, submitted=4, coalesced=2))
+
+        self.release.set()
+        self.assertEqual((yield [first, other] + unshared), [1, 4, 5, 5])
+        self.assertEqual(self.pool.pending, {})
+        #once it has finished, the key runs a new job
+        self.assertEqual((yield self.pool.submit("school", self.job, arguments=self.arguments(6))), 6)
+        self.assertEqual(self.gathered, [1, 6])
+        self.assertEqual(self.pool.stats(), dict(pending=0, submitted=5, coalesced=2))
+
+    @gen_test
+    def test_02_finished(self):
+        #finished runs on the IOLoop once per job, however many submissions share it, and its return is the result
+        calls = []
+        def finished(result):
+            calls.append(threading.current_thread() is threading.main_thread())
+            return result * 10
+        futures = [self.pool.submit("school", self.job, 2, finished=finished) for submission in range(3)]
+        self.release.set()
+        self.assertEqual((yield futures), [20, 20, 20])
+        self.assertEqual(calls, [True])
+
+        #a failing job, or finished, fails the future and frees the key
+        with self.assertRaises(KeyError):
+            yield self.pool.submit("school", self.job, None, finished=finished)
+        with self.assertRaises(ZeroDivisionError):
+            yield self.pool.submit("school", self.job, 0, finished=lambda result: 1 / result)
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(calls, [True])
+
+
+class Socket(object):
+    """
+    An open ApiSocket that keeps the messages written to it
+    """
+    def __init__(self):
+        self.ws_connection = True
+        self.messages = []
+
+    def write_message(self, message):
+        self.messages.append(json_decode(message))
+
+
+class SlowFilter(object):
+    """
+    A filter whose predictions of a course take longer the higher its id, and
+        fail for the courses in failing
+    """
+    def __init__(self, offset, failing=()):
+        self.offset = offset
+        self.failing = failing
+
+    @gen.coroutine
+    def calculated_rating_async(self, user_id, course_id):
+        yield gen.sleep(course_id * 0.02)
+        if course_id in self.failing:
+            raise KeyError(course_id)
+        raise gen.Return(course_id + self.offset)
+
+
+class ChannelTests(AsyncHTTPTestCase):
+    """
+    The replies of the multiplexed socket a page's Channel keeps open
+    """
+
+    def get_app(self):
+        self.tokens = TokenSigner("secret")
+        filters = namedtuple("Filters", ["rating", "grade", "difficulty"])(SlowFilter(0, failing={0}), SlowFilter(1), SlowFilter(2))
+        push = type("Push", (object,), {"unsubscribe": lambda self, socket: None})()
+        return Application([(r"/api/socket", ApiSocket, dict(db=None, tokens=self.tokens, filters=filters, push=push))])
+
+    @gen_test
+    def test_01_reply_routing(self):
+        user = namedtuple("User", ["user_id", "user_name", "school_id", "admin", "moderator", "roles_changed"])(7, "channel", 1, False, False, 0)
+        token = self.tokens.issue(user)
+        socket = yield websocket_connect(self.get_url("/api/socket").replace("http", "ws"))
+        #several requests out at once, answered as they finish rather than in the order they were sent
+        for message in (dict(id=1, type="predict", course=4), dict(id=2, type="predict", course=1), dict(id=3, type="predict", course=0),
+                        dict(id=4, type="predict", token="forged", course=1), dict(id=5, type="unknown", course=1)):
+            message.setdefault("token", token)
+            socket.write_message(json_encode(message))
+        replies = []
+        for reply in range(5):
+            replies.append(json_decode((yield socket.read_message())))
+        self.assertEqual(sorted(reply["id"] for reply in replies[:3]), [3, 4, 5])
+        self.assertEqual([reply["id"] for reply in replies[3:]], [2, 1])
+        replies = {reply["id"]: reply for reply in replies}
+        #each carrying the answer to its own request
+        self.assertEqual((replies[1]["stat"], replies[1]["course"], replies[1]["rating"], replies[1]["difficulty"]), ("predicted", 4, 4, 6))
+        self.assertEqual((replies[2]["stat"], replies[2]["course"], replies[2]["grade"]), ("predicted", 1, 2))
+        #and a request that fails, or isn't allowed, is answered as failed with the socket left open
+        for failed in (3, 4, 5):
+            self.assertEqual(replies[failed], {"id": failed, "stat": "failed"})
+        socket.write_message(json_encode(dict(id=6, type="predict", token=token, course=2)))
+        self.assertEqual(json_decode((yield socket.read_message()))["id"], 6)
+        socket.close()
+
+
+class DatabaseTestCase(AsyncTestCase):
+    """
+    Runs each test against a Database of its own, in a temporary sqlite file
+    """
+
+    def setUp(self):
+        super(DatabaseTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.url = os.environ.get("DATABASE_URL")
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(self.folder, "test.db")
+        self.db = Database()
+
+    def tearDown(self):
+        self.db.engine.dispose()
+        if self.url is None:
+            del os.environ["DATABASE_URL"]
+        else:
+            os.environ["DATABASE_URL"] = self.url
+        shutil.rmtree(self.folder)
+        super(DatabaseTestCase, self).tearDown()
+
+    def school(self, rated):
+        """
+        Adds the school P with a user per key of rated, who rates the courses
+            named by the letters of its value
+
+        Return -> tuple(map(user->User), map(course->course_id))
+        """
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Push", "P")
+            for user in rated:
+                self.db.add_user(session, user, user + "@p", "password", "P", hashed=("salt", b"hash"))
+            for course in sorted(set("".join(rated.values()))):
+                self.db.add_course(session, "P", course, course)
+        with self.db.session_scope() as session:
+            for number, (user, letters) in enumerate(sorted(rated.items())):
+                for index, course in enumerate(letters):
+                    self.db.add_rating(session, user, course, rating=(number + index) % 5 + 1, grade=(number * index) % 4 + 1, difficulty=index + 1)
+            users = {user: self.db.fetch_user_by_name(session, user) for user in rated}
+            ids = {course: self.db.fetch_course_by_name(session, "P", course).course_id for course in set("".join(rated.values()))}
+        return users, ids
+
+
+class RatingStoreTests(DatabaseTestCase):
+
+    @gen_test
+    def test_01_async_load(self):
+        users, ids = self.school({"u": "AB", "v": "BC"})
+        adb = AsyncDatabase(self.db, 2)
+        store = RatingStore(self.db, adb=adb)
+        school_id = yield store.school_of_async(users["u"].user_id)
+        self.assertEqual(school_id, users["u"].school_id)
+        #two requests share one load, and a change committed while it runs is replayed onto it
+        loads = [store.matrix_async(school_id), store.matrix_async(school_id)]
+        self.assertEqual(len(store.loading), 1)
+        store.changed([RatingChange(school_id, users["u"].user_id, ids["C"], None, (5, 1, 1), 10 ** 6)])
+        first, second = yield loads
+        self.assertIs(first, second)
+        self.assertEqual(store.loading, {})
+        self.assertEqual(store.revisions[school_id], 10 ** 6)
+        values, rated = first.column("rating", first.courses[ids["C"]])
+        self.assertEqual((int(rated.sum()), values[first.users[users["u"].user_id]]), (2, 5.0))
+        adb.shutdown()
+
+
+class PredictionPushTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(PredictionPushTests, self).setUp()
+        store = RatingStore(self.db)
+        self.filters = type("Filters", (object,), {attribute: Filter(self.db, attribute, store) for attribute in PredictionPush.attributes})
+        self.push = PredictionPush(self.db, self.filters)
+
+    @gen_test
+    def test_01_delta(self):
+        #w shares A with n and o and B with x, n shares C with x and o shares E with x
+        users, ids = self.school({"w": "AB", "n": "AC", "o": "ADE", "x": "CEB"})
+        courses = {course_id: course for course, course_id in ids.items()}
+        sockets = {}
+        for user in "wno":
+            sockets[user] = Socket()
+            yield self.push.subscribe(sockets[user], users[user].user_id, users[user].school_id)
+
+        #w rating C moves their weight to n and x, and so w's E through x and n's B through w, as well as o's C
+        with self.db.session_scope() as session:
+            self.db.add_rating(session, "w", "C", rating=1, grade=1, difficulty=2)
+        while self.push.running:
+            yield gen.sleep(0.01)
+
+        delta = {}
+        for user, socket in sockets.items():
+            self.assertEqual(len(socket.messages), 1, user)
+            message = socket.messages[0]
+            delta[user] = (sorted(courses[int(course_id)] for course_id in message["predictions"]), [courses[course_id] for course_id in message["removed"]])
+        self.assertEqual(delta, {"w": (["E"], ["C"]), "n": (["B"], []), "o": (["C"], [])})
+        #only those courses were worked out again, o's C alone
+        change = RatingChange(users["w"].school_id, users["w"].user_id, ids["C"], None, (1, 1, 2), 0)
+        self.assertEqual([courses[course_id] for course_id in self.filters.rating.changed_courses(users["o"].user_id, [change])], ["C"])
+        self.assertEqual([courses[course_id] for course_id in self.filters.rating.changed_courses(users["n"].user_id, [change])], ["A", "B", "C"])
+        #and what each page now has is what it would be sent afresh
+        for user, socket in sockets.items():
+            full = yield self.push.predictions(users[user].user_id)
+            sent = self.push.subscribers[users[user].user_id][socket]
+            self.assertEqual(sent, {course_id: values for course_id, values in full.items() if any(value is not None for value in values)}, user)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,164 @@
+"""
+Non blocking access to the Database for the tornado handlers
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+class AsyncDatabase(object):
+    """
+    Runs the queries of a Database in a pool of threads, so that a slow query
+    only holds up the request that made it rather than every connection the
+    IOLoop is serving.  Each call returns a tornado Future that handlers yield.
+
+    run executes a function in its own session_scope on a worker thread.  Any
+    Database method that takes a session first (the fetch_, add_, update_,
+    remove_ and _exists methods) is also available as a coroutine with the
+    session left out, and the properties (users, schools...) as coroutines
+    taking no arguments:
+
+        user = yield adb.fetch_user_by_name(username)
+        schools = yield adb.schools()
+
+    Objects come back detached from their session: their columns can be read,
+    but relationships (school.courses, user.courses...) have to be loaded by
+    the function given to run, while its session is still open.
+
+    The Database's listeners (the RatingStore, the ShardRouter) are not thread
+    safe, so the rating changes a worker commits are held back and published
+    on the IOLoop, before the Future resolves.
+
+    bind gives a view whose calls all share one session instead, so that a
+    request is a single unit of work with a single identity map: an object
+    fetched twice is only selected once, and objects stay attached between
+    calls.  Nothing is committed until commit or finish.  The calls of a
+    bound view must be yielded one at a time, as a session can't be used by
+    two threads at once.
+
+    instance data:
+        database -- the Database being wrapped
+        executor -- the ThreadPoolExecutor the queries run in
+        session  -- the session every call runs in, or None for a new
+                    session_scope per call
+    """
+
+    # the Database methods that take a session as their first argument
+    prefixes = ("fetch_", "add_", "update_", "remove_")
+    suffixes = ("_exists",)
+    sessionless = ("add_listener",)
+
+    def __init__(self, database, workers=10, executor=None, session=None):
+        """
+        Arguments:
+            database -> the Database to run the queries of
+            workers  -> the number of queries that can run at once, best kept
+                        below the size of the engine's connection pool
+            executor -> the threads to share, rather than starting new ones
+            session  -> the session to run every call in, see bind
+        """
+        self.database = database
+        self.executor = executor or ThreadPoolExecutor(workers)
+        self.session = session
+
+    def bind(self, session):
+        """
+        Return -> an AsyncDatabase on the same threads whose calls all run in
+                  session, which is left for the caller to commit
+        """
+        return AsyncDatabase(self.database, executor=self.executor, session=session)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Runs function(session, *args, **kwargs) on a worker thread, inside a
+            session_scope that commits once it returns
+
+        Return -> a tornado Future of the function's result
+        """
+        if self.session is not None:
+            return self.call(function, self.session, *args, **kwargs)
+
+        def transaction():
+            with self.database.session_scope() as session:
+                return function(session, *args, **kwargs)
+        return self.call(transaction)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) on a worker thread, for functions that
+            manage their own sessions
+
+        Return -> a tornado Future of the function's result
+        """
+        future = Future()
+        committed = []
+
+        def job():
+            self.database.local.deferred = committed
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.database.local.deferred = None
+
+        def done(job):
+            try:
+                for changes in committed:
+                    self.database.publish(changes)
+                result = job.result()
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        IOLoop.current().add_future(self.executor.submit(job), done)
+        return future
+
+    def commit(self):
+        """
+        Commits the bound session, rolling it back if the commit fails
+
+        Return -> a tornado Future that resolves once the commit's rating
+                  changes have been published
+        """
+        def commit():
+            try:
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+        return self.call(commit)
+
+    def finish(self, session, commit=True):
+        """
+        Commits, or rolls back, and closes a session that is done with, such
+            as that of a finished request, logging any error
+        """
+        def finish():
+            try:
+                if commit:
+                    session.commit()
+                else:
+                    session.rollback()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+        future = self.call(finish)
+        IOLoop.current().add_future(future, lambda future: future.result())
+        return future
+
+    def __getattr__(self, name):
+        """
+        The coroutine versions of the Database's methods and properties
+        """
+        attribute = getattr(type(self.database), name, None)
+        if isinstance(attribute, property):
+            return lambda: self.call(getattr, self.database, name)
+        if callable(attribute) and name not in self.sessionless and (name.startswith(self.prefixes) or name.endswith(self.suffixes)):
+            method = getattr(self.database, name)
+            return lambda *args, **kwargs: self.run(method, *args, **kwargs)
+        raise AttributeError(name)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -31,7 +31,9 @@ class CourseDatabase(object):
             year = Column(sqlalchemy.Integer, nullable=True)
             semester = Column(sqlalchemy.String(), nullable=True)
 
-            sqlalchemy.UniqueConstraint("identifier", "school_id", "professor", "year", "semester")
+            # a school offers each course once per professor, year and semester, and courses are looked up by
+            # school and identifier, so the one index serves both
+            __table_args__ = (sqlalchemy.Index("uq_courses_offering", "school_id", "identifier", "professor", "year", "semester", unique=True),)
 
             def __str__(self):
                 """
@@ -0,0 +1,132 @@
+"""
+Streaming the ratings, users and courses out of the Database
+"""
+
+import csv
+import io
+import json
+import sqlalchemy
+
+
+class Exporter(object):
+    """
+    Writes whole tables out as csv or newline delimited json in constant
+    memory, for training models offline or moving a school elsewhere.
+
+    rows streams a table from a single query, fetching batch rows at a time
+    from a server side cursor where the driver has them (stream_results), for
+    the export command.  page reads the batch of rows after a given key
+    instead, so that an export can be served a query at a time through the
+    AsyncDatabase without holding a cursor open between them.
+
+    Rows come out as tuples in the order of names(table).  The ratings carry
+    the user and course names as well as their ids, so an export can be read
+    back by Database.bulk_add_ratings; users leave out their password hashes,
+    salts, api keys and email addresses.
+
+    instance data:
+        database -- the Database being exported
+    """
+
+    tables = ("ratings", "users", "courses")
+
+    def __init__(self, database):
+        self.database = database
+
+    def columns(self, table):
+        """
+        Return -> the list of columns exported from a table
+        """
+        db = self.database
+        if table == "ratings":
+            return [db.rating.user_id, db.rating.course_id, db.user.user_name.label("username"), db.course.identifier.label("coursename"),
+                    db.rating.semester, db.rating.year, db.rating.professor, db.rating.rating, db.rating.grade, db.rating.difficulty]
+        if table == "users":
+            return [db.user.user_id, db.user.user_name, db.user.school_id, db.user.first_name, db.user.last_name,
+                    db.user.age, db.user.graduation, db.user.admin, db.user.moderator]
+        if table == "courses":
+            return [db.course.course_id, db.course.school_id, db.course.course_name, db.course.identifier,
+                    db.course.professor, db.course.year, db.course.semester]
+        raise ValueError("Can't export {}, only {}".format(table, ", ".join(self.tables)))
+
+    def names(self, table):
+        return [column.key for column in self.columns(table)]
+
+    def keys(self, table):
+        """
+        Return -> the columns a table is ordered by, which identify its rows
+        """
+        db = self.database
+        return {"ratings": [db.rating.user_id, db.rating.course_id], "users": [db.user.user_id], "courses": [db.course.course_id]}[table]
+
+    def query(self, session, table, school_id=None):
+        """
+        Return -> the query of a table, or of the part of it belonging to a
+                  school, in the order of its keys
+        """
+        db = self.database
+        query = session.query(*self.columns(table))
+        if table == "ratings":
+            query = query.join(db.user, db.user.user_id == db.rating.user_id).join(db.course, db.course.course_id == db.rating.course_id)
+            school = db.user.school_id
+        else:
+            school = db.user.school_id if table == "users" else db.course.school_id
+        if school_id is not None:
+            query = query.filter(school == school_id)
+        return query.order_by(*self.keys(table))
+
+    def rows(self, session, table, school_id=None, batch=1000):
+        """
+        Streams the rows of a table, batch at a time
+
+        Return -> a generator of row tuples
+        """
+        for row in self.query(session, table, school_id).execution_options(stream_results=True).yield_per(batch):
+            yield tuple(row)
+
+    def page(self, session, table, school_id=None, after=None, limit=1000):
+        """
+        Reads the rows of a table that follow a key
+
+        Arguments:
+            table     -> one of tables
+            school_id -> the school to export, or None for all of them
+            after     -> the key of the last row read, as given by key, or
+                         None to start from the first row
+            limit     -> the number of rows to read
+
+        Return -> a list of up to limit row tuples
+        """
+        query = self.query(session, table, school_id)
+        if after is not None:
+            # (a, b) > (x, y) spelt out, as not every database compares tuples
+            keys = self.keys(table)
+            later = [sqlalchemy.and_(*[key == value for key, value in zip(keys[:index], after)] + [keys[index] > after[index]])
+                     for index in range(len(keys))]
+            query = query.filter(sqlalchemy.or_(*later))
+        return [tuple(row) for row in query.limit(limit)]
+
+    def key(self, table, row):
+        """
+        Return -> the key of an exported row, for page
+        """
+        # every table's keys are its first columns
+        return row[:len(self.keys(table))]
+
+    def csv_header(self, table):
+        return self.csv_lines([self.names(table)])
+
+    def csv_lines(self, rows):
+        """
+        Return -> the rows as lines of csv
+        """
+        lines = io.StringIO()
+        csv.writer(lines).writerows(rows)
+        return lines.getvalue()
+
+    def json_lines(self, table, rows):
+        """
+        Return -> the rows as lines of json objects keyed by the column names
+        """
+        names = self.names(table)
+        return "".join(json.dumps(dict(zip(names, row))) + "\n" for row in rows)
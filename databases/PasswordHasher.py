@@ -0,0 +1,157 @@
+"""
+Hashing passwords off the IOLoop
+"""
+
+import time
+import scrypt
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+def hash_password(password, salt, hashlength):
+    """
+    Return -> the base64 encoded scrypt hash of a password, as stored in the
+              password_hash of a user
+    """
+    return b64encode(scrypt.hash(password, salt, hashlength))
+
+
+def new_salt():
+    return str(int(time.time()))
+
+
+class PasswordHasher(object):
+    """
+    Computes scrypt hashes in a small pool of threads.  Each hash is tens of
+    milliseconds of cpu by design; scrypt releases the GIL while it works, so
+    on the pool they run beside the IOLoop, and in parallel with each other,
+    instead of a burst of logins queueing every other request behind them.
+
+    At most limit hashes are waiting or running at once.  Past that, hash and
+    verify fail straight away with HasherBusyError, so that a flood of logins
+    is turned away instead of building a queue no one will wait for.
+
+    The time each hash takes, from being asked for to being answered, is kept
+    per kind of request (login, register, password) for stats.
+
+    instance data:
+        hashlength -- the length of the hashes, that of the Database
+        executor   -- the ThreadPoolExecutor the hashes run in
+        limit      -- the number of hashes that may be waiting or running
+        pending    -- the number of hashes waiting or running
+        rejected   -- the number of hashes turned away for being over the limit
+        latencies  -- map(kind->deque of the latest latencies, in seconds)
+        counts     -- map(kind->the number of hashes of that kind)
+    """
+
+    def __init__(self, hashlength, workers=4, limit=64, window=1000):
+        """
+        Arguments:
+            hashlength -> the length of the hashes, Database.hashlength
+            workers    -> the number of hashes computed at once, at most the
+                          number of cores
+            limit      -> the number of hashes that may be waiting or running
+            window     -> the number of latest latencies kept per kind
+        """
+        self.hashlength = hashlength
+        self.executor = ThreadPoolExecutor(workers)
+        self.limit = limit
+        self.window = window
+        self.pending = 0
+        self.rejected = 0
+        self.latencies = {}
+        self.counts = {}
+
+    def hash(self, password, salt, kind="hash"):
+        """
+        Hashes a password with a salt in the pool
+
+        Return -> a tornado Future of the hash, as hash_password
+        """
+        if self.pending >= self.limit:
+            self.rejected += 1
+            raise HasherBusyError(self.pending)
+
+        future = Future()
+        started = time.time()
+        self.pending += 1
+
+        def done(job):
+            self.pending -= 1
+            self.latencies.setdefault(kind, deque(maxlen=self.window)).append(time.time() - started)
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            try:
+                future.set_result(job.result())
+            except Exception as error:
+                future.set_exception(error)
+        IOLoop.current().add_future(self.executor.submit(hash_password, password, salt, self.hashlength), done)
+        return future
+
+    def new_hash(self, password, kind="hash"):
+        """
+        Hashes a password with a fresh salt, for add_user and update_password
+
+        Return -> a tornado Future of tuple(salt, hash)
+        """
+        salt = new_salt()
+        future = Future()
+        IOLoop.current().add_future(self.hash(password, salt, kind),
+                                    lambda hashed: _chain(hashed, future, lambda result: (salt, result)))
+        return future
+
+    def verify(self, password, salt, password_hash, kind="login"):
+        """
+        Return -> a tornado Future of whether password hashes to password_hash
+        """
+        # add_user stores the hash as bytes, which some drivers hand back as they are
+        if isinstance(password_hash, bytes):
+            password_hash = password_hash.decode('utf-8')
+        future = Future()
+        IOLoop.current().add_future(self.hash(password, salt, kind),
+                                    lambda hashed: _chain(hashed, future, lambda result: result.decode('utf-8') == password_hash))
+        return future
+
+    def stats(self):
+        """
+        Return -> a dict of the pending and rejected counts, and per kind of
+                  hash its count and the mean, median, 95th percentile and
+                  maximum of its latest latencies in milliseconds
+        """
+        stats = dict(pending=self.pending, rejected=self.rejected)
+        for kind, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            stats[kind] = dict(count=self.counts[kind],
+                               mean=1000 * sum(ordered) / len(ordered),
+                               median=1000 * ordered[len(ordered) // 2],
+                               p95=1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                               max=1000 * ordered[-1])
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def _chain(source, target, convert):
+    """
+    Resolves the Future target with convert of the result of the resolved
+        Future source, or with its exception
+    """
+    try:
+        target.set_result(convert(source.result()))
+    except Exception as error:
+        target.set_exception(error)
+
+
+class HasherBusyError(Exception):
+    """
+    Raised when a PasswordHasher already has as many hashes as it will take
+    """
+    def __init__(self, pending, *args):
+        self.pending = pending
+        self.information = args
+
+    def __str__(self):
+        return "The password hasher is busy with {} hashes".format(self.pending)
@@ -0,0 +1,50 @@
+"""
+Database for storing how many times each school's ratings have changed
+"""
+
+import sqlalchemy
+import sqlalchemy.ext.declarative
+import sqlalchemy.orm
+from sqlalchemy import Column
+
+
+class RevisionDatabase(object):
+    """
+    Factory for creating revision databases
+    """
+
+    def __init__(this, base_class):
+        """
+        Creates a class to store a change counter for the ratings of each school,
+            so that cached data built from the ratings can tell whether it is
+            still current
+        """
+        class RevisionTable(base_class):
+            """
+            """
+            __tablename__ = "revisions"
+            school_id = Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("schools.school_id"), primary_key=True)
+            revision = Column(sqlalchemy.Integer, default=0, nullable=False)  # bumped once per commit that changes ratings
+
+            def __str__(self):
+                """
+                """
+                return self.__repr__()
+
+            def __repr__(self):
+                """
+                """
+                return "<Revision {} of school {}>".format(self.revision, self.school_id)
+
+        this.class_ = RevisionTable
+
+    def create(this):
+        """
+        Returns the RevisionTable class
+        """
+        return this.class_
+
+
+if __name__ == "__main__":
+    meta = sqlalchemy.MetaData()
+    testdb = RevisionDatabase(sqlalchemy.ext.declarative.declarative_base()).create()
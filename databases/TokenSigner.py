@@ -0,0 +1,130 @@
+"""
+Signed, expiring tokens for the websockets and the api
+"""
+
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import namedtuple
+
+
+# what a token says about the user it was issued to
+TokenClaims = namedtuple("TokenClaims", ["user_id", "username", "school_id", "admin", "moderator", "issued", "expires", "token_id"])
+
+
+class TokenSigner(object):
+    """
+    Issues and checks the tokens that the pages hand to their websockets, and
+    that api clients send, in place of a user's apikey.  A token carries the
+    user's id, name, school and roles and is signed with an HMAC, so checking
+    one is a hash and a couple of dict lookups: no query is made to find out
+    who sent a message.
+
+    As the claims are only read from the database when a token is issued, a
+    token has to be revoked when they stop being true.  revoke drops a single
+    token, revoke_user every token issued to a user so far, for when their
+    roles or password change or they sign out.  Revocations are kept only as
+    long as the tokens they revoke would have lived, and only in this process,
+    so a role change also stamps the user's roles_changed column, and current
+    refuses the tokens issued before it wherever the roles were changed, for
+    the handlers that act on a token's roles.
+
+    instance data:
+        secret        -- the key tokens are signed with
+        lifetime      -- the number of seconds a token is valid for
+        revoked       -- map(token_id->expiry time) of the revoked tokens
+        revoked_users -- map(username->time) before which every token issued
+                         to that user is revoked
+    """
+
+    def __init__(self, secret, lifetime=6 * 60 * 60):
+        """
+        Arguments:
+            secret   -> the key to sign tokens with, such as the cookie secret
+            lifetime -> the number of seconds a token is valid for
+        """
+        self.secret = secret.encode("utf-8") if isinstance(secret, str) else secret
+        self.lifetime = lifetime
+        self.revoked = {}
+        self.revoked_users = {}
+
+    def issue(self, user):
+        """
+        Arguments:
+            user -> the user the token speaks for, a row of the users table
+
+        Return -> a token string
+        """
+        issued = time.time()
+        claims = TokenClaims(user.user_id, user.user_name, user.school_id, bool(user.admin), bool(user.moderator),
+                             issued, issued + self.lifetime, binascii.hexlify(os.urandom(8)).decode("ascii"))
+        payload = urlsafe_b64encode(json.dumps(list(claims)).encode("utf-8")).decode("ascii")
+        return "{}.{}".format(payload, self.signature(payload))
+
+    def signature(self, payload):
+        return hmac.new(self.secret, payload.encode("ascii"), hashlib.sha256).hexdigest()
+
+    def verify(self, token):
+        """
+        Checks a token's signature, expiry and revocation, without touching
+            the database
+
+        Return -> the TokenClaims of the token, or None if it isn't valid
+        """
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+        payload, signature = token.split(".")
+        try:
+            if not hmac.compare_digest(self.signature(payload), signature):
+                return None
+            claims = TokenClaims(*json.loads(urlsafe_b64decode(payload.encode("ascii")).decode("utf-8")))
+        except (ValueError, TypeError):
+            return None
+        if claims.expires <= time.time() or claims.token_id in self.revoked:
+            return None
+        if claims.issued <= self.revoked_users.get(claims.username, 0):
+            return None
+        return claims
+
+    def current(self, claims, user):
+        """
+        Checks that a token's roles still hold, given its user as they are now
+
+        Arguments:
+            claims -> the TokenClaims of the token
+            user   -> the user the token was issued to, a row of the users table
+
+        Return -> False if the user's roles have changed since the token was
+                  issued, by this process or another such as the admin command
+        """
+        return claims.issued > (user.roles_changed or 0)
+
+    def revoke(self, claims):
+        """
+        Revokes a single token, given its TokenClaims
+        """
+        self.prune()
+        self.revoked[claims.token_id] = claims.expires
+
+    def revoke_user(self, username):
+        """
+        Revokes every token issued to a user until now
+        """
+        self.prune()
+        self.revoked_users[username] = time.time()
+
+    def prune(self):
+        """
+        Forgets the revocations of tokens that have expired anyway
+        """
+        now = time.time()
+        for token_id, expires in list(self.revoked.items()):
+            if expires <= now:
+                del self.revoked[token_id]
+        for username, revoked in list(self.revoked_users.items()):
+            if revoked + self.lifetime <= now:
+                del self.revoked_users[username]
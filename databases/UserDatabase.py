@@ -45,8 +45,10 @@ class UserDatabase(object):
             # status
             admin = Column(sqlalchemy.Boolean, default=False, nullable=False)
             moderator = Column(sqlalchemy.Boolean, default=False, nullable=False)
+            # when admin or moderator last changed, tokens issued before then are refused (see TokenSigner.current)
+            roles_changed = Column(sqlalchemy.Float, default=0, server_default="0", nullable=False)
             # relations
-            school_id = Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("schools.school_id"))
+            school_id = Column(sqlalchemy.Integer, sqlalchemy.ForeignKey("schools.school_id"), index=True)
             # ratings = sqlalchemy.orm.relationship(rating_, backref="user", cascade="all, delete, delete-orphan")
             # there seem to be errors thrown when I include that line, I have absolutely no idea why, and
             # everything works fine without it.  Strange
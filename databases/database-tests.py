@@ -1,9 +1,19 @@
 
 import unittest
+import base64
+import collections
+import json
 import os
+import threading
+import time
 import database
+import Exporter
+import PasswordHasher
+import TokenSigner
 import sqlalchemy.ext
+import sqlalchemy.event
 import scrypt
+from tornado.testing import AsyncTestCase, gen_test
 
 
 
@@ -121,6 +131,10 @@ class DatabaseTests(unittest.TestCase):
             self.assertFalse(self.db.rating_exists(session, "nonexistant user", "CS50", professor="Malan", year=2012, semester=database.Semesters.Fall.value))
             self.assertFalse(self.db.rating_exists(session, "jmorton", "fake course"))
             self.assertFalse(self.db.rating_exists(session, "jmorton", "CS50", professor="Malan", year=2012, semester=database.Semesters.Fall.value))
+            #CS1301 is offered in several terms, so naming it alone doesn't say which one is meant
+            self.assertFalse(self.db.rating_exists(session, "jmorton", "CS1301"))
+            self.assertRaises(database.ItemDoesNotExistError, self.db.add_rating, session, "jmorton", "CS1301", rating=5)
+            self.assertRaises(database.ItemDoesNotExistError, self.db.remove_rating, session, "jmorton", "CS1301", year=2013)
 
         with self.db.session_scope() as session:
             #adding a rating fails by throwing an error if school & user do not "match"
@@ -190,6 +204,460 @@ class DatabaseTests(unittest.TestCase):
     def test_08_misc(self):
         pass
 
+    def count_queries(self, session, method, *args, **kwargs):
+        """
+        runs a Database method and flushes its session, returning the number of statements sent to the database
+        """
+        session.flush()
+        statements = []
+        def count(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(self.db.engine, "before_cursor_execute", count)
+        try:
+            method(session, *args, **kwargs)
+            session.flush()
+        finally:
+            sqlalchemy.event.remove(self.db.engine, "before_cursor_execute", count)
+        return len(statements)
+
+    def test_09_round_trips(self):
+        #each write is a single lookup and a single write
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Round Trip University", "RTU")
+        with self.db.session_scope() as session:
+            self.assertLessEqual(self.count_queries(session, self.db.add_user, "roundtrip", "rt@rtu.edu", "password", "RTU", hashed=("salt", b"hash")), 2)
+            self.assertLessEqual(self.count_queries(session, self.db.add_course, "RTU", "Round Trips", "RT1001", professor="Trip", year=2014, semester=database.Semesters.Fall.value), 2)
+            self.assertLessEqual(self.count_queries(session, self.db.add_rating, "roundtrip", "RT1001", semester=database.Semesters.Fall.value, year=2014, professor="Trip", rating=4, grade=4, difficulty=4), 2)
+            self.assertLessEqual(self.count_queries(session, self.db.update_rating, "roundtrip", "RT1001", oldsem=database.Semesters.Fall.value, oldyear=2014, oldprof="Trip", rating=2), 2)
+            self.assertLessEqual(self.count_queries(session, self.db.remove_rating, "roundtrip", "RT1001", semester=database.Semesters.Fall.value, year=2014, professor="Trip"), 2)
+
+        with self.db.session_scope() as session:
+            #and they still do the right thing
+            self.assertFalse(self.db.rating_exists(session, "roundtrip", "RT1001"))
+            self.assertTrue(self.db.course_exists(session, school="RTU", coursename="RT1001"))
+            self.assertEqual(self.db.fetch_user_by_name(session, "roundtrip").school_id, self.db.fetch_school_by_name(session, "RTU").school_id)
+            self.assertFalse(self.db.add_course(session, "RTU", "Round Trips", "RT1001", professor="Trip", year=2014, semester=database.Semesters.Fall.value))
+            self.assertTrue(self.db.add_rating(session, "roundtrip", "RT1001", rating=5))
+            self.assertFalse(self.db.add_rating(session, "roundtrip", "RT1001", rating=5))
+            self.assertRaises(database.ItemDoesNotExistError, self.db.add_rating, session, "roundtrip", "CS50")
+            self.assertRaises(database.ItemDoesNotExistError, self.db.add_rating, session, "nobody", "RT1001")
+
+    def query_plan(self, session, query):
+        """
+        sqlite's plan for a query, as a single string
+        """
+        return " ".join(str(step[-1]) for step in session.execute("EXPLAIN QUERY PLAN " + query))
+
+    def indexes(self, table):
+        """
+        map(name->tuple(columns, unique)) of the indexes the database has on a table
+        """
+        return {index["name"]: (tuple(index["column_names"]), bool(index["unique"])) for index in sqlalchemy.inspect(self.db.engine).get_indexes(table)}
+
+    def test_10_indexes(self):
+        #every fetch path has an index, whatever the database
+        self.assertEqual(self.indexes("schools")["ix_schools_school_short"], (("school_short",), True))
+        self.assertEqual(self.indexes("users")["ix_users_school_id"], (("school_id",), False))
+        self.assertEqual(self.indexes("courses")["uq_courses_offering"], (("school_id", "identifier", "professor", "year", "semester"), True))
+        self.assertEqual(self.indexes("ratings")["ix_ratings_course_id"], (("course_id",), False))
+        if self.db.engine.name == "sqlite":
+            #and sqlite's planner uses them
+            with self.db.session_scope() as session:
+                self.assertIn("ix_schools_school_short", self.query_plan(session, "SELECT * FROM schools WHERE school_short = 'RTU'"))
+                self.assertIn("uq_courses_offering", self.query_plan(session, "SELECT * FROM courses WHERE school_id = 1 AND identifier = 'CS1301'"))
+
+        #an existing database missing an index gets it back from a migration
+        with self.db.session_scope() as session:
+            session.execute("DROP INDEX ix_ratings_course_id")
+        self.assertNotIn("ix_ratings_course_id", self.indexes("ratings"))
+        self.assertEqual(self.db.migrate(), ["ix_ratings_course_id"])
+        self.assertEqual(self.db.migrate(), [])
+        self.assertIn("ix_ratings_course_id", self.indexes("ratings"))
+
+        #unless rows already there break a unique index, which is reported before anything is created
+        with self.db.session_scope() as session:
+            session.execute("DROP INDEX ix_ratings_course_id")
+            session.execute("DROP INDEX uq_courses_offering")
+        with self.db.session_scope() as session:
+            school_id = self.db.fetch_school_by_name(session, "RTU").school_id
+            for name in ("Duplicates", "Duplicates Again"):
+                session.add(self.db.course(course_name=name, school_id=school_id, identifier="DUP1001", professor="Twice", year=2014, semester=database.Semesters.Fall.value))
+            #which nulls never do
+            for name in ("Nulls", "Nulls Again"):
+                session.add(self.db.course(course_name=name, school_id=school_id, identifier="NUL1001"))
+        with self.assertRaises(database.DuplicateRowsError) as raised:
+            self.db.migrate()
+        self.assertEqual(raised.exception.duplicates, {"uq_courses_offering": [((school_id, "DUP1001", "Twice", 2014, database.Semesters.Fall.value), 2)]})
+        self.assertNotIn("ix_ratings_course_id", self.indexes("ratings"))
+        with self.db.session_scope() as session:
+            session.query(self.db.course).filter_by(course_name="Duplicates Again").delete()
+        self.assertEqual(self.db.migrate(), ["uq_courses_offering", "ix_ratings_course_id"])
+
+    def test_11_user_cache(self):
+        #a signed in user is fetched once, and then read from the cache
+        user = self.db.current_user("roundtrip")
+        statements = []
+        def count(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(self.db.engine, "before_cursor_execute", count)
+        try:
+            self.assertIs(self.db.current_user("roundtrip"), user)
+        finally:
+            sqlalchemy.event.remove(self.db.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])
+
+        #a change that is rolled back leaves it cached
+        try:
+            with self.db.session_scope() as session:
+                self.db.update_user(session, "roundtrip", first="Rolled")
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertIs(self.db.cached_user("roundtrip"), user)
+
+        #a committed change drops it
+        with self.db.session_scope() as session:
+            self.db.update_user(session, "roundtrip", first="Round")
+        self.assertIsNone(self.db.cached_user("roundtrip"))
+        self.assertEqual(self.db.current_user("roundtrip").first_name, "Round")
+
+        #as does time
+        self.db.user_ttl = 0
+        self.db.user_cache.clear()
+        self.db.current_user("roundtrip")
+        self.assertIsNone(self.db.cached_user("roundtrip"))
+
+    def test_12_revisions(self):
+        #a school has its revision row from the start, so its first rating only has to bump it
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Revision Institute", "RI")
+        with self.db.session_scope() as session:
+            school_id = self.db.fetch_school_by_name(session, "RI").school_id
+            self.assertEqual(session.query(self.db.revision).filter(self.db.revision.school_id == school_id).count(), 1)
+            self.assertEqual(self.db.fetch_revision(session, school_id), 0)
+            self.db.add_user(session, "reviser", "r@ri.edu", "password", "RI", hashed=("salt", b"hash"))
+            self.db.add_course(session, "RI", "Revisions", "RI1001")
+        with self.db.session_scope() as session:
+            self.db.add_rating(session, "reviser", "RI1001", rating=3)
+        with self.db.session_scope() as session:
+            self.assertEqual(self.db.fetch_revision(session, school_id), 1)
+
+        #and a school added before the revisions table gets its row from a migration
+        with self.db.session_scope() as session:
+            session.query(self.db.revision).filter(self.db.revision.school_id == school_id).delete(synchronize_session=False)
+        self.db.migrate()
+        with self.db.session_scope() as session:
+            self.assertEqual(session.query(self.db.revision).filter(self.db.revision.school_id == school_id).count(), 1)
+            self.assertEqual(self.db.fetch_revision(session, school_id), 0)
+
+    def test_13_bulk_add_ratings(self):
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Bulk University", "BU")
+            for name in ("bulk1", "bulk2"):
+                self.db.add_user(session, name, name + "@bu.edu", "password", "BU", hashed=("salt", b"hash"))
+            for course in ("BU1001", "BU1002", "BU1003"):
+                self.db.add_course(session, "BU", "Bulk", course)
+            #one course in two terms, which is only found when the term is given
+            self.db.add_course(session, "BU", "Bulk", "BU2001", year=2013, semester=database.Semesters.Fall.value)
+            self.db.add_course(session, "BU", "Bulk", "BU2001", year=2013, semester=database.Semesters.Spring.value)
+            self.db.add_rating(session, "bulk2", "BU1003", rating=1)
+        changes = []
+        self.db.add_listener(changes.extend)
+
+        #three to a chunk, so the duplicates of earlier rows are in the same chunk and in later ones
+        rows = [dict(username="bulk1", coursename="BU1001", rating="4", grade="", difficulty="2"),
+                dict(username="bulk1", coursename="BU1001", rating="5"),  # a duplicate in the same chunk
+                dict(username="nobody", coursename="BU1001", rating="3"),  # an unknown user
+                dict(username="bulk1", coursename="BU1002", rating="3", grade="4"),
+                dict(username="bulk1", coursename="BU9999", rating="3"),  # an unknown course
+                dict(username="bulk2", coursename="BU1003", rating="5"),  # rated before the import
+                dict(username="bulk2", coursename="BU2001", rating="2"),  # an ambiguous course
+                dict(username="bulk1", coursename="BU1001", rating="1"),  # a duplicate in a later chunk
+                dict(username="bulk2", coursename="BU2001", year="2013", semester=database.Semesters.Spring.value, rating="2"),
+                dict(username="bulk2", coursename="BU1001")]
+        with self.db.session_scope() as session:
+            self.assertEqual(self.db.bulk_add_ratings(session, iter(rows), chunk=3), (4, 6))
+
+        with self.db.session_scope() as session:
+            rating = self.db.fetch_rating_by_name(session, "bulk1", "BU1001")
+            self.assertEqual((rating.rating, rating.grade, rating.difficulty), (4, None, 2))
+            self.assertEqual(self.db.fetch_rating_by_name(session, "bulk2", "BU1003").rating, 1)
+            self.assertTrue(self.db.rating_exists(session, "bulk2", "BU2001", year=2013, semester=database.Semesters.Spring.value))
+            self.assertFalse(self.db.rating_exists(session, "bulk2", "BU2001", year=2013, semester=database.Semesters.Fall.value))
+            school_id = self.db.fetch_school_by_name(session, "BU").school_id
+            bulk1 = self.db.fetch_user_by_name(session, "bulk1").user_id
+
+        #every added rating is published once the import commits, all at the revision it brought the school to
+        self.assertEqual(len(changes), 4)
+        self.assertEqual({(change.school_id, change.old, change.revision) for change in changes}, {(school_id, None, 2)})
+        self.assertEqual([change.new for change in changes if change.user_id == bulk1], [(4, None, 2), (3, 4, None)])
+
+    def summary(self, short):
+        """
+        the cached SchoolSummary of the school with the given identifier
+        """
+        return next(summary for summary in self.db.school_summaries() if summary.school_short == short)
+
+    def test_14_school_summaries(self):
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Summary College", "SC")
+            self.db.add_school(session, "Empty College", "EC")
+            for name in ("summer", "winter"):
+                self.db.add_user(session, name, name + "@sc.edu", "password", "SC", hashed=("salt", b"hash"))
+            self.db.add_course(session, "SC", "Sums", "SC1001")
+            self.db.add_course(session, "SC", "Means", "SC1002")
+            self.db.add_rating(session, "summer", "SC1001", rating=4)
+            self.db.add_rating(session, "summer", "SC1002", rating=2)
+            self.db.add_rating(session, "winter", "SC1001", rating=3)
+
+        #the students, courses and ratings of each school are counted and its ratings averaged
+        summary = self.summary("SC")
+        self.assertEqual((summary.school_name, summary.numstudents, summary.numcourses, summary.numratings), ("Summary College", 2, 2, 3))
+        self.assertAlmostEqual(summary.mean_rating, 3.0)
+        self.assertEqual(tuple(self.summary("EC"))[3:], (0, 0, 0, None))
+
+        #and then read from the cache, without a query
+        summaries = self.db.school_summaries()
+        statements = []
+        def count(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sqlalchemy.event.listen(self.db.engine, "before_cursor_execute", count)
+        try:
+            self.assertIs(self.db.school_summaries(), summaries)
+        finally:
+            sqlalchemy.event.remove(self.db.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])
+
+        #a change that is rolled back leaves them cached
+        try:
+            with self.db.session_scope() as session:
+                self.db.add_course(session, "SC", "Rollbacks", "SC1003")
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertIs(self.db.school_summaries(), summaries)
+        self.assertEqual(self.summary("SC").numcourses, 2)
+
+        #a committed change drops them
+        with self.db.session_scope() as session:
+            self.db.update_rating(session, "winter", "SC1001", rating=5)
+        self.assertIsNone(self.db.summaries)
+        summary = self.summary("SC")
+        self.assertEqual(summary.numratings, 3)
+        self.assertAlmostEqual(summary.mean_rating, 11 / 3)
+        self.assertIsNot(self.db.school_summaries(), summaries)
+
+        #and counting them in a session with changes that may not commit doesn't cache them
+        self.db.summaries = None
+        try:
+            with self.db.session_scope() as session:
+                self.db.add_course(session, "SC", "Rollbacks", "SC1003")
+                self.assertEqual(next(summary for summary in self.db.school_summaries(session) if summary.school_short == "SC").numcourses, 3)
+                self.assertIsNone(self.db.summaries)
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(self.summary("SC").numcourses, 2)
+
+    def profile_queries(self, method, *args):
+        """
+        the number of statements a query profile sends, reading the rated courses of a dashboard as its template does
+        """
+        def profile(session, *args):
+            for course in method(session, *args).get("your_courses", []):
+                course.course_name
+        with self.db.session_scope() as session:
+            self.db.summaries = None
+            return self.count_queries(session, profile, *args)
+
+    def test_15_query_profiles(self):
+        with self.db.session_scope() as session:
+            for short, users, courses in (("P1", 1, 1), ("PN", 6, 8)):
+                self.db.add_school(session, "Profile " + short, short)
+                for user in range(users):
+                    self.db.add_user(session, short + str(user), short + str(user) + "@profile.edu", "password", short, hashed=("salt", b"hash"))
+                for course in range(courses):
+                    self.db.add_course(session, short, "Profiles", short + str(1000 + course))
+                    for user in range(users):
+                        self.db.add_rating(session, short + str(user), short + str(1000 + course), rating=course % 5 + 1)
+        with self.db.session_scope() as session:
+            one, many = (self.db.fetch_school_by_name(session, short).school_id for short in ("P1", "PN"))
+            one_user, many_user = (self.db.fetch_user_by_name(session, name).user_id for name in ("P10", "PN0"))
+
+        #the dashboard and roster take as many statements for one course as for many
+        self.assertLessEqual(self.profile_queries(self.db.fetch_dashboard, one_user, one), 2)
+        self.assertEqual(self.profile_queries(self.db.fetch_dashboard, one_user, one), self.profile_queries(self.db.fetch_dashboard, many_user, many))
+        self.assertLessEqual(self.profile_queries(self.db.fetch_roster, one), 2)
+        self.assertEqual(self.profile_queries(self.db.fetch_roster, one), self.profile_queries(self.db.fetch_roster, many))
+
+        #and the admin panel as many for one more school as for many more
+        summary = self.profile_queries(self.db.fetch_admin_summary)
+        self.assertLessEqual(summary, 2)
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Profile Extra", "PX")
+        self.assertEqual(self.profile_queries(self.db.fetch_admin_summary), summary)
+        with self.db.session_scope() as session:
+            for school in range(5):
+                self.db.add_school(session, "Profile Extra " + str(school), "PX" + str(school))
+        self.assertEqual(self.profile_queries(self.db.fetch_admin_summary), summary)
+
+    def test_16_roles_changed(self):
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Roles University", "RU")
+            self.db.add_user(session, "roles", "roles@ru.edu", "password", "RU", hashed=("salt", b"hash"))
+        self.assertEqual(self.db.current_user("roles").roles_changed, 0)
+
+        #every way of changing a role stamps when it changed, and drops the cached user
+        before = time.time()
+        with self.db.session_scope() as session:
+            self.db.update_user(session, "roles", admin=True, mod=True)
+        user = self.db.current_user("roles")
+        self.assertTrue(user.admin and user.moderator)
+        self.assertGreaterEqual(user.roles_changed, before)
+        stamped = user.roles_changed
+        with self.db.session_scope() as session:
+            self.db.toggle_role(session, self.db.fetch_user_by_name(session, "roles"), "moderator")
+        user = self.db.current_user("roles")
+        self.assertFalse(user.moderator)
+        self.assertGreaterEqual(user.roles_changed, stamped)
+
+        #a database from before the column gets it from a migration, with nothing changed yet
+        with self.db.session_scope() as session:
+            session.execute("ALTER TABLE users DROP COLUMN roles_changed")
+        self.assertEqual(self.db.migrate(), ["users.roles_changed"])
+        with self.db.session_scope() as session:
+            self.assertEqual(self.db.fetch_user_by_name(session, "roles").roles_changed, 0)
+
+    def test_17_export_pages(self):
+        with self.db.session_scope() as session:
+            self.db.add_school(session, "Export College", "XC")
+            for user in range(3):
+                self.db.add_user(session, "exporter" + str(user), "exporter" + str(user) + "@xc.edu", "password", "XC", hashed=("salt", b"hash"))
+            for course in range(4):
+                self.db.add_course(session, "XC", "Exports", "XC" + str(1000 + course))
+            for user in range(3):
+                for course in range(4 - user):
+                    self.db.add_rating(session, "exporter" + str(user), "XC" + str(1000 + course), rating=course + 1)
+        exporter = Exporter.Exporter(self.db)
+        with self.db.session_scope() as session:
+            school_id = self.db.fetch_school_by_name(session, "XC").school_id
+            for table in Exporter.Exporter.tables:
+                for school in (school_id, None):
+                    rows = list(exporter.rows(session, table, school))
+                    #pages of any size, breaking inside a user's ratings or not, read every row once and in order
+                    for limit in (1, 2, 3, 7, len(rows) + 1):
+                        paged, after = [], None
+                        while True:
+                            page = exporter.page(session, table, school, after, limit)
+                            if not page:
+                                break
+                            self.assertLessEqual(len(page), limit)
+                            paged.extend(page)
+                            after = exporter.key(table, page[-1])
+                        self.assertEqual(paged, rows)
+            self.assertEqual(len(list(exporter.rows(session, "ratings", school_id))), 9)
+            self.assertEqual({row[2] for row in exporter.rows(session, "users", school_id)}, {school_id})
+
+class PasswordHasherTests(AsyncTestCase):
+
+    def setUp(self):
+        super(PasswordHasherTests, self).setUp()
+        self.hasher = PasswordHasher.PasswordHasher(64, workers=1, limit=2)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.hasher.executor.shutdown(wait=True)
+        super(PasswordHasherTests, self).tearDown()
+
+    @gen_test
+    def test_01_busy(self):
+        #with its only worker held up, the hasher takes limit hashes and turns the rest away straight away
+        self.hasher.executor.submit(self.release.wait, 5)
+        waiting = [self.hasher.hash("password", "salt", "login"), self.hasher.new_hash("password", "register")]
+        self.assertEqual(self.hasher.pending, 2)
+        self.assertRaises(PasswordHasher.HasherBusyError, self.hasher.hash, "password", "salt", "login")
+        self.assertRaises(PasswordHasher.HasherBusyError, self.hasher.verify, "password", "salt", "hash", "login")
+        self.assertEqual(self.hasher.stats(), dict(pending=2, rejected=2))
+
+        #the hashes it took are answered once the worker is free, and then it takes more
+        self.release.set()
+        hashed, (salt, new) = yield waiting
+        self.assertEqual(hashed, PasswordHasher.hash_password("password", "salt", 64))
+        self.assertEqual(new, PasswordHasher.hash_password("password", salt, 64))
+        self.assertTrue((yield self.hasher.verify("password", "salt", hashed, "login")))
+        self.assertFalse((yield self.hasher.verify("wrong", "salt", hashed.decode("utf-8"), "login")))
+        stats = self.hasher.stats()
+        self.assertEqual((stats["pending"], stats["rejected"], stats["login"]["count"], stats["register"]["count"]), (0, 2, 3, 1))
+
+class TokenSignerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = TokenSigner.TokenSigner("secret", lifetime=60)
+        self.user = collections.namedtuple("User", ["user_id", "user_name", "school_id", "admin", "moderator", "roles_changed"])(7, "jmorton", 1, False, True, 0)
+
+    def test_01_claims(self):
+        claims = self.signer.verify(self.signer.issue(self.user))
+        self.assertEqual((claims.user_id, claims.username, claims.school_id, claims.admin, claims.moderator), (7, "jmorton", 1, False, True))
+        #a token signed with another secret, or that isn't a token at all, is refused
+        self.assertIsNone(TokenSigner.TokenSigner("other").verify(self.signer.issue(self.user)))
+        for token in (None, "", "nonsense", "a.b.c", "!!!.abc"):
+            self.assertIsNone(self.signer.verify(token))
+
+    def test_02_tampering(self):
+        token = self.signer.issue(self.user)
+        payload, signature = token.split(".")
+        #a payload claiming to be an admin keeps the original signature
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode("ascii")).decode("utf-8"))
+        claims[3] = True
+        forged = base64.urlsafe_b64encode(json.dumps(claims).encode("utf-8")).decode("ascii")
+        self.assertIsNone(self.signer.verify("{}.{}".format(forged, signature)))
+        #as does a changed signature
+        flipped = ("0" if signature[-1] != "0" else "1")
+        self.assertIsNone(self.signer.verify("{}.{}".format(payload, signature[:-1] + flipped)))
+        self.assertIsNotNone(self.signer.verify(token))
+
+    def test_03_expiry(self):
+        self.signer.lifetime = -1
+        self.assertIsNone(self.signer.verify(self.signer.issue(self.user)))
+
+    def test_04_revoke(self):
+        first, second = self.signer.issue(self.user), self.signer.issue(self.user)
+        self.signer.revoke(self.signer.verify(first))
+        self.assertIsNone(self.signer.verify(first))
+        self.assertIsNotNone(self.signer.verify(second))
+
+    def test_05_revoke_user(self):
+        other = self.user._replace(user_id=8, user_name="other")
+        old, others = self.signer.issue(self.user), self.signer.issue(other)
+        self.signer.revoke_user("jmorton")
+        self.assertIsNone(self.signer.verify(old))
+        self.assertIsNotNone(self.signer.verify(others))
+        #tokens issued afterwards are good
+        time.sleep(0.01)
+        self.assertIsNotNone(self.signer.verify(self.signer.issue(self.user)))
+
+    def test_06_prune(self):
+        claims = self.signer.verify(self.signer.issue(self.user))
+        self.signer.revoke(claims)
+        self.signer.revoke_user("jmorton")
+        self.signer.prune()
+        self.assertIn(claims.token_id, self.signer.revoked)
+        self.assertIn("jmorton", self.signer.revoked_users)
+        #once the tokens they cover have expired, revocations are forgotten
+        self.signer.revoked[claims.token_id] = time.time() - 1
+        self.signer.revoked_users["jmorton"] = time.time() - self.signer.lifetime - 1
+        self.signer.prune()
+        self.assertEqual(self.signer.revoked, {})
+        self.assertEqual(self.signer.revoked_users, {})
+
+    def test_07_current(self):
+        claims = self.signer.verify(self.signer.issue(self.user))
+        self.assertTrue(self.signer.current(claims, self.user))
+        #a role change persisted by any process, after the token was issued, makes its roles stale
+        self.assertFalse(self.signer.current(claims, self.user._replace(admin=True, roles_changed=time.time())))
+        self.assertTrue(self.signer.current(claims, self.user._replace(roles_changed=claims.issued - 1)))
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
 
@@ -8,18 +8,22 @@ Now with more DRY!
 
 from enum import Enum
 from contextlib import contextmanager
+from collections import namedtuple
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 from . import UserDatabase
 from . import CourseDatabase
 from . import RatingDatabase
 from . import SchoolDatabase
-import time  # for creating hash salts
-import scrypt  # for hashing passwords
+from . import RevisionDatabase
+from .PasswordHasher import hash_password, new_salt
 import hashlib
+import itertools
 import os
-from  base64 import b64encode
+import threading
+import time
 
 
 class Database(object):
@@ -32,10 +36,17 @@ class Database(object):
         rating -- the table of ratings (many to many link between course and user)
         user -- the table of users
         school -- the table of school (one to many with user and course)
+        revision -- the table of rating change counters, one per school
         sessionmaker -- a factory for sessions, can be used by external tools to make specialized database queries
+        listeners -- callables notified with a list of RatingChanges whenever a transaction that changed ratings commits
+        summaries -- the cached list of SchoolSummaries, None when a commit has changed them (see school_summaries)
+        user_cache -- map(username->tuple(expiry time, user)) of the users recently signed in (see current_user)
+        user_ttl -- the number of seconds a user is cached for
+        local -- per thread state, local.deferred collects the changes committed by a thread that must not call the
+                 listeners itself (see AsyncDatabase)
     """
 
-    def __init__(self, name="ClassRank.db", folder="data", hashlength=64):
+    def __init__(self, name="ClassRank.db", folder="data", hashlength=64, user_ttl=60):
         """
         initializes the database, creates tables and files as necessary
 
@@ -45,10 +56,13 @@ class Database(object):
             folder -- a relative path to the folder where the database should be stored
             uid -- the value under which the database stores the user's Primary Key, holdover can be safely ignored
             hashlength -- the length of password hashes
+            user_ttl -- the number of seconds current_user keeps a user before fetching it again
 
         The system defaults to name="ClassRank.db", table="main" folder="data", uid="user_id, and hashlength="64"
         """
-        self.engine = sqlalchemy.create_engine(os.environ['DATABASE_URL'])
+        # a request's session is used by whichever of the AsyncDatabase's threads runs each of its queries
+        connect_args = {"check_same_thread": False} if os.environ['DATABASE_URL'].startswith("sqlite") else {}
+        self.engine = sqlalchemy.create_engine(os.environ['DATABASE_URL'], connect_args=connect_args)
 
         self.hashlength = hashlength  # length of the scrypt password hash
         self.base = sqlalchemy.ext.declarative.declarative_base()
@@ -59,10 +73,23 @@ class Database(object):
         self.rating = RatingDatabase.RatingDatabase(self.base, self.course).create()
         self.user = UserDatabase.UserDatabase(self.base, self.hashlength, self.course, self.rating).create()
         self.school = SchoolDatabase.SchoolDatabase(self.base, self.course, self.user).create()
+        self.revision = RevisionDatabase.RevisionDatabase(self.base).create()
 
         self.metadata.create_all(self.engine)
         self.sessionmaker = sqlalchemy.orm.sessionmaker(bind=self.engine, expire_on_commit=False)
 
+        # rating changes are collected on the session and only published once they are committed
+        self.listeners = []
+        self.local = threading.local()
+        self.summaries = None
+        self.summaries_generation = 0
+        self.user_cache = {}
+        self.user_ttl = user_ttl
+        self.users_generation = 0
+        sqlalchemy.event.listen(self.sessionmaker, "before_commit", self._bump_revisions)
+        sqlalchemy.event.listen(self.sessionmaker, "after_commit", self._publish_changes)
+        sqlalchemy.event.listen(self.sessionmaker, "after_rollback", self._discard_changes)
+
         # on first run, create an admin account
         if len(self.schools) == 0:
             with self.session_scope() as session:
@@ -89,6 +116,142 @@ class Database(object):
         finally:
             session.close()
 
+    def migrate(self):
+        """
+        adds the columns and creates the indexes declared by the tables that an existing database does not have yet,
+        as create_all only adds them along with new tables, and gives the schools added before the revisions table
+        their revision row
+
+        returns the names of the columns (as table.column) and indexes created
+
+        raises DuplicateRowsError, before changing anything, if rows already in the database would break a unique index
+        that is missing
+        """
+        inspector = sqlalchemy.inspect(self.engine)
+        missing = [index for table in self.metadata.sorted_tables
+                   for index in table.indexes if index.name not in {index["name"] for index in inspector.get_indexes(table.name)}]
+        duplicates = {index.name: self.fetch_duplicates(index) for index in missing if index.unique}
+        duplicates = {name: rows for name, rows in duplicates.items() if rows}
+        if duplicates:
+            raise DuplicateRowsError(duplicates)
+        created = []
+        for table in self.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    # a column added to rows that already exist takes its server_default
+                    default = " DEFAULT {}".format(column.server_default.arg) if column.server_default is not None else ""
+                    with self.engine.begin() as connection:
+                        connection.execute("ALTER TABLE {} ADD COLUMN {} {}{}{}".format(table.name, column.name, column.type.compile(self.engine.dialect),
+                                                                                        default, "" if column.nullable else " NOT NULL"))
+                    created.append("{}.{}".format(table.name, column.name))
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing:
+                    index.create(self.engine)
+                    created.append(index.name)
+        with self.session_scope() as session:
+            seeded = session.query(self.revision.school_id)
+            for school_id, in session.query(self.school.school_id).filter(~self.school.school_id.in_(seeded)):
+                session.add(self.revision(school_id=school_id, revision=0))
+        return created
+
+    def fetch_duplicates(self, index):
+        """
+        the rows that would break a unique index if it were created, as a list of tuple(values of its columns, count)
+
+        rows with a null in any of the columns never clash, as nulls are distinct from each other in a unique index
+        """
+        columns = list(index.columns)
+        with self.session_scope() as session:
+            query = session.query(*(columns + [sqlalchemy.func.count()])).filter(*(column.isnot(None) for column in columns))
+            return [(tuple(row[:-1]), row[-1]) for row in query.group_by(*columns).having(sqlalchemy.func.count() > 1)]
+
+    def add_listener(self, listener):
+        """
+        registers a callable that is called with a list of RatingChanges after
+        every commit that added, changed or removed ratings
+        """
+        self.listeners.append(listener)
+
+    def _record_change(self, session, school_id, user_id, course_id, old, new):
+        """
+        remembers a change to a rating until the session commits, old and new
+        are (rating, grade, difficulty) tuples, or None when the rating does not
+        exist before or after the change
+        """
+        session.info.setdefault("rating_changes", []).append(RatingChange(school_id, user_id, course_id, old, new, None))
+        self._summaries_changed(session)
+
+    def _summaries_changed(self, session):
+        """
+        marks the session as changing what school_summaries counts, so the cache is dropped once it commits
+        """
+        session.info["summaries_changed"] = True
+
+    def forget_user(self, session, username):
+        """
+        marks the session as changing a user, so that user is dropped from the cache of current_user once it commits
+
+        update_user, update_password and remove_user do this themselves, code changing a user's columns directly must
+        """
+        session.info.setdefault("users_changed", set()).add(username)
+
+    def _bump_revisions(self, session):
+        """
+        increments the revision of every school whose ratings are changed by
+        the committing transaction, once per school, and stamps the changes
+        with the revision they bring their school to
+        """
+        changes = session.info.get("rating_changes", [])
+        revisions = {}
+        for school_id in {change.school_id for change in changes}:
+            bumped = session.query(self.revision).filter(self.revision.school_id == school_id).update({"revision": self.revision.revision + 1}, synchronize_session=False)
+            # every school gets its row when it is added (or migrated), as two first writes inserting it at once
+            # would have one fail on the primary key; this is only for a database that hasn't been migrated yet
+            if not bumped:
+                session.add(self.revision(school_id=school_id, revision=1))
+            revisions[school_id] = self.fetch_revision(session, school_id)
+        if changes:
+            session.info["rating_changes"] = [change._replace(revision=revisions[change.school_id]) for change in changes]
+
+    def fetch_revision(self, session, school_id):
+        """
+        the number of committed transactions that have changed the ratings of
+        students at a school
+        """
+        row = session.query(self.revision.revision).filter(self.revision.school_id == school_id).first()
+        return row[0] if row else 0
+
+    def publish(self, changes):
+        """
+        calls every listener with a list of committed RatingChanges
+        """
+        for listener in self.listeners:
+            listener(changes)
+
+    def _publish_changes(self, session):
+        if session.info.pop("summaries_changed", False):
+            self.summaries_generation += 1
+            self.summaries = None
+        forgotten = session.info.pop("users_changed", None)
+        if forgotten:
+            self.users_generation += 1
+            for username in forgotten:
+                self.user_cache.pop(username, None)
+        changes = session.info.pop("rating_changes", None)
+        if changes:
+            deferred = getattr(self.local, "deferred", None)
+            if deferred is not None:
+                deferred.append(changes)
+            else:
+                self.publish(changes)
+
+    def _discard_changes(self, session):
+        session.info.pop("rating_changes", None)
+        session.info.pop("summaries_changed", None)
+        session.info.pop("users_changed", None)
+
     # methods that do things!
     def fetch_school_by_name(self, session, school_name):  # done
         """
@@ -183,6 +346,13 @@ class Database(object):
         except sqlalchemy.orm.exc.NoResultFound:
             raise ItemDoesNotExistError(DatabaseObjects.Rating, str(userid)+" for "+str(courseid))
 
+    def fetch_school_ratings(self, session, school_id):
+        """
+        fetches (user_id, course_id, rating, grade, difficulty) tuples for every
+        rating made by a student of the given school
+        """
+        return session.query(self.rating.user_id, self.rating.course_id, self.rating.rating, self.rating.grade, self.rating.difficulty).join(self.user, self.user.user_id == self.rating.user_id).filter(self.user.school_id == school_id).all()
+
     def school_exists(self, session, school_name=None, school_id=None, school_short=None):  # done
         """
         """
@@ -239,72 +409,174 @@ class Database(object):
             return False
 
     def rating_exists(self, session, username, coursename, semester=None, year=None, professor=None):  # done
-        if self.user_exists(session, user_name=username):
-            user = self.fetch_user_by_name(session, username)
-            userid = user.user_id
-            schoolid = user.school_id
-            schoolname = self.fetch_school_by_id(session, schoolid).school_short
-        else:
-            return False
-        if self.course_exists(session, school_id=schoolid, coursename=coursename, semester=semester, year=year, professor=professor):
-            courseid = self.fetch_course_by_name(session, schoolname, coursename, semester=semester, year=year, professor=professor).course_id
-        else:
-            return False
         try:
-            self.fetch_rating_by_id(session, userid, courseid)
-            return True
+            found = self._find_rating(session, username, coursename, semester=semester, year=year, professor=professor)
         except ItemDoesNotExistError:
             return False
+        return found is not None and found.rated is not None
+
+    def _find_rating(self, session, username, coursename, semester=None, year=None, professor=None):
+        """
+        looks up a user, the course of that name at their school and the user's rating of it in a single query
+
+        returns a row of (user_id, school_id, course_id, rated, rating, grade, difficulty), where course_id is None
+        if the course does not exist and rated is None if the user has not rated it, or None if the user does not exist
+
+        raises ItemDoesNotExistError if the name and terms given match more than one course, such as a course offered
+        in several terms named without its term
+        """
+        course = [self.course.school_id == self.user.school_id, self.course.identifier == coursename]
+        if semester:
+            course.append(self.course.semester == semester)
+        if year:
+            course.append(self.course.year == year)
+        if professor:
+            course.append(self.course.professor == professor)
+        rating = [self.rating.user_id == self.user.user_id, self.rating.course_id == self.course.course_id]
+
+        query = session.query(self.user.user_id, self.user.school_id, self.course.course_id, self.rating.user_id.label("rated"),
+                              self.rating.rating, self.rating.grade, self.rating.difficulty).select_from(self.user)
+        query = query.outerjoin(self.course, sqlalchemy.and_(*course)).outerjoin(self.rating, sqlalchemy.and_(*rating))
+        try:
+            return query.filter(self.user.user_name == username).one()
+        except sqlalchemy.orm.exc.NoResultFound:
+            return None
+        except sqlalchemy.orm.exc.MultipleResultsFound:
+            raise ItemDoesNotExistError(DatabaseObjects.Course, coursename)
 
     def add_school(self, session, school_name, school_identifier):  # done
         if not self.school_exists(session, school_short=school_identifier):
-            session.add(self.school(school_name=school_name, school_short=school_identifier))
+            school = self.school(school_name=school_name, school_short=school_identifier)
+            session.add(school)
+            # its revision row exists from the start, so the commits that change its ratings only ever update it
+            session.flush()
+            session.add(self.revision(school_id=school.school_id, revision=0))
+            self._summaries_changed(session)
             return True
         return False
 
-    def add_user(self, session, username, email, password, school, first=None, last=None, admin=False, mod=False):  # done
-        if not self.user_exists(session, user_name=username):
-            salt = str(int(time.time()))
-            pwhash = b64encode(scrypt.hash(password, salt, self.hashlength))
+    def add_user(self, session, username, email, password, school, first=None, last=None, admin=False, mod=False, hashed=None):  # done
+        """
+        hashed is tuple(salt, hash) of the password if it has already been hashed, by PasswordHasher.new_hash
+        """
+        taken, schoolid = self.fetch_registration(session, username, school)
+        if not taken:
+            salt, pwhash = hashed or self.new_hash(password)
             apikey = hashlib.sha256(pwhash).hexdigest()
-            if self.school_exists(session, school_short=school):
-                schoolid = self.fetch_school_by_name(session, school).school_id
+            if schoolid is not None:
                 session.add(self.user(user_name=username, email_address=email, password_hash=pwhash, password_salt=salt, school_id=schoolid, first_name=first, last_name=last, admin=admin, moderator=mod, apikey=apikey))
+                self._summaries_changed(session)
                 return True
             return False
 
+    def fetch_registration(self, session, username, school):
+        """
+        Return -> tuple(whether the username is taken, the school_id of the
+                  school with the short name school or None), in one query
+        """
+        taken = session.query(self.user.user_id).filter(self.user.user_name == username).exists()
+        schoolid = session.query(self.school.school_id).filter(self.school.school_short == school).as_scalar()
+        return tuple(session.query(taken, schoolid).one())
+
     def add_course(self, session, school, coursename, identifier, professor=None, year=None, semester=None):  # done
-        if not self.course_exists(session, school=school, coursename=identifier, professor=professor, year=year, semester=semester):
-            if self.school_exists(session, school_short=school):
-                schoolid = self.fetch_school_by_name(session, school).school_id
+        # the id of the school and whether it already has the course, in one query
+        schoolid = session.query(self.school.school_id).filter(self.school.school_short == school).as_scalar()
+        query = {"identifier": identifier}
+        if semester:
+            query["semester"] = semester
+        if year:
+            query["year"] = year
+        if professor:
+            query["professor"] = professor
+        exists = session.query(self.course.course_id).filter_by(**query).filter(self.course.school_id == schoolid).exists()
+        schoolid, exists = session.query(schoolid, exists).one()
+        if not exists:
+            if schoolid is not None:
                 session.add(self.course(course_name=coursename, school_id=schoolid, identifier=identifier, professor=professor, year=year, semester=semester))
+                self._summaries_changed(session)
                 return True
         return False
 
     def add_rating(self, session, username, coursename, semester=None, year=None, professor=None, rating=None, grade=None, difficulty=None):  # done
-        if not self.rating_exists(session, username, coursename, semester=semester, year=year, professor=professor):
-            user = self.fetch_user_by_name(session, username)
-            userid = user.user_id
-            schoolname = self.fetch_school_by_id(session, user.school_id).school_short
-            courseid = self.fetch_course_by_name(session, schoolname, coursename, semester=semester, year=year, professor=professor).course_id
-            session.add(self.rating(user_id=userid, course_id=courseid, semester=semester, year=year, professor=professor, rating=rating, grade=grade, difficulty=difficulty))
+        found = self._find_rating(session, username, coursename, semester=semester, year=year, professor=professor)
+        if found is None:
+            raise ItemDoesNotExistError(DatabaseObjects.User, username)
+        if found.course_id is None:
+            raise ItemDoesNotExistError(DatabaseObjects.Course, coursename)
+        if found.rated is None:
+            session.add(self.rating(user_id=found.user_id, course_id=found.course_id, semester=semester, year=year, professor=professor, rating=rating, grade=grade, difficulty=difficulty))
+            self._record_change(session, found.school_id, found.user_id, found.course_id, None, (rating, grade, difficulty))
 
             return True
         return False
 
+    def bulk_add_ratings(self, session, ratings, chunk=500):
+        """
+        adds many ratings at once, for importing the ratings of a school
+
+        ratings is an iterable of dicts with the keyword arguments of add_rating (username, coursename, and optionally
+        semester, year, professor, rating, grade and difficulty), read lazily a chunk at a time.  each chunk takes one
+        query for its users, one for their courses, one for their existing ratings and a single executemany insert.
+        ratings of unknown users or courses, or that already exist, are skipped as add_rating would refuse them
+
+        returns tuple(the number of ratings added, the number skipped)
+        """
+        added = skipped = 0
+        ratings = iter(ratings)
+        while True:
+            rows = list(itertools.islice(ratings, chunk))
+            if not rows:
+                return added, skipped
+            inserted = self._bulk_add_chunk(session, rows)
+            added += inserted
+            skipped += len(rows) - inserted
+
+    def _bulk_add_chunk(self, session, rows):
+        users = {user.user_name: user for user in session.query(self.user.user_id, self.user.user_name, self.user.school_id)
+                 .filter(self.user.user_name.in_({row["username"] for row in rows}))}
+        courses = {}
+        if users:
+            for course in session.query(self.course.course_id, self.course.school_id, self.course.identifier, self.course.semester, self.course.year, self.course.professor)\
+                    .filter(self.course.school_id.in_({user.school_id for user in users.values()}), self.course.identifier.in_({row["coursename"] for row in rows})):
+                courses.setdefault((course.school_id, course.identifier), []).append(course)
+        rated = {(rating.user_id, rating.course_id) for rating in session.query(self.rating.user_id, self.rating.course_id)
+                 .filter(self.rating.user_id.in_({user.user_id for user in users.values()}))} if users else set()
+
+        inserts = []
+        for row in rows:
+            user = users.get(row["username"])
+            if user is None:
+                continue
+            semester, year, professor = row.get("semester") or None, _integer(row.get("year")), row.get("professor") or None
+            # a course matches as in fetch_course_by_name, on whichever of semester, year and professor are given
+            matches = [course for course in courses.get((user.school_id, row["coursename"]), [])
+                       if (not semester or course.semester == semester) and (not year or course.year == year) and (not professor or course.professor == professor)]
+            if len(matches) != 1 or (user.user_id, matches[0].course_id) in rated:
+                continue
+            courseid = matches[0].course_id
+            rated.add((user.user_id, courseid))
+            values = (_integer(row.get("rating")), _integer(row.get("grade")), _integer(row.get("difficulty")))
+            inserts.append(dict(user_id=user.user_id, course_id=courseid, semester=semester, year=year, professor=professor, rating=values[0], grade=values[1], difficulty=values[2]))
+            self._record_change(session, user.school_id, user.user_id, courseid, None, values)
+
+        if inserts:
+            session.execute(self.rating.__table__.insert(), inserts)
+        return len(inserts)
+
     def remove_rating(self, session, username, coursename, semester=None, year=None, professor=None):  # done, this can be made better
-        if self.rating_exists(session, username, coursename, semester=semester, year=year, professor=professor):
-            user = self.fetch_user_by_name(session, username)
-            userid = user.user_id
-            schoolid = user.school_id
-            schoolname = self.fetch_school_by_id(session, schoolid).school_short
-            courseid = self.fetch_course_by_name(session, schoolname, coursename=coursename, semester=semester, year=year, professor=professor).course_id
-            session.query(self.rating).filter(self.rating.user_id==userid, self.rating.course_id==courseid).delete()
+        found = self._find_rating(session, username, coursename, semester=semester, year=year, professor=professor)
+        if found is not None and found.rated is not None:
+            self._record_change(session, found.school_id, found.user_id, found.course_id, (found.rating, found.grade, found.difficulty), None)
+            session.query(self.rating).filter(self.rating.user_id==found.user_id, self.rating.course_id==found.course_id).delete()
 
     def remove_user(self, session, username):  # done
         if self.user_exists(session, username):
             user = session.query(self.user).filter(self.user.user_name==username).one()
+            for old in session.query(self.rating).filter(self.rating.user_id==user.user_id):
+                self._record_change(session, user.school_id, user.user_id, old.course_id, (old.rating, old.grade, old.difficulty), None)
             session.delete(user)
+            self._summaries_changed(session)
+            self.forget_user(session, username)
 
     # neither schools nor courses can be removed
 
@@ -324,9 +596,21 @@ class Database(object):
             if admin:
                 changes["admin"] = admin
             if mod:
-                changes["mod"] = mod
+                changes["moderator"] = mod
+            if admin or mod:
+                changes["roles_changed"] = time.time()
 
             session.query(self.user).filter(self.user.user_name==username).update(changes)
+            self.forget_user(session, username)
+
+    def toggle_role(self, session, user, role):
+        """
+        flips the "admin" or "moderator" role of a user, given the user, and stamps roles_changed so the tokens issued
+        to them until now are refused by every process (see TokenSigner.current)
+        """
+        setattr(user, role, not getattr(user, role))
+        user.roles_changed = time.time()
+        self.forget_user(session, user.user_name)
 
     def update_course(self, session, school, coursename, oldsem=None, oldyear=None, oldprof=None, identifier=None, semester=None, year=None, professor=None):  # done
         if self.course_exists(session, school=school, coursename=coursename, semester=oldsem, year=oldyear, professor=oldprof):
@@ -344,10 +628,11 @@ class Database(object):
             session.query(self.course).filter(self.course.course_id==courseid).update(changes)
 
     def update_rating(self, session, username, coursename, oldsem=None, oldyear=None, oldprof=None, semester=None, year=None, professor=None, rating=None, grade=None, difficulty=None):  # done
-        if self.rating_exists(session, username, coursename, semester=oldsem, year=oldyear, professor=oldprof):
-            rated = self.fetch_rating_by_name(session, username, coursename, semester=oldsem, year=oldyear, professor=oldprof)
-            userid = rated.user_id
-            courseid = rated.course_id
+        found = self._find_rating(session, username, coursename, semester=oldsem, year=oldyear, professor=oldprof)
+        if found is not None and found.rated is not None:
+            userid = found.user_id
+            courseid = found.course_id
+            old = (found.rating, found.grade, found.difficulty)
             changes = {}
             if semester:
                 changes["semester"] = semester
@@ -363,30 +648,147 @@ class Database(object):
                 changes["difficulty"] = difficulty
 
             session.query(self.rating).filter(self.rating.course_id==courseid, self.rating.user_id==userid).update(changes)
+            new = (changes.get("rating", old[0]), changes.get("grade", old[1]), changes.get("difficulty", old[2]))
+            self._record_change(session, found.school_id, userid, courseid, old, new)
 
 
     def fetch_students(self, session, school):
         """
+        all students of a school, given its id, in one query
         """
-        pass
+        return session.query(self.user).filter(self.user.school_id == school).all()
 
     def fetch_courses(self, session, user):
         """
+        all courses a user has rated, given their id, in one query
         """
-        pass
+        return [rating.course for rating in self.fetch_user_ratings(session, user)]
+
+    def fetch_user_ratings(self, session, user):
+        """
+        all ratings a user has made, given their id, with their courses loaded by the same query
+        """
+        return session.query(self.rating).options(sqlalchemy.orm.joinedload(self.rating.course)).filter(self.rating.user_id == user).all()
+
+    # query profiles, each loads everything a page shows in a fixed number of queries, however many rows there are,
+    # rather than leaving the template to lazy load relationships one object at a time
+
+    def fetch_dashboard(self, session, user, school):
+        """
+        the dashboard of a user at a school, given their ids, in two queries
+
+        returns a dict of school_courses (the courses at their school), your_courses (the courses they rated) and
+        your_ratings (map(course_id->their rating))
+        """
+        ratings = self.fetch_user_ratings(session, user)
+        school_courses = session.query(self.course).filter(self.course.school_id == school).all()
+        return dict(school_courses=school_courses, your_courses=[rating.course for rating in ratings], your_ratings={rating.course_id: rating for rating in ratings})
+
+    def fetch_roster(self, session, school):
+        """
+        the moderator panel of a school, given its id, in two queries
+
+        returns a dict of users (the students) and courses
+        """
+        return dict(users=self.fetch_students(session, school), courses=session.query(self.course).filter(self.course.school_id == school).all())
+
+    def fetch_admin_summary(self, session):
+        """
+        the admin panel, in at most two queries: the SchoolSummary of every school and every user
+
+        returns a dict of schools and users
+        """
+        return dict(schools=self.school_summaries(session), users=session.query(self.user).all())
+
+    def fetch_school_summaries(self, session):
+        """
+        counts the students, courses and ratings of every school and averages their ratings, in a single query
 
-    def update_password(self, session, username, new_password):
+        returns a list of SchoolSummary, ordered by school_id
         """
+        courses = session.query(sqlalchemy.func.count(self.course.course_id)).filter(self.course.school_id == self.school.school_id).correlate(self.school).as_scalar()
+        query = session.query(self.school.school_id, self.school.school_name, self.school.school_short,
+                              sqlalchemy.func.count(sqlalchemy.distinct(self.user.user_id)), courses,
+                              sqlalchemy.func.count(self.rating.user_id), sqlalchemy.func.avg(self.rating.rating))
+        query = query.outerjoin(self.user, self.user.school_id == self.school.school_id).outerjoin(self.rating, self.rating.user_id == self.user.user_id)
+        query = query.group_by(self.school.school_id, self.school.school_name, self.school.school_short).order_by(self.school.school_id)
+        return [SchoolSummary(school_id, name, short, students, courses, ratings, None if mean is None else float(mean))
+                for school_id, name, short, students, courses, ratings, mean in query]
+
+    def school_summaries(self, session=None):
+        """
+        the SchoolSummary of every school, from a cache that is dropped whenever a commit adds or removes a school,
+        user, course or rating
+
+        session is used to fill the cache, a session of its own if None
+        """
+        summaries = self.summaries
+        if summaries is None:
+            generation = self.summaries_generation
+            if session is None:
+                with self.session_scope() as session:
+                    summaries = self.fetch_school_summaries(session)
+            else:
+                summaries = self.fetch_school_summaries(session)
+            # unless a commit has changed them while they were counted, or the session has changes that may not commit
+            if generation == self.summaries_generation and not session.info.get("summaries_changed"):
+                self.summaries = summaries
+        return summaries
+
+    def cached_user(self, username):
+        """
+        the user signed in as username from the cache of current_user, without touching the database
+
+        returns None if the user is not cached, or has been for longer than user_ttl
+        """
+        cached = self.user_cache.get(username)
+        if cached is not None:
+            expiry, user = cached
+            if expiry > time.time():
+                return user
+            self.user_cache.pop(username, None)
+        return None
+
+    def current_user(self, username):
+        """
+        the user signed in as username, for resolving the user of a request
+
+        the user is fetched in a session of its own and kept for user_ttl seconds, or until a commit changes it (see
+        forget_user), so it comes back detached: its columns can be read, but it must not be changed or have its
+        relationships loaded, fetch it by name in a session for that
+        """
+        user = self.cached_user(username)
+        if user is None:
+            generation = self.users_generation
+            with self.session_scope() as session:
+                user = self.fetch_user_by_name(session, username)
+            # unless a commit has changed a user while this one was fetched
+            if generation == self.users_generation:
+                self.user_cache[username] = (time.time() + self.user_ttl, user)
+        return user
+
+    def update_password(self, session, username, new_password, hashed=None):
+        """
+        hashed is tuple(salt, hash) of the new password if it has already been hashed, by PasswordHasher.new_hash
         """
         if self.user_exists(session, user_name=username):
             user = self.fetch_user_by_name(session, username)
-            newsalt = str(int(time.time()))
-            newhash = b64encode(scrypt.hash(new_password, newsalt, self.hashlength))
+            newsalt, newhash = hashed or self.new_hash(new_password)
             user.password_hash = newhash
             user.password_salt = newsalt
+            self.forget_user(session, username)
             return True
         return False
 
+    def new_hash(self, password):
+        """
+        hashes a password with a fresh salt, on the calling thread
+
+        returns tuple(salt, hash)
+        """
+        salt = new_salt()
+        return salt, hash_password(password, salt, self.hashlength)
+
     def __enter__(self):
         """
         syntactic sugar
@@ -448,6 +850,22 @@ class Database(object):
             return session.query(self.course).all()
 
 
+def _integer(value):
+    """
+    converts the value of a rating column, which may be read from a csv file as a string, to an int or None
+    """
+    return None if value is None or value == "" else int(value)
+
+
+# the counts the admin panel shows for a school, mean_rating is None for a school without ratings
+SchoolSummary = namedtuple("SchoolSummary", ["school_id", "school_name", "school_short", "numstudents", "numcourses", "numratings", "mean_rating"])
+
+
+# a change to a single rating, published to the database's listeners once it is committed
+# revision is the revision of the school's ratings its transaction committed
+RatingChange = namedtuple("RatingChange", ["school_id", "user_id", "course_id", "old", "new", "revision"])
+
+
 #A collection of error classes raised when either things do or do not exist in the database
 class DatabaseObjects(Enum):
     """
@@ -493,6 +911,17 @@ class ItemDoesNotExistError(Exception):
     def __str__(self):
         return "A {} named {} does not exist".format(self.identifier.name, self.name)
 
+class DuplicateRowsError(Exception):
+    """
+    Exception raised when a migration would create a unique index that rows already in the database break
+    """
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+
+    def __str__(self):
+        return "; ".join("{} is broken by {}".format(name, ", ".join("{} ({} rows)".format(values, count) for values, count in rows))
+                         for name, rows in sorted(self.duplicates.items()))
+
 class PasswordLengthError(Exception):
     """
     Exception raised when a user's password is too long (hashing 2000 char passwords is bad)
@@ -1,5 +1,6 @@
 """
 """
+from tornado import gen
 from tornado.web import authenticated
 from .BaseHandler import BaseHandler
 
@@ -8,45 +9,34 @@ class AdminpanelHandler(BaseHandler):
     """
     """
     @authenticated
+    @gen.coroutine
     def get(self):
-        self.user = self.get_user_obj()
+        self.user = yield self.get_user_obj_async()
         if self.user.admin:
             self.data["auth"] = True
-            self.data["schools"] = self.db.schools
-
-            #this I would consider the blackest of magicks
-            with self.db.session_scope() as session:
-                for school in self.data["schools"]:
-                    session.add(school)
-                    school.numcourses = len(school.courses)
-                    school.numstudents = len(school.students)
-            self.data["users"] = self.db.users
+            self.data.update((yield self.adb.fetch_admin_summary()))
             self.data["user"] = self.user
 
+            self.data["token"] = self.api_token()
             self.render("adminpanel.html", **self.data)
         else:
             self.redirect("/welcome")
 
 
     @authenticated
+    @gen.coroutine
     def post(self):
-        self.user = self.get_user_obj()
+        self.user = yield self.get_user_obj_async()
         
         school_name = self.validate_item(self.get_argument("school_name", ""), str)
         school_short = self.validate_item(self.get_argument("school_short", ""), str)
         if all([school_name, school_short]):
-            with self.db.session_scope() as session:
-                self.db.add_school(session, school_name, school_short)
+            yield self.adb.add_school(school_name, school_short)
+            yield self.commit()
 
-        with self.db.session_scope() as session:
-            self.data["auth"] = True
-            self.data["schools"] = self.db.schools
-            self.data["users"] = self.db.users
-            self.data["user"] = self.user
+        self.data["auth"] = True
+        self.data.update((yield self.adb.fetch_admin_summary()))
+        self.data["user"] = self.user
 
-            for school in self.data["schools"]:
-                session.add(school)
-                school.numcourses = len(school.courses)
-                school.numstudents = len(school.students)
-
-            self.render("adminpanel.html", **self.data)
+        self.data["token"] = self.api_token()
+        self.render("adminpanel.html", **self.data)
@@ -1,6 +1,7 @@
 """
 The base class from which most (all? other handlers will inherit)
 """
+from tornado import gen
 from tornado.web import RequestHandler
 import tornado
 
@@ -13,24 +14,96 @@ class BaseHandler(RequestHandler):
         An override to the builtin @authenticate, can be rewritten to be better
             if eventually necessary
         """
-        return self.get_secure_cookie("user")
+        return self.user_cookie
 
 
-    def initialize(self, db):
+    def initialize(self, db, adb=None, filters=None, hasher=None, tokens=None):
         """
         Gives the handler some base information that it can then change
         """
-        if self.get_secure_cookie("user"):
-            self.username = tornado.escape.json_decode(self.get_secure_cookie("user"))
+        # the cookie's signature is checked once, here, rather than by every method that needs the username
+        cookie = self.get_secure_cookie("user")
+        if cookie:
+            self.username = tornado.escape.json_decode(cookie)
+        self.user_cookie = cookie
         self.db = db
+        self.async_db = adb
+        self._session = None
+        self._adb = None
+        self.filters = filters
+        self.hasher = hasher
+        self.tokens = tokens
         self.data = {"auth":False, "user":None, "socketbase":"ws://boiling-crag-4069.herokuapp.com/"}
 
     def get_user_obj(self):
-        self.username = tornado.escape.json_decode(self.get_secure_cookie("user"))
-        with self.db.session_scope() as session:
-            self.user = self.db.fetch_user_by_name(session, self.username)
+        """
+        The signed in user, from the Database's cache of them when it is there,
+            detached so only its columns can be read
+        """
+        self.user = self.db.current_user(self.username)
         return self.user
 
+    @gen.coroutine
+    def get_user_obj_async(self):
+        """
+        get_user_obj, without blocking the IOLoop when the user isn't cached
+        """
+        self.user = self.db.cached_user(self.username)
+        if self.user is None:
+            self.user = yield self.async_db.call(self.db.current_user, self.username)
+        raise gen.Return(self.user)
+
+    def api_token(self):
+        """
+        Signs a token for the signed in user, for the websocket calls of the
+            page being rendered
+        """
+        return self.tokens.issue(self.user)
+
+    @property
+    def session(self):
+        """
+        The session of this request, shared by every query it makes so that
+            each object is only fetched once, created the first time it is
+            used and committed once the request has finished
+
+        From its first query to its commit the session holds one of the
+            engine's pooled connections, so a handler commits before it waits
+            on anything else (the hasher, the filters, a slow client) and uses
+            the unbound self.async_db for lookups made before such a wait
+        """
+        if self._session is None:
+            self._session = self.db.sessionmaker()
+        return self._session
+
+    @property
+    def adb(self):
+        """
+        The AsyncDatabase, bound to the request's session
+        """
+        if self._adb is None:
+            self._adb = self.async_db.bind(self.session)
+        return self._adb
+
+    @gen.coroutine
+    def commit(self):
+        """
+        Commits what the request has done so far, for a handler that reads
+            something the commit updates, like the filters, before it finishes,
+            or that is about to wait on something other than the database, as
+            the commit hands the session's connection back to the pool
+        """
+        if self._session is not None:
+            yield self.adb.commit()
+
+    def on_finish(self):
+        """
+        Commits the request's session, or rolls it back if the request failed
+        """
+        if self._session is not None:
+            session, self._session, self._adb = self._session, None, None
+            self.async_db.finish(session, commit=self.get_status() < 500)
+
     def validate_form(self, **kwargs):
         """
         kwargs should be a dict<formname : tuple(value, type(value))>
@@ -59,5 +132,24 @@ class BaseHandler(RequestHandler):
             except TypeError:
                 return None
 
+    @gen.coroutine
+    def add_course(self, school_id):
+        """
+        Adds the course in the submitted course form to the school with the given
+            id, if the form has a course name and identifier
+        """
+        course_name = self.validate_item(self.get_argument("course_name"), str)
+        course_abbreviation = self.validate_item(self.get_argument("course_identifier"), str)
+        professor = self.validate_item(self.get_argument("professor", None), str)
+        year = self.validate_item(self.get_argument("year", None), int)
+        # Crappy implementation of the semester Enum
+        semesters = {"Fall":"Fall","Spring":"Spr","Summer":"Sum","Winter":"Win"}
+        semester = semesters.get(self.validate_item(self.get_argument("semester", None), str))
+
+        if all([course_name is not None, course_abbreviation is not None]):
+            school = yield self.adb.fetch_school_by_id(school_id)
+            yield self.adb.add_course(school.school_short, course_name, course_abbreviation, professor=professor, year=year, semester=semester)
+            yield self.commit()
+
     #do not override get_template_namespace()
     
\ No newline at end of file
@@ -1,6 +1,7 @@
 """
 """
 
+from tornado import gen
 from tornado.web import authenticated
 from .BaseHandler import BaseHandler
 
@@ -9,37 +10,56 @@ class DashHandler(BaseHandler):
     """
     
     @authenticated
+    @gen.coroutine
     def get(self):
-        self.data["user"] = self.get_user_obj()
+        self.data["user"] = yield self.get_user_obj_async()
         self.data["auth"] = True
-        with self.db.session_scope() as session:
-            self.data["school_courses"] = self.db.fetch_school_by_id(session, self.user.school_id).courses
-            session.add(self.user)
-            self.data["your_courses"] = self.user.courses
-            self.data["your_ratings"] = {course.course_id : self.db.fetch_rating_by_id(session, self.data["user"].user_id, course.course_id) for course in self.data["your_courses"]}
+        self.data.update((yield self.adb.fetch_dashboard(self.user.user_id, self.user.school_id)))
+        # the similarities may take a while to build, and the connection isn't needed while they do
+        yield self.commit()
+        self.data["recommendations"] = yield self.recommendations()
+        self.data["token"] = self.api_token()
         self.render("dash.html", **self.data)
 
     @authenticated
+    @gen.coroutine
     def post(self):
-        self.data["user"] = self.get_user_obj()
+        self.data["user"] = yield self.get_user_obj_async()
         self.data["auth"] = True
         if self.get_argument("submit", False):
             course_id = self.validate_item(self.get_argument("submit"), int)
-            with self.db.session_scope() as session:
-                course = self.db.fetch_course_by_id(session, course_id)
-                rating = self.validate_item(self.get_argument("rating-"+str(course.course_id)), int)
-                difficulty = self.validate_item(self.get_argument("difficulty-"+str(course.course_id)), int)
-                grade = self.validate_item(self.get_argument("grade-"+str(course.course_id)), int)
-                if any([grade, difficulty, rating]):
-                    self.db.update_rating(session, self.data["user"].user_name, course.identifier, oldyear=course.year, oldprof=course.professor, oldsem=course.semester, grade=grade, rating=rating, difficulty=difficulty)
+            rating = self.validate_item(self.get_argument("rating-"+str(course_id)), int)
+            difficulty = self.validate_item(self.get_argument("difficulty-"+str(course_id)), int)
+            grade = self.validate_item(self.get_argument("grade-"+str(course_id)), int)
+            yield self.adb.run(self.rate, course_id, grade=grade, rating=rating, difficulty=difficulty)
         else:
             deleted_id = self.validate_item(self.get_argument("delete"), int)
-            with self.db.session_scope() as session:
-                course = self.db.fetch_course_by_id(session, deleted_id)
-                self.db.remove_rating(session, self.data["user"].user_name, course.identifier, semester=course.semester, year=course.year, professor=course.professor)
-        with self.db.session_scope() as session:
-            self.data["school_courses"] = self.db.fetch_school_by_id(session, self.user.school_id).courses
-            session.add(self.user)
-            self.data["your_courses"] = self.user.courses
-            self.data["your_ratings"] = {course.course_id : self.db.fetch_rating_by_id(session, self.data["user"].user_id, course.course_id) for course in self.data["your_courses"]}
+            yield self.adb.run(self.unrate, deleted_id)
+        # the filters only see the change once it is committed
+        yield self.commit()
+        self.data.update((yield self.adb.fetch_dashboard(self.user.user_id, self.user.school_id)))
+        # the similarities may take a while to build, and the connection isn't needed while they do
+        yield self.commit()
+        self.data["recommendations"] = yield self.recommendations()
+        self.data["token"] = self.api_token()
         self.render("dash.html", **self.data)
+
+    def rate(self, session, course_id, grade=None, rating=None, difficulty=None):
+        course = self.db.fetch_course_by_id(session, course_id)
+        if any([grade, difficulty, rating]):
+            self.db.update_rating(session, self.user.user_name, course.identifier, oldyear=course.year, oldprof=course.professor, oldsem=course.semester, grade=grade, rating=rating, difficulty=difficulty)
+
+    def unrate(self, session, course_id):
+        course = self.db.fetch_course_by_id(session, course_id)
+        self.db.remove_rating(session, self.user.user_name, course.identifier, semester=course.semester, year=course.year, professor=course.professor)
+
+    @gen.coroutine
+    def recommendations(self, n=5):
+        """
+        The n courses with the highest predicted rating for the user, as a list
+            of tuple(course, predicted rating), all scored in a single pass
+            once the filter's similarities are built off the IOLoop
+        """
+        courses = {course.course_id : course for course in self.data["school_courses"]}
+        recommended = yield self.filters.rating.recommend_async(self.user.user_id, n)
+        raise gen.Return([(courses[course_id], predicted) for course_id, predicted in recommended if course_id in courses])
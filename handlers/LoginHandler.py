@@ -1,9 +1,12 @@
 """
 """
 
-from .utils import auth_user
+import time
+from tornado import gen
+from .utils import auth_user_async
 import tornado.escape
 from .BaseHandler import BaseHandler
+from databases.PasswordHasher import HasherBusyError
 
 
 class LoginHandler(BaseHandler):
@@ -13,24 +16,34 @@ class LoginHandler(BaseHandler):
     def get(self):
         self.render("login.html", **self.data)
 
+    @gen.coroutine
     def post(self):
+        started = time.time()
         username = self.validate_item(self.get_argument("username", ""), str)
         password =self.validate_item(self.get_argument("password", ""), str)
 
-        if self.is_authorized(username, password):
+        try:
+            authorized = yield self.is_authorized(username, password)
+        except HasherBusyError as error:
+            print("User {} turned away, {}".format(username, error))
+            self.send_error(503)
+            return
+
+        if authorized:
             self.authorize(username)
+            print("User {} logged in in {:.0f}ms".format(username, 1000 * (time.time() - started)))
         else:
             print("User {} failed to logged in".format(username))
             self.redirect("/login")
 
+    @gen.coroutine
     def is_authorized(self, username, password):
-        if auth_user(self.db, username, password):
-            return True
-        return False
+        # looked up in a session of its own, so no connection is held while the password is hashed
+        authorized = yield auth_user_async(self.async_db, self.hasher, username, password)
+        raise gen.Return(authorized)
 
     def authorize(self, user):
         if user:
-            print("User {} logged in".format(user))
             self.set_secure_cookie("user", tornado.escape.json_encode(user))
             self.redirect("/welcome")
         else:
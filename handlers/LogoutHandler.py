@@ -7,5 +7,8 @@ class LogoutHandler(BaseHandler):
     """
     """
     def get(self):
+        if self.current_user:
+            # the tokens handed to the user's pages go with the cookie
+            self.tokens.revoke_user(self.username)
         self.clear_cookie("user")
         self.redirect("/login")
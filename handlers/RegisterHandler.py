@@ -1,6 +1,8 @@
 """
 """
+from tornado import gen
 from .BaseHandler import BaseHandler
+from databases.PasswordHasher import HasherBusyError
 
 
 class RegisterHandler(BaseHandler):
@@ -10,6 +12,7 @@ class RegisterHandler(BaseHandler):
     def get(self):
         self.render("register.html", **self.data)
 
+    @gen.coroutine
     def post(self):
         username = self.validate_item(self.get_argument("username", ""), str)
         email = self.validate_item(self.get_argument("email", ""), str)
@@ -18,8 +21,18 @@ class RegisterHandler(BaseHandler):
         password2 = self.validate_item(self.get_argument("password2", ""), str)
 
         if username != "" and email != "" and password == password2 and school != "" and len(password) < 256:
-            with self.db.session_scope() as session:
-                self.db.add_user(session, username, email, password, school)
+            # a taken name or a missing school is turned away before any time is spent hashing
+            taken, schoolid = yield self.adb.fetch_registration(username, school)
+            if taken or schoolid is None:
+                self.redirect("/register")
+                return
+            try:
+                hashed = yield self.hasher.new_hash(password, "register")
+            except HasherBusyError:
+                self.send_error(503)
+                return
+            yield self.adb.add_user(username, email, password, school, hashed=hashed)
+            yield self.commit()
             self.redirect("/login")
         else:
             self.redirect("/register")
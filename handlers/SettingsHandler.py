@@ -1,27 +1,44 @@
+from tornado import gen
 from tornado.web import authenticated
 from .BaseHandler import BaseHandler
-from .utils import auth_user
+from .utils import auth_user_async
+from databases.PasswordHasher import HasherBusyError
 
 class SettingsHandler(BaseHandler):
     """
     """
         
     @authenticated
+    @gen.coroutine
     def get(self):
         self.data["auth"] = True
-        self.data["user"] = self.get_user_obj()
+        self.data["user"] = yield self.get_user_obj_async()
 
-        self.render("settings.html", **self.data)
+        school = yield self.adb.fetch_school_by_id(self.data["user"].school_id)
+        self.render("settings.html", school_name=school.school_name, **self.data)
 
     @authenticated
+    @gen.coroutine
     def post(self):
         self.data["auth"] = True
-        self.data["user"] = self.get_user_obj()
+        self.data["user"] = yield self.get_user_obj_async()
 
         if self.validate_item(self.get_argument("password", default=None), str) == "true":
-            if auth_user(self.db, self.data["user"].user_name, self.validate_item(self.get_argument("current_pw"), str)):
-                with self.db.session_scope() as session:
-                    self.db.update_password(session, self.data["user"].user_name, self.validate_item(self.get_argument("new_password", default=None), str))
+            current = self.validate_item(self.get_argument("current_pw"), str)
+            try:
+                # looked up in a session of its own, so no connection is held while the passwords are hashed
+                authorized = yield auth_user_async(self.async_db, self.hasher, self.data["user"].user_name, current, "password")
+                if authorized:
+                    new_password = self.validate_item(self.get_argument("new_password", default=None), str)
+                    hashed = yield self.hasher.new_hash(new_password, "password")
+            except HasherBusyError as error:
+                print("User {} turned away, {}".format(self.data["user"].user_name, error))
+                self.send_error(503)
+                return
+            if authorized:
+                yield self.adb.update_password(self.data["user"].user_name, new_password, hashed=hashed)
+                yield self.commit()
+                self.tokens.revoke_user(self.data["user"].user_name)
         else:
             #get args
             first_name = self.get_argument("fname", default=None, strip=True)
@@ -37,23 +54,11 @@ class SettingsHandler(BaseHandler):
                 "age":(age,int),
                 "graduation":(grad,int)}
             values = self.validate_form(**values)
-            with self.db.session_scope() as session:
-                if {values[key] for key in values} != {None}:
-                    self.db.update_user(session, self.username, **values)
+            if {values[key] for key in values} != {None}:
+                yield self.adb.update_user(self.username, **values)
+                yield self.commit()
+                # the commit has dropped the cached user, so this is fetched again as it now is
+                self.data["user"] = yield self.get_user_obj_async()
 
-
-        self.render("settings.html", **self.data)
-
-
-
-    def get_template_namespace(self):
-        #This is a bit of a hack, but it works
-        namespace = BaseHandler.get_template_namespace(self)
-
-        def fetch_school(school):
-            with self.db.session_scope() as session:
-                 return self.db.fetch_school_by_id(session, school)
-
-        namespace = dict(fetch_school=fetch_school,**namespace)
-        namespace.update(self.ui)
-        return namespace
+        school = yield self.adb.fetch_school_by_id(self.data["user"].school_id)
+        self.render("settings.html", school_name=school.school_name, **self.data)
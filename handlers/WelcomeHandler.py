@@ -1,8 +1,8 @@
 """
 """
 
+from tornado import gen
 from tornado.web import authenticated
-import tornado
 from .BaseHandler import BaseHandler
 
 
@@ -11,12 +11,8 @@ class WelcomeHandler(BaseHandler):
     """
 
     @authenticated
+    @gen.coroutine
     def get(self):
         self.data["auth"] = True
-
-        self.username = tornado.escape.json_decode(self.get_secure_cookie("user"))
-        
-        with self.db.session_scope() as session:
-            self.user = self.db.fetch_user_by_name(session, self.username)
-        self.data["user"] = self.user
+        self.data["user"] = yield self.get_user_obj_async()
         self.render("welcome.html", **self.data)
@@ -1,5 +1,7 @@
 import scrypt
 from base64 import b64encode
+from tornado import gen
+from databases.database import ItemDoesNotExistError
 
 def auth_user(database, username, password):
     with database.session_scope() as session:
@@ -9,6 +11,19 @@ def auth_user(database, username, password):
             return True
         return False
 
+@gen.coroutine
+def auth_user_async(adb, hasher, username, password, kind="login"):
+    """
+    auth_user, with the user fetched through an AsyncDatabase and the password
+        hashed by a PasswordHasher, so neither blocks the IOLoop
+    """
+    try:
+        user = yield adb.fetch_user_by_name(username)
+    except ItemDoesNotExistError:
+        raise gen.Return(False)
+    authorized = yield hasher.verify(password, user.password_salt, user.password_hash, kind)
+    raise gen.Return(authorized)
+
 def auth_admin(database, username, password):
     with database.session_scope() as session:
         user = database.fetch_user_by_name(session, username)
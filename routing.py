@@ -2,10 +2,14 @@
 """
 """
 
+import csv
+import logging
 import os
-from tornado import ioloop
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, ioloop
 from tornado.web import Application
-from sys import argv
+from sys import argv, stdout
 # there must be a better way to do this!
 from handlers.IndexHandler import IndexHandler
 from handlers.RegisterHandler import RegisterHandler
@@ -25,10 +29,23 @@ from api.handlers.ApiUsers import ApiUsers
 from api.handlers.ApiUser import ApiUser
 from api.handlers.ApiToggleSocket import ApiToggleSocket
 from api.handlers.ApiAddCourse import ApiAddCourse
+from api.handlers.ApiSocket import ApiSocket
+from api.handlers.ApiExport import ApiExport
+from api.handlers.ApiToken import ApiToken
 
-from databases.database import Database
+from databases.database import Database, DuplicateRowsError
+from databases.AsyncDatabase import AsyncDatabase
+from databases.PasswordHasher import PasswordHasher
+from databases.Exporter import Exporter
+from databases.TokenSigner import TokenSigner
 
 from backend.Filter import Filter
+from backend.ItemFilter import ItemFilter
+from backend.RatingStore import RatingStore
+from backend.FactorFilter import FactorFilter
+from backend.Jobs import JobPool
+from backend.Shards import ShardRouter, ShardedFilter
+from backend.PredictionPush import PredictionPush
 
 global_settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
@@ -38,92 +55,219 @@ global_settings = {
     "cookie_secret": "This is actually a secret cookie!986425&(!@"
     }
 
-# the gloabl database
-db = Database()
+# the gloabl database, which keeps signed in users for USER_TTL seconds
+db = Database(user_ttl=int(os.environ.get("USER_TTL", 60)))
+# handlers query it from a pool of threads, so a slow query doesn't hold up every other request
+adb = AsyncDatabase(db, int(os.environ.get("DB_WORKERS", 10)))
+# the websockets and the api are authenticated by signed tokens that last TOKEN_LIFETIME seconds
+tokens = TokenSigner(global_settings["cookie_secret"], int(os.environ.get("TOKEN_LIFETIME", 6 * 60 * 60)))
+
+# the filters share one store, so the ratings of a school are only loaded once
+# it is snapshotted to disk so that a restarted server starts warm, which needs SNAPSHOT_PATH to be
+# on persistent storage: heroku's own filesystem is wiped whenever the dyno restarts
+snapshot_path = os.environ.get("SNAPSHOT_PATH", os.path.join(os.path.dirname(__file__), "databases", "data", "snapshots"))
+rating_store = RatingStore(db, snapshot_path, adb=adb)
+
+# factor models are trained offline by the train command below, and served by make_server's filters
+model_path = os.environ.get("MODEL_PATH", os.path.join(os.path.dirname(__file__), "databases", "data", "models"))
+factor_filter = FactorFilter(db, "rating", model_path, rating_store)
 
-rating_filter = Filter(db, "rating")
-grade_filter = Filter(db, "grade")
-difficulty_filter = Filter(db, "difficulty")
 
 class Filters(object):  # a pseudo-struct to hold the filters
     pass
 
-filters = Filters()
-filters.rating = rating_filter
-filters.grade = grade_filter
-filters.difficulty = difficulty_filter
-
-# a list of web routes and the objects to which they connect
-class_rank = Application([
-    # things relating to the homepage
-    (r'/', IndexHandler, dict(db=db)),
-    (r'/index/?', IndexHandler, dict(db=db)),
-
-    # authentication/signin
-    (r'/register/?', RegisterHandler, dict(db=db)),
-    (r'/login/?', LoginHandler, dict(db=db)),
-    (r'/logout/?', LogoutHandler, dict(db=db)),
-
-    #require authentication for normal users
-    (r'/welcome/?', WelcomeHandler, dict(db=db)),
-    (r'/dash/?', DashHandler, dict(db=db)),  # partial
-    (r'/app/?', AppHandler, dict(db=db)),  # partial
-    (r'/settings/?', SettingsHandler, dict(db=db)),
+
+class Server(object):  # a pseudo-struct to hold the application and the workers it runs on
+    pass
+
+
+def make_server():
+    """
+    Starts the threads and processes the web server runs on and builds the
+        application on them.  Only runserver calls this, so that the other
+        commands don't start any workers.
+
+    Return -> a Server, with the application, its filters and prediction push,
+              and the hasher, job pool and shard router to shut down
+    """
+    # passwords are hashed on their own threads, HASH_WORKERS at a time with at most HASH_LIMIT waiting
+    hasher = PasswordHasher(db.hashlength, int(os.environ.get("HASH_WORKERS", 4)), int(os.environ.get("HASH_LIMIT", 64)))
+
+    # on a machine with cores to spare, FILTER_SHARDS worker processes each own the filters of some schools.
+    # Otherwise similarities are built in worker processes, so a school's first request doesn't stall the server;
+    # the shards build their own, so the pool is only started without them
+    shards = int(os.environ.get("FILTER_SHARDS", 0))
+    job_pool = None
+    if not shards:
+        job_pool = JobPool(int(os.environ["FILTER_WORKERS"]) if "FILTER_WORKERS" in os.environ else None)
+
+    # FILTER_ENGINE=item predicts from the similarities of courses rather than of students, see backend/ItemFilter.py
+    engine = os.environ.get("FILTER_ENGINE", "user")
+    if engine not in ("user", "item"):
+        raise ValueError("FILTER_ENGINE must be user or item, not {}".format(engine))
+    engine_class = ItemFilter if engine == "item" else Filter
+
+    filters = Filters()
+    filters.store = rating_store
+    filters.jobs = job_pool
+    filters.rating = engine_class(db, "rating", rating_store, jobs=job_pool)
+    filters.grade = engine_class(db, "grade", rating_store, jobs=job_pool)
+    filters.difficulty = engine_class(db, "difficulty", rating_store, jobs=job_pool)
+
+    # with shards, they answer for the filters
+    shard_router = None
+    if shards:
+        shard_router = ShardRouter(db, rating_store, shards, snapshot_path)
+        filters.rating = ShardedFilter(shard_router, "rating", engine=engine)
+        filters.grade = ShardedFilter(shard_router, "grade", engine=engine)
+        filters.difficulty = ShardedFilter(shard_router, "difficulty", engine=engine)
+
+    # and a school's factor models, once trained, answer instead for as long as they match its ratings
+    filters.rating = FactorFilter(db, "rating", model_path, rating_store, fallback=filters.rating)
+    filters.grade = FactorFilter(db, "grade", model_path, rating_store, fallback=filters.grade)
+    filters.difficulty = FactorFilter(db, "difficulty", model_path, rating_store, fallback=filters.difficulty)
+
+    # the dash pages are pushed the predictions that change when the ratings at their user's school do
+    prediction_push = PredictionPush(db, filters)
+
+    # a list of web routes and the objects to which they connect
+    class_rank = Application([
+        # things relating to the homepage
+        (r'/', IndexHandler, dict(db=db, adb=adb)),
+        (r'/index/?', IndexHandler, dict(db=db, adb=adb)),
+
+        # authentication/signin
+        (r'/register/?', RegisterHandler, dict(db=db, adb=adb, hasher=hasher)),
+        (r'/login/?', LoginHandler, dict(db=db, adb=adb, hasher=hasher)),
+        (r'/logout/?', LogoutHandler, dict(db=db, adb=adb, tokens=tokens)),
+
+        #require authentication for normal users
+        (r'/welcome/?', WelcomeHandler, dict(db=db, adb=adb)),
+        (r'/dash/?', DashHandler, dict(db=db, adb=adb, filters=filters, tokens=tokens)),  # partial
+        (r'/app/?', AppHandler, dict(db=db, adb=adb)),  # partial
+        (r'/settings/?', SettingsHandler, dict(db=db, adb=adb, hasher=hasher, tokens=tokens)),
     
-    # moderator only
-    (r'/modpanel/?', ModHandler, dict(db=db)),
-
-    # admin only
-    (r'/adminpanel/school/(\d+)/?', AdminSchoolHandler, dict(db=db)),
-    (r'/adminpanel/?', AdminpanelHandler, dict(db=db)),
-
-    # api-----------------------------------------------------------------------
-    # catches the following:
-    #     /api/school/123
-    #     /api/school/123
-    #     /api/school/Georgia_Tech
-    #     /api/school/123/
-    #     /api/school/Georgia_Tech.json
-    (r'/api/school/(.+?)(?:/?|(?:\.json)?)', ApiSchool, dict(db=db)),
-    # catches the following:
-    #     /api/schools
-    #     /api/schools/
-    #     /api/schools.json
-    (r'/api/schools(:?/|\.json)?', ApiSchools, dict(db=db)),
-    # catches the following:
-    #     /api/user/123
-    #     /api/user/jmorton
-    #     /api/user/123/
-    #     /api/jmorton.json
-    (r'/api/user/(.+?)(?:/?|(?:\.json)?)', ApiUser, dict(db=db)),
-    # catches the following:
-    #     /api/schools
-    #     /api/schools/
-    #     /api/schools.json
-    (r'/api/users(:?/|\.json)?', ApiUsers, dict(db=db)),
-    # Toggles users being moderators/admins
-    (r'/api/toggle/?', ApiToggleSocket, dict(db=db)),  # websocket
-    # Adds a course for a given user
-    (r'/api/add_course/?', ApiAddCourse, dict(db=db)),  # websocket
-    (r'/api/?', ApiHome, dict(db=db)),
-    # user/(#####) #maybe?
-    # user/user_name
-    # course/(#####)/(#####) #maybe
-    # course/school_abbr/(#####)
-    # course/school_abbr/course_abbr
-    # adminpanel/schools
-    # adminpanel/users
-    # adminpanel/courses
-    # adminpanel/school/(#####)
-    # adminpanel/user/(#####)
-    # adminpanel/course/(#####)/(#####)
-    ], **global_settings)
+        # moderator only
+        (r'/modpanel/?', ModHandler, dict(db=db, adb=adb, tokens=tokens)),
+
+        # admin only
+        (r'/adminpanel/school/(\d+)/?', AdminSchoolHandler, dict(db=db, adb=adb, tokens=tokens)),
+        (r'/adminpanel/?', AdminpanelHandler, dict(db=db, adb=adb, tokens=tokens)),
+
+        # api-----------------------------------------------------------------------
+        # catches the following:
+        #     /api/school/123
+        #     /api/school/123
+        #     /api/school/Georgia_Tech
+        #     /api/school/123/
+        #     /api/school/Georgia_Tech.json
+        (r'/api/school/(.+?)(?:/?|(?:\.json)?)', ApiSchool, dict(db=db, adb=adb)),
+        # catches the following:
+        #     /api/schools
+        #     /api/schools/
+        #     /api/schools.json
+        (r'/api/schools(:?/|\.json)?', ApiSchools, dict(db=db, adb=adb)),
+        # catches the following:
+        #     /api/user/123
+        #     /api/user/jmorton
+        #     /api/user/123/
+        #     /api/jmorton.json
+        (r'/api/user/(.+?)(?:/?|(?:\.json)?)', ApiUser, dict(db=db, adb=adb)),
+        # catches the following:
+        #     /api/schools
+        #     /api/schools/
+        #     /api/schools.json
+        (r'/api/users(:?/|\.json)?', ApiUsers, dict(db=db, adb=adb)),
+        # Toggles users being moderators/admins
+        (r'/api/toggle/?', ApiToggleSocket, dict(db=db, adb=adb, tokens=tokens)),  # websocket
+        # Adds a course for a given user
+        (r'/api/add_course/?', ApiAddCourse, dict(db=db, adb=adb, tokens=tokens)),  # websocket
+        # the socket a page keeps open, which takes add_course, toggle and predict messages
+        (r'/api/socket/?', ApiSocket, dict(db=db, adb=adb, tokens=tokens, filters=filters, push=prediction_push)),  # websocket
+        # streams a whole table to admins, or one school's part with ?school=123, catches the following:
+        #     /api/export/ratings
+        #     /api/export/courses.csv
+        #     /api/export/users.json (newline delimited)
+        (r'/api/export/(ratings|users|courses)(?:\.(csv|json))?/?', ApiExport, dict(db=db, adb=adb, tokens=tokens)),
+        # GET hands the signed in user a token, DELETE revokes the token it is sent with
+        (r'/api/token/?', ApiToken, dict(db=db, adb=adb, tokens=tokens)),
+        (r'/api/?', ApiHome, dict(db=db, adb=adb)),
+        # user/(#####) #maybe?
+        # user/user_name
+        # course/(#####)/(#####) #maybe
+        # course/school_abbr/(#####)
+        # course/school_abbr/course_abbr
+        # adminpanel/schools
+        # adminpanel/users
+        # adminpanel/courses
+        # adminpanel/school/(#####)
+        # adminpanel/user/(#####)
+        # adminpanel/course/(#####)/(#####)
+        ], **global_settings)
+
+    server = Server()
+    server.application = class_rank
+    server.filters = filters
+    server.prediction_push = prediction_push
+    server.hasher = hasher
+    server.job_pool = job_pool
+    server.shard_router = shard_router
+    return server
 
 
 
 def runserver():
-    class_rank.listen(int(os.environ.get("PORT", 5000)))
-    ioloop.IOLoop.instance().start()
+    server = make_server()
+    hasher, job_pool, shard_router = server.hasher, server.job_pool, server.shard_router
+    server.application.listen(int(os.environ.get("PORT", 5000)))
+    loop = ioloop.IOLoop.instance()
+    if "SNAPSHOT_PATH" not in os.environ:
+        print("SNAPSHOT_PATH isn't set, the snapshots are written to {}; if that isn't persistent storage "
+              "(on heroku it isn't) every restart rebuilds the similarities from scratch".format(snapshot_path))
+
+    # snapshot every five minutes, and on the way out when heroku stops the dyno.  The periodic
+    # snapshots are written by their own thread, the IOLoop would otherwise stall for every write
+    snapshot_executor = ThreadPoolExecutor(1)
+
+    @gen.coroutine
+    def snapshot():
+        try:
+            yield rating_store.save_async(snapshot_executor)
+        except Exception as error:
+            print("Couldn't write the snapshots, {!r}".format(error))
+    ioloop.PeriodicCallback(snapshot, 5 * 60 * 1000).start()
+    if shard_router is not None:
+        @gen.coroutine
+        def snapshot_shards():
+            try:
+                yield shard_router.save()
+            except Exception as error:
+                print("Couldn't write the shards' snapshots, {!r}".format(error))
+        ioloop.PeriodicCallback(snapshot_shards, 5 * 60 * 1000).start()
+
+    # the hashing latencies and rejections are logged alongside, to tune HASH_WORKERS and HASH_LIMIT against real load
+    logging.basicConfig()
+    hasher_log = logging.getLogger("classrank.hasher")
+    hasher_log.setLevel(logging.INFO)
+
+    def log_hasher():
+        if hasher.pending or hasher.rejected or any(hasher.counts.values()):
+            hasher_log.info("password hasher %s", hasher.stats())
+    ioloop.PeriodicCallback(log_hasher, 5 * 60 * 1000).start()
+
+    def shutdown():
+        snapshot_executor.shutdown()
+        rating_store.save()
+        if job_pool is not None:
+            job_pool.shutdown()
+        adb.shutdown()
+        hasher.shutdown()
+        if shard_router is not None:
+            shard_router.save()
+            shard_router.shutdown()
+        loop.stop()
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.add_callback_from_signal(shutdown))
+    loop.start()
 
 
 if __name__ == "__main__":
@@ -132,8 +276,48 @@ if __name__ == "__main__":
     if argv[1] == "add_school":
         with db.session_scope() as session:
             db.add_school(session, argv[2], argv[3])
+    if argv[1] == "migrate":
+        # adds the columns and indexes of newer versions to an existing database, once any rows that would break
+        # its unique indexes are merged or removed
+        try:
+            created = db.migrate()
+        except DuplicateRowsError as error:
+            print("nothing migrated, remove the duplicates first: {}".format(error))
+        else:
+            print("created {}".format(", ".join(created)) if created else "nothing to migrate")
     if argv[1] == "admin":
+        # stamps the user's roles_changed too, so a running server refuses the tokens issued to them before
         with db.session_scope() as session:
             db.update_user(session, argv[2], admin=True)
     if argv[1] == "filter_test":
-        print(rating_filter.calculated_rating(4, 5))
\ No newline at end of file
+        print(Filter(db, "rating", rating_store).calculated_rating(4, 5))
+    if argv[1] == "train":
+        # trains the factor models of every school, or of the schools named by id
+        schools = [int(school_id) for school_id in argv[2:]] or [school.school_id for school in db.schools]
+        for school_id in schools:
+            for attribute in ("rating", "grade", "difficulty"):
+                model = factor_filter.train(school_id, attribute)
+                print("trained {} of school {} on revision {}".format(attribute, school_id, model.revision))
+    if argv[1] == "import_ratings":
+        # loads a csv of ratings whose header names the arguments of add_rating: username, coursename, semester,
+        # year, professor, rating, grade, difficulty
+        with open(argv[2], newline="") as ratings, db.session_scope() as session:
+            added, skipped = db.bulk_add_ratings(session, csv.DictReader(ratings))
+        print("imported {} ratings, skipped {}".format(added, skipped))
+    if argv[1] == "export":
+        # streams a table to stdout: export <ratings|users|courses> [csv|json] [school_id]
+        table, form = argv[2], argv[3] if len(argv) > 3 else "csv"
+        exporter = Exporter(db)
+        with db.session_scope() as session:
+            rows = exporter.rows(session, table, int(argv[4]) if len(argv) > 4 else None)
+            if form == "csv":
+                stdout.write(exporter.csv_header(table))
+            for row in rows:
+                stdout.write(exporter.csv_lines([row]) if form == "csv" else exporter.json_lines(table, [row]))
+    if argv[1] == "snapshot":
+        # builds the user and course similarities of every school and writes them out, to warm up a new server
+        for school in db.schools:
+            for attribute in ("rating", "grade", "difficulty"):
+                rating_store.similarities_for(school.school_id, attribute)
+                rating_store.item_similarities_for(school.school_id, attribute)
+        print("wrote {} snapshots to {}".format(rating_store.save(), snapshot_path))
\ No newline at end of file
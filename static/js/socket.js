@@ -1,21 +1,92 @@
-function makeConnection(socket_host, message, callback, clickEvent){
+function Channel(socket_url){
     /*
-     * A class to make doing websocket requests much, erm, easier.
-     * socket_url is the url of the websocket we will be communicating with
-     * messages is an object containting a set of messages to be sent to the socket host
+     * A single long lived websocket that carries every request a page makes,
+     * instead of a new connection (and handshake) per click.
+     * socket_url is the url of the multiplexed socket, api/socket
+     *
+     * Each message is given an id, and the reply with the same id is handed to
+     * the callback it was sent with.  Messages sent while the socket is
+     * connecting wait for it.  When the connection drops it is reopened, at
+     * first straight away and then after doubling delays of up to 30 seconds,
+     * and the requests it was carrying fail with {stat:"failed"} rather than
+     * being sent twice.
+     *
+     * Messages the server pushes unasked, which have no id, are handed to the
+     * listeners added with on(type, listener) for their type, and the "open"
+     * listeners are called each time the socket (re)connects, to subscribe.
      */
-    
-    //create a websocket at the given url
-    var response;
-    var socket = new WebSocket(socket_host);
+    this.socket_url = socket_url;
+    this.socket = null;
+    this.next_id = 1;
+    this.pending = {};
+    this.queue = [];
+    this.listeners = {};
+    this.retries = 0;
+    this.connect();
+}
 
-    socket.onopen = function(event) {
-            socket.send(JSON.stringify(message));
+Channel.prototype.connect = function(){
+    var channel = this;
+    var socket = new WebSocket(this.socket_url);
+    this.socket = socket;
+
+    socket.onopen = function(event){
+        channel.retries = 0;
+        while (channel.queue.length > 0){
+            socket.send(JSON.stringify(channel.queue.shift()));
+        }
+        channel.emit("open", event);
+    }
+
+    socket.onmessage = function(event){
+        var response = JSON.parse(event.data);
+        var callback = channel.pending[response.id];
+        if (callback !== undefined){
+            delete channel.pending[response.id];
+            callback(response);
+        } else if (response.id === undefined){
+            channel.emit(response.type, response);
+        }
     }
 
-    socket.onmessage = function(event) {
-        response = JSON.parse(event.data);
-        socket.close();
-        callback(response, clickEvent);
+    socket.onclose = function(event){
+        channel.socket = null;
+        // the messages still queued were never sent, and go out once it reconnects
+        var pending = channel.pending;
+        channel.pending = {};
+        channel.queue.forEach(function(message){
+            channel.pending[message.id] = pending[message.id];
+            delete pending[message.id];
+        });
+        for (var id in pending){
+            pending[id]({id:Number(id), stat:"failed", error:"disconnected"});
+        }
+        var delay = channel.retries === 0 ? 0 : Math.min(30000, 500 * Math.pow(2, channel.retries - 1));
+        channel.retries += 1;
+        // spread the reconnects of many pages out, so a restarted server isn't hit by all of them at once
+        setTimeout(function(){ channel.connect(); }, delay + Math.random() * delay / 2);
     }
-}
\ No newline at end of file
+}
+
+Channel.prototype.send = function(message, callback){
+    /*
+     * Sends a message, an object with a type (add_course, toggle, predict) and
+     * the values that type needs, and calls callback with the reply
+     */
+    message.id = this.next_id++;
+    this.pending[message.id] = callback || function(){};
+    if (this.socket !== null && this.socket.readyState === WebSocket.OPEN){
+        this.socket.send(JSON.stringify(message));
+    } else {
+        this.queue.push(message);
+    }
+    return message.id;
+}
+
+Channel.prototype.on = function(type, listener){
+    (this.listeners[type] = this.listeners[type] || []).push(listener);
+}
+
+Channel.prototype.emit = function(type, message){
+    (this.listeners[type] || []).forEach(function(listener){ listener(message); });
+}